@@ -0,0 +1,68 @@
+"""Write throughput of file_hashes: a commit per row against batched executemany.
+
+    python -m benchmarks.db_writes --rows 100000
+
+Commit-per-row modes fsync on every file, so they run on --per-row-rows rows and are compared by rows/s.
+"""
+
+import argparse
+import hashlib
+import os
+import tempfile
+import time
+
+from src.db import DBApi
+from src.models import FileFingerprint
+
+
+def make_rows(count: int, seed: str) -> list[tuple[str, dict[str, str], FileFingerprint]]:
+    rows = []
+    for i in range(count):
+        digest = hashlib.sha256(f"{seed}{i}".encode()).hexdigest()
+        digests = {"blake3": digest, "sha256": digest, "autov2": digest[:10], "crc32": digest[:8]}
+        rows.append(
+            (f"/models/Lora/{i // 1000}/model-{i}.safetensors", digests, FileFingerprint(size=i, mtime_ns=i, inode=i)),
+        )
+    return rows
+
+
+def write_per_row(db_api: DBApi, rows) -> None:
+    for i, (path, digests, fingerprint) in enumerate(rows):
+        db_api.update_filehash(path, digests["blake3"], fingerprint, digests)
+        db_api.update_data(path, i, i)
+
+
+def write_batched(db_api: DBApi, rows) -> None:
+    with db_api.batch() as batch:
+        for i, (path, digests, fingerprint) in enumerate(rows):
+            batch.update_filehash(path, digests["blake3"], fingerprint, digests)
+            batch.update_data(path, i, i)
+
+
+def run_mode(name: str, rows_count: int, journal_mode: str, synchronous: str, writer) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        db_api = DBApi(os.path.join(tmp, "db.sqlite"), journal_mode=journal_mode)
+        db_api.conn.execute(f"PRAGMA synchronous = {synchronous}")
+        for stage, seed in (("insert", "a"), ("update", "b")):
+            rows = make_rows(rows_count, seed)
+            started = time.perf_counter()
+            writer(db_api, rows)
+            elapsed = time.perf_counter() - started
+            print(f"{name:<28} {stage:<7} {rows_count:>8} rows {elapsed:>9.2f}s {rows_count / elapsed:>12.0f} rows/s")
+        db_api.conn.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--per-row-rows", type=int, default=5_000)
+    args = parser.parse_args()
+
+    # the old behaviour: rollback journal, full fsync, a commit per statement group
+    run_mode("per-row, DELETE/FULL", args.per_row_rows, "DELETE", "FULL", write_per_row)
+    run_mode("per-row, WAL/NORMAL", args.per_row_rows, "WAL", "NORMAL", write_per_row)
+    run_mode("batched, WAL/NORMAL", args.rows, "WAL", "NORMAL", write_batched)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Synthetic .safetensors libraries: LoRA-shaped files of a given size, the same bytes for the same seed.
+
+    python -m benchmarks.library /tmp/library --files 200 --size-mb 2 --corrupt 10
+
+Files go to loras/<n>/ in folders of 100, every tenth one to models/ instead. Corrupted files are either
+truncated or have a header that doesn't parse. A manifest.json next to them keeps the parameters and the
+sha256 of every file, an existing library with the same parameters is reused as it is.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import struct
+
+import numpy as np
+
+from pydantic import BaseModel
+
+MODELS_FOLDER = "models"
+LORAS_FOLDER = "loras"
+MANIFEST = "manifest.json"
+
+# down and up projections of a kohya-ss LoRA, F16
+BLOCKS = 8
+RANK = 8
+
+
+class SyntheticFile(BaseModel):
+    path: str  # relative to the library root
+    size: int
+    sha256: str
+    corrupted: bool = False
+
+
+class Library(BaseModel):
+    root: str = ""
+    files_count: int
+    size: int
+    corrupt: int
+    seed: int
+    files: list[SyntheticFile] = []
+
+    def paths(self) -> list[str]:
+        return [os.path.join(self.root, file.path) for file in self.files]
+
+    def total_bytes(self) -> int:
+        return sum(file.size for file in self.files)
+
+
+def safetensors_bytes(name: str, size: int, rng: np.random.Generator) -> bytes:
+    """A LoRA of about size bytes with random weights, the header included."""
+    dim = max(1, size // (BLOCKS * 2 * RANK * 2))
+    header: dict[str, object] = {
+        "__metadata__": {
+            "ss_output_name": name,
+            "ss_network_dim": str(RANK),
+            "ss_base_model_version": "sdxl_base_v1-0",
+        },
+    }
+    offset = 0
+    for block in range(BLOCKS):
+        prefix = f"lora_unet_down_blocks_{block}_attentions_0_proj_in"
+        for suffix, shape in ((".lora_down.weight", [RANK, dim]), (".lora_up.weight", [dim, RANK])):
+            header[prefix + suffix] = {
+                "dtype": "F16",
+                "shape": shape,
+                "data_offsets": [offset, offset + dim * RANK * 2],
+            }
+            offset += dim * RANK * 2
+    encoded = json.dumps(header, separators=(",", ":")).encode()
+    # the data starts 8-byte aligned, like the files safetensors writes
+    encoded += b" " * (-len(encoded) % 8)
+    return struct.pack("<Q", len(encoded)) + encoded + rng.bytes(offset)
+
+
+def corrupted(content: bytes, index: int) -> bytes:
+    if index % 2:
+        # the header promises more data than there is
+        return content[: len(content) // 2]
+    return content[:8] + b"{not json" + content[17:]
+
+
+def make_library(root: str, files_count: int, size: int, corrupt: int = 0, seed: int = 0) -> Library:
+    library = Library(root=root, files_count=files_count, size=size, corrupt=corrupt, seed=seed)
+    manifest_path = os.path.join(root, MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            existing = Library.model_validate_json(f.read())
+        if existing.model_dump(exclude={"root", "files"}) == library.model_dump(exclude={"root", "files"}):
+            return existing.model_copy(update={"root": root})
+        # files of a bigger library than this one would be scanned along with it
+        for file in existing.files:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(root, file.path))
+
+    # corrupted files are spread over the library, not all in the last folder
+    corrupted_indices = set(np.linspace(0, files_count - 1, corrupt).astype(int).tolist()) if corrupt else set()
+    for index in range(files_count):
+        name = f"lora-{index:06d}"
+        folder = MODELS_FOLDER if index % 10 == 0 else os.path.join(LORAS_FOLDER, str(index // 100))
+        path = os.path.join(folder, f"{name}.safetensors")
+        content = safetensors_bytes(name, size, np.random.default_rng([seed, index]))
+        if index in corrupted_indices:
+            content = corrupted(content, index)
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+        with open(os.path.join(root, path), "wb") as f:
+            f.write(content)
+        library.files.append(
+            SyntheticFile(
+                path=path,
+                size=len(content),
+                sha256=hashlib.sha256(content).hexdigest(),
+                corrupted=index in corrupted_indices,
+            ),
+        )
+
+    with open(manifest_path, "w") as f:
+        f.write(library.model_dump_json(exclude={"root"}))
+    return library
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("root")
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--size-mb", type=float, default=2.0)
+    parser.add_argument("--corrupt", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    library = make_library(args.root, args.files, int(args.size_mb * (1 << 20)), args.corrupt, args.seed)
+    print(f"{len(library.files)} files, {library.total_bytes() / (1 << 20):.1f} MiB in {library.root}")
+
+
+if __name__ == "__main__":
+    main()
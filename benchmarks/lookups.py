@@ -0,0 +1,92 @@
+"""Lookups of local files against the catalog: a query per hash against one query for all of them.
+
+    python -m benchmarks.lookups --models 4000 --versions 5
+
+Every version has one file known to CivitAI by its sha256, the local files are looked up by blake3 first
+like metadata does, so each of them misses once before it's found. Related versions (newer ones, inpainting
+ones) are queried for the half of the versions that have a local file.
+"""
+
+import argparse
+import hashlib
+import os
+import tempfile
+import time
+
+from benchmarks.render import make_models
+
+from src.db import DBApi
+from src.models import FileFingerprint
+
+
+def digest(algorithm: str, model_version_id: int) -> str:
+    return hashlib.sha256(f"{algorithm}{model_version_id}".encode()).hexdigest()
+
+
+def fill(db_api: DBApi, models_count: int, versions: int) -> None:
+    models = make_models(models_count, versions=versions, images=0)
+    with db_api.transaction():
+        for model in models:
+            model.id += 1  # model id 0 reads as missing
+            for model_version in model.modelVersions:
+                model_version.modelId = model.id
+                model_version.baseModelType = "Inpainting" if model_version.id % 7 == 0 else "Standard"
+                model_version.files[0].hashes.SHA256 = digest("sha256", model_version.id).upper()
+            db_api.upsert_model(model)
+
+    with db_api.batch() as batch:
+        for model in models:
+            for model_version in model.modelVersions:
+                path = f"/models/Lora/{model.id}/v{model_version.id}.safetensors"
+                digests = {"blake3": digest("blake3", model_version.id), "sha256": digest("sha256", model_version.id)}
+                fingerprint = FileFingerprint(size=model_version.id, mtime_ns=model_version.id, inode=model_version.id)
+                batch.update_filehash(path, digests["blake3"], fingerprint, digests)
+
+
+def timed(name: str, count: int, function) -> object:
+    started = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - started
+    print(f"{name:<28} {count:>8} {elapsed:>9.3f}s {count / elapsed:>12.0f} /s")
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--models", type=int, default=4000)
+    parser.add_argument("--versions", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_api = DBApi(os.path.join(tmp, "db.sqlite"))
+        fill(db_api, args.models, args.versions)
+        items = list(db_api.get_filehashes().values())
+
+        per_file = timed(
+            "a query per hash",
+            len(items),
+            lambda: [db_api.find_model_version_by_hashes(item.lookup_hashes()) for item in items],
+        )
+        found = timed(
+            "one query",
+            len(items),
+            lambda: db_api.find_model_versions_by_hashes(
+                filehash for item in items for filehash in item.lookup_hashes()
+            ),
+        )
+        batched = [next((found[h.upper()] for h in item.lookup_hashes() if h.upper() in found), None) for item in items]
+        if batched != per_file:
+            raise SystemExit("lookups disagree")
+
+        with db_api.batch() as batch:
+            for item, (model_id, model_version_id) in zip(items[::2], batched[::2], strict=True):
+                batch.update_data(item.filepath, model_id, model_version_id)
+        links = timed("newer versions", len(items) // 2, db_api.find_newer_versions)
+        print(f"{'':<28} {len(links):>8} links")
+        links = timed("inpaint versions", len(items) // 2, db_api.find_inpaint_versions)
+        print(f"{'':<28} {len(links):>8} links")
+        db_api.conn.close()
+
+
+if __name__ == "__main__":
+    main()
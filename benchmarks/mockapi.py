@@ -0,0 +1,99 @@
+"""A local CivitAI API for benchmarks: /models/{id} and /model-versions/by-hash over an httpx.MockTransport.
+
+Every response is delayed by latency seconds and a throttle share of them is a 429 with Retry-After, both
+drawn from a seeded generator, so two runs with the same parameters see the same responses.
+"""
+
+import asyncio
+import json
+import random
+import re
+
+from collections import Counter
+
+import httpx
+
+from benchmarks.library import Library
+from benchmarks.render import make_models
+
+from src.models import CivitaiModel
+
+MODEL_PATH = re.compile(r"/models/(\d+)$")
+BY_HASH_PATH = re.compile(r"/model-versions/by-hash/(\w+)$")
+
+
+def catalog(library: Library, versions: int = 3, unknown_every: int = 10, images: int = 10) -> list[CivitaiModel]:
+    """Models with a version for each file of the library, but every unknown_every-th one CivitAI doesn't know."""
+    known = [file for index, file in enumerate(library.files) if not unknown_every or index % unknown_every]
+    models = make_models(-(-len(known) // versions), versions=versions, images=images)
+    model_versions = [model_version for model in models for model_version in model.modelVersions]
+    for model in models:
+        model.id += 1  # model id 0 reads as missing
+        for model_version in model.modelVersions:
+            model_version.id += 1
+            model_version.modelId = model.id
+    for model_version, file in zip(model_versions, known, strict=False):
+        model_version.files[0].hashes.SHA256 = file.sha256.upper()
+    return models
+
+
+class MockCivitai:
+    def __init__(
+        self,
+        models: list[CivitaiModel],
+        latency: float = 0.0,
+        throttle: float = 0.0,
+        retry_after: float = 0.1,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.random = random.Random(seed)  # noqa: S311
+        self.requests: Counter[str] = Counter()
+        self.throttled = 0
+        # serialized once, so the mock costs next to nothing next to the client
+        self.models = {model.id: model.model_dump_json(exclude_none=True).encode() for model in models}
+        self.versions_by_hash: dict[str, bytes] = {}
+        for model in models:
+            for model_version in model.modelVersions:
+                data = model_version.model_dump(mode="json", exclude_none=True)
+                data["model"] = {"name": model.name, "type": model.type}
+                content = json.dumps(data).encode()
+                for file in model_version.files:
+                    for filehash in file.hashes.model_dump(exclude_none=True).values():
+                        self.versions_by_hash[filehash.upper()] = content
+
+    def transport(self) -> httpx.MockTransport:
+        return httpx.MockTransport(self.handle)
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.throttle and self.random.random() < self.throttle:
+            self.throttled += 1
+            return httpx.Response(429, headers={"Retry-After": str(self.retry_after)})
+
+        path = request.url.path
+        if request.method == "POST" and path.endswith("/model-versions/by-hash"):
+            self.requests["POST by-hash"] += 1
+            found = {
+                content
+                for filehash in json.loads(request.content)
+                if (content := self.versions_by_hash.get(filehash.upper()))
+            }
+            return self._json(b"[" + b",".join(sorted(found)) + b"]")
+        if match := BY_HASH_PATH.search(path):
+            self.requests["GET by-hash"] += 1
+            return self._json(self.versions_by_hash.get(match[1].upper()))
+        if match := MODEL_PATH.search(path):
+            self.requests["GET model"] += 1
+            return self._json(self.models.get(int(match[1])))
+        self.requests["other"] += 1
+        return self._json(None)
+
+    @staticmethod
+    def _json(content: bytes | None) -> httpx.Response:
+        if content is None:
+            return httpx.Response(404, json={"error": "Not found"})
+        return httpx.Response(200, content=content, headers={"Content-Type": "application/json"})
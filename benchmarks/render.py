@@ -0,0 +1,97 @@
+"""Rendering of model pages: a new Jinja environment per page against the shared one, serial and in processes.
+
+python -m benchmarks.render --models 2000 --workers 4
+"""
+
+import argparse
+import time
+
+from jinja2 import Environment, FileSystemLoader
+
+from src.mdgenerator import TEMPLATES_DIR, render_model_pages
+from src.models import CivitaiModel
+
+
+def make_models(count: int, versions: int = 3, images: int = 10) -> list[CivitaiModel]:
+    models = []
+    for model_id in range(count):
+        model_versions = [
+            {
+                "id": model_id * versions + i,
+                "modelId": model_id,
+                "index": i,
+                "name": f"v{i}",
+                "trainedWords": [f"word{model_id}", "style"],
+                "baseModel": "SDXL 1.0",
+                "baseModelType": "Standard",
+                "downloadUrl": f"https://civitai.com/api/download/models/{model_id * versions + i}",
+                "files": [
+                    {
+                        "id": model_id * versions + i,
+                        "sizeKB": 223_000.5,
+                        "name": f"model{model_id}_v{i}.safetensors",
+                        "type": "Model",
+                        "downloadUrl": f"https://civitai.com/api/download/models/{model_id * versions + i}",
+                        "metadata": {"format": "SafeTensor", "size": "pruned", "fp": "fp16"},
+                        "hashes": {"SHA256": f"{model_id:064x}"},
+                    },
+                ],
+                "images": [
+                    {
+                        "url": f"https://image.civitai.com/{model_id}/{i}/{j}.jpeg",
+                        "nsfwLevel": j % 8,
+                        "width": 832,
+                        "height": 1216,
+                        "hash": "U5F~5@~q00004n%M",
+                        "type": "image",
+                        "hasMeta": True,
+                        "onSite": False,
+                        "meta": {
+                            "sampler": "DPM++ 2M",
+                            "Schedule type": "Karras",
+                            "cfgScale": 4 + j % 4,
+                            "steps": 20 + j,
+                            "Size": "832x1216",
+                        },
+                    }
+                    for j in range(images)
+                ],
+            }
+            for i in range(versions)
+        ]
+        model = CivitaiModel.model_validate(
+            {"id": model_id, "name": f"Model {model_id}", "type": "LORA", "modelVersions": model_versions},
+        )
+        for model_version in model.modelVersions[:2]:
+            model_version._exists = True
+        models.append(model)
+    return models
+
+
+def render_fresh_environment(models: list[CivitaiModel]) -> None:
+    # what every page used to cost: a new environment and a template compiled from source
+    for model in models:
+        Environment(loader=FileSystemLoader(TEMPLATES_DIR)).get_template("model.md.j2").render(model=model)  # noqa: S701
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--models", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    models = make_models(args.models)
+    modes = (
+        ("environment per page", lambda: render_fresh_environment(models)),
+        ("shared environment", lambda: list(render_model_pages(models))),
+        (f"shared, {args.workers} processes", lambda: list(render_model_pages(models, workers=args.workers))),
+    )
+    for name, render in modes:
+        started = time.perf_counter()
+        render()
+        elapsed = time.perf_counter() - started
+        print(f"{name:<28} {args.models:>8} pages {elapsed:>9.2f}s {args.models / elapsed:>10.0f} pages/s")
+
+
+if __name__ == "__main__":
+    main()
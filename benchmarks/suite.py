@@ -0,0 +1,302 @@
+"""The benchmarks of a whole run over a synthetic library and a mock API, with results comparable between runs.
+
+    python -m benchmarks.suite --files 200 --size-mb 2 --output after.json --compare before.json
+    python -m benchmarks.suite --only hash sync --latency 0.2 --throttle 0.1
+
+scan: a full scan into an empty database, then an incremental one over it. hash: gen_filehash of every file,
+one algorithm at a time, and all of them in one read. integrity: get_corrupted_files at each level into an
+empty database, then the header level again over the stored results. sync: MetadataManipulator against
+the mock API into an empty database, hashing, lookups and model fetches included, then again over it.
+render: model pages, serially and in --workers processes.
+
+Every benchmark runs --repeat times and the fastest run counts. Files are read from the page cache after
+the first run, so hashing numbers are CPU bound; pass --library to keep the files between runs.
+"""
+
+import argparse
+import contextlib
+import functools
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from collections.abc import Callable, Iterator
+
+import loguru
+
+from pydantic import BaseModel
+
+from benchmarks.library import LORAS_FOLDER, MODELS_FOLDER, Library, make_library
+from benchmarks.mockapi import MockCivitai, catalog
+from benchmarks.render import make_models
+
+from src.civitai import AsyncCivitai
+from src.db import DBApi
+from src.mdgenerator import render_model_pages
+from src.metadata import MetadataManipulator
+from src.metrics import metrics
+from src.models import CivitaiModel
+from src.ratelimit import RateLimiter, RetryPolicy
+from src.scanner import FileScanner
+from src.tensorreader import INTEGRITY_LEVELS, get_corrupted_files
+from src.utils import HASH_ALGORITHMS, gen_filehash, gen_filehashes
+
+BENCHMARKS = ("scan", "hash", "integrity", "sync", "render")
+
+
+class Result(BaseModel):
+    seconds: float  # the fastest run
+    runs: list[float]
+    items: int
+    bytes: int | None = None
+    details: dict[str, float] = {}
+
+    @property
+    def per_second(self) -> float:
+        return self.items / self.seconds if self.seconds else 0.0
+
+
+def timed(function: Callable[[], object]) -> float:
+    started = time.perf_counter()
+    function()
+    return time.perf_counter() - started
+
+
+def measure(repeat: int, function: Callable[[], object]) -> list[float]:
+    return [timed(function) for _ in range(repeat)]
+
+
+def hash_library(paths: list[str], algorithms: tuple[str, ...]) -> None:
+    if len(algorithms) == 1:
+        for path in paths:
+            gen_filehash(path, algorithms[0])
+    else:
+        for path in paths:
+            gen_filehashes(path, algorithms)
+
+
+def render_pages(models: list[CivitaiModel], workers: int) -> None:
+    # the pages are rendered as they're iterated
+    list(render_model_pages(models, workers=workers))
+
+
+@contextlib.contextmanager
+def empty_db() -> Iterator[DBApi]:
+    with tempfile.TemporaryDirectory() as tmp:
+        db_api = DBApi(os.path.join(tmp, "db.sqlite"))
+        try:
+            yield db_api
+        finally:
+            db_api.conn.close()
+
+
+def bench_scan(library: Library, args: argparse.Namespace) -> dict[str, Result]:
+    cold, warm = [], []
+    for _ in range(args.repeat):
+        with empty_db() as db_api:
+            cold.append(timed(functools.partial(FileScanner(db_api).scan, [library.root], full=True)))
+            warm.append(timed(functools.partial(FileScanner(db_api).scan, [library.root])))
+    return {
+        "scan full": Result(seconds=min(cold), runs=cold, items=len(library.files)),
+        "scan incremental": Result(seconds=min(warm), runs=warm, items=len(library.files)),
+    }
+
+
+def bench_hash(library: Library, args: argparse.Namespace) -> dict[str, Result]:
+    results = {}
+    for name, algorithms in [*((algorithm, (algorithm,)) for algorithm in HASH_ALGORITHMS), ("all", HASH_ALGORITHMS)]:
+        runs = measure(args.repeat, functools.partial(hash_library, library.paths(), algorithms))
+        results[f"hash {name}"] = Result(
+            seconds=min(runs),
+            runs=runs,
+            items=len(library.files),
+            bytes=library.total_bytes(),
+        )
+    return results
+
+
+def bench_integrity(library: Library, args: argparse.Namespace) -> dict[str, Result]:
+    paths = library.paths()
+    expected = sorted(path for path, file in zip(paths, library.files, strict=True) if file.corrupted)
+    results = {}
+    runs: dict[str, list[float]] = {level: [] for level in (*INTEGRITY_LEVELS, "header cached")}
+    for _ in range(args.repeat):
+        for level in INTEGRITY_LEVELS:
+            with empty_db() as db_api:
+                check = functools.partial(get_corrupted_files, library.root, paths, db_api, level, args.workers)
+                started = time.perf_counter()
+                found = check()
+                runs[level].append(time.perf_counter() - started)
+                if found != expected:
+                    raise SystemExit(f"integrity {level}: found {len(found)} corrupted files of {len(expected)}")
+                if level == "header":
+                    runs["header cached"].append(timed(check))
+    for level, level_runs in runs.items():
+        results[f"integrity {level}"] = Result(
+            seconds=min(level_runs),
+            runs=level_runs,
+            items=len(paths),
+            bytes=library.total_bytes() if level == "full" else None,
+        )
+    return results
+
+
+def bench_sync(library: Library, args: argparse.Namespace) -> dict[str, Result]:
+    models = catalog(library, versions=args.versions)
+    expected = sum(1 for index in range(len(library.files)) if index % 10)
+    results: dict[str, list[float]] = {"sync": [], "sync again": []}
+    details: dict[str, dict[str, float]] = {}
+    for _ in range(args.repeat):
+        with empty_db() as db_api, tempfile.TemporaryDirectory() as work_dir:
+            scan = FileScanner(db_api).scan([library.root], full=True)
+            for name in results:
+                mock = MockCivitai(models, latency=args.latency, throttle=args.throttle, seed=args.seed)
+                rate_limiter = RateLimiter(
+                    rate=args.rate,
+                    max_per_host=args.concurrency,
+                    retry_policy=RetryPolicy(max_retries=10),
+                )
+                api = AsyncCivitai(
+                    "https://civitai.invalid/api/v1",
+                    "benchmark",
+                    rate_limiter=rate_limiter,
+                    transport=mock.transport(),
+                )
+                stages = dict(metrics.stages)
+                sync = functools.partial(
+                    MetadataManipulator,
+                    csv_file_path="",
+                    base_path=library.root,
+                    models_path=MODELS_FOLDER,
+                    loras_path=LORAS_FOLDER,
+                    work_dir=work_dir,
+                    civitai_api=api,
+                    db_api=db_api,
+                    hash_algorithms=list(HASH_ALGORITHMS),
+                    hash_workers=args.workers,
+                    scan=scan,
+                )
+                results[name].append(timed(sync))
+                bound = sum(1 for record in db_api.get_filehashes().values() if record.modelversionid)
+                if bound != expected:
+                    raise SystemExit(f"{name}: {bound} files bound to a model version of {expected}")
+                # where the time went, from the stages the run itself reports
+                details[name] = {
+                    **{
+                        f"{stage} seconds": round(seconds - stages.get(stage, 0.0), 3)
+                        for stage, seconds in metrics.stages.items()
+                        if seconds != stages.get(stage)
+                    },
+                    **{f"{kind} requests": count for kind, count in mock.requests.items()},
+                    "throttled": mock.throttled,
+                }
+    return {
+        name: Result(seconds=min(runs), runs=runs, items=len(library.files), details=details[name])
+        for name, runs in results.items()
+    }
+
+
+def bench_render(library: Library, args: argparse.Namespace) -> dict[str, Result]:
+    models = make_models(args.models)
+    results = {}
+    for workers in dict.fromkeys((1, args.workers)):
+        runs = measure(args.repeat, functools.partial(render_pages, models, workers))
+        results[f"render {workers} workers"] = Result(seconds=min(runs), runs=runs, items=len(models))
+    return results
+
+
+def environment() -> dict[str, object]:
+    return {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def compare(results: dict[str, Result], baseline_path: str) -> None:
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    print(f"\n{'':<28} {'before':>10} {'after':>10} {'change':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]["seconds"]
+        change = (result.seconds - before) / before * 100 if before else 0.0
+        print(f"{name:<28} {before:>9.3f}s {result.seconds:>9.3f}s {change:>+7.1f}%")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument("--library", help="where to keep the synthetic library, a temporary folder by default")
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--size-mb", type=float, default=2.0)
+    parser.add_argument("--corrupt", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--versions", type=int, default=3, help="versions of each model in the mock API")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds the mock API takes to answer")
+    parser.add_argument("--throttle", type=float, default=0.05, help="share of 429 responses of the mock API")
+    parser.add_argument("--rate", type=float, default=50.0, help="requests per second to the mock API")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--models", type=int, default=1000, help="model pages to render")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    # a log line per hashed file would be most of what's measured
+    loguru.logger.remove()
+    loguru.logger.add(sys.stderr, level="ERROR")
+
+    with contextlib.ExitStack() as stack:
+        root = args.library or stack.enter_context(tempfile.TemporaryDirectory())
+        started = time.perf_counter()
+        library = make_library(root, args.files, int(args.size_mb * (1 << 20)), args.corrupt, args.seed)
+        elapsed = time.perf_counter() - started
+        print(f"{len(library.files)} files, {library.total_bytes() / (1 << 20):.1f} MiB in {elapsed:.1f}s")
+
+        benchmarks = {
+            "scan": bench_scan,
+            "hash": bench_hash,
+            "integrity": bench_integrity,
+            "sync": bench_sync,
+            "render": bench_render,
+        }
+        results: dict[str, Result] = {}
+        for name in args.only:
+            for result_name, result in benchmarks[name](library, args).items():
+                results[result_name] = result
+                throughput = f" {result.bytes / result.seconds / (1 << 20):>10.1f} MiB/s" if result.bytes else ""
+                print(
+                    f"{result_name:<28} {result.items:>8} {result.seconds:>9.3f}s {result.per_second:>10.0f} /s",
+                    end="",
+                )
+                print(throughput)
+                for detail, value in result.details.items():
+                    print(f"{'':<30}{detail}: {value:g}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "environment": environment(),
+                    "parameters": vars(args),
+                    "results": {
+                        name: {**result.model_dump(), "per_second": result.per_second}
+                        for name, result in results.items()
+                    },
+                },
+                f,
+                indent=2,
+            )
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,53 +4,70 @@
 # allowCommercialUse: enum (None, Image, Rent, Sell)
 
 
-import os
-import re
-import shutil
-import tempfile
+import threading
+
+from collections.abc import Iterable
 
 import httpx
-import loguru
 
 from tqdm import tqdm
 
-from src.models import CivitaiModel, CivitaiModelVersion
+from src.downloader import DownloadResult, SegmentedDownloader
+from src.httpcache import AsyncCachingTransport, ResponseCache
+from src.models import CivitaiHashes, CivitaiModel, CivitaiModelVersion
+from src.ratelimit import AsyncRateLimitedTransport, RateLimitedTransport, RateLimiter, TokenBucket
 
 
-def parse_content_disposition(header):
-    # Define a regular expression pattern to match the filename parameter
-    pattern = r'filename=["\']?([^"\';]+)["\']?'
-    match = re.search(pattern, header)
-    if match:
-        filename = match[1]
-        # Remove quotes around the filename if present
-        if filename.startswith('"') and filename.endswith('"') or filename.startswith("'") and filename.endswith("'"):
-            filename = filename[1:-1]
-        return filename
-    return None
+def index_by_hash(model_versions: Iterable[CivitaiModelVersion]) -> dict[str, CivitaiModelVersion]:
+    """Every hash of every file of the versions, upper case, to its version."""
+    return {
+        filehash.upper(): model_version
+        for model_version in model_versions
+        for file in model_version.files
+        for filehash in file.hashes.model_dump(exclude_none=True).values()
+    }
 
 
 class Civitai:
-    def __init__(self, base_url: str, api_key: str):
+    def __init__(self, base_url: str, api_key: str, rate_limiter: RateLimiter | None = None):
         self.base_url = base_url
         self.api_key = api_key
         self.headers = {"Authorization": f"Bearer {self.api_key}"}
+        self.rate_limiter = rate_limiter or RateLimiter()
+        # one pooled client, so consecutive requests reuse the connection instead of a new TLS handshake each
+        self.client = httpx.Client(
+            headers=self.headers,
+            timeout=None,  # noqa: S113
+            transport=RateLimitedTransport(self.rate_limiter),
+        )
 
     def get_model(self, model_id: int):
         url = f"{self.base_url}/models/{model_id}"
-        x = httpx.get(url, headers=self.headers, timeout=None)
+        x = self.client.get(url)
+        x.raise_for_status()
         return CivitaiModel(**x.json())
 
-    # def get_by_modelVersion(self, modelVersionId: str):
-    #     url = f"{self.base_url}/model-versions/{modelVersionId}"
-    #     x = httpx.get(url, headers=self.headers)
-    #     # return ModelVersion(x.json())
-    #     return x.json()
+    def get_model_version(self, model_version_id: int) -> CivitaiModelVersion | None:
+        url = f"{self.base_url}/model-versions/{model_version_id}"
+        x = self.client.get(url)
+        if x.status_code == 404:
+            return None
+        x.raise_for_status()
+        return CivitaiModelVersion(**x.json())
 
     def get_modelversion_by_hash(self, filehash: str) -> CivitaiModelVersion | None:
         url = f"{self.base_url}/model-versions/by-hash/{filehash}"
-        x = httpx.get(url, headers=self.headers)
-        return None if x.status_code == 404 else CivitaiModelVersion(**x.json())
+        x = self.client.get(url, timeout=httpx.Timeout(5.0))
+        if x.status_code == 404:
+            return None
+        x.raise_for_status()
+        return CivitaiModelVersion(**x.json())
+
+    def get_modelversions_by_hashes(self, filehashes: list[str]) -> list[CivitaiModelVersion]:
+        """Versions with a file matching any of the hashes in one request, see index_by_hash to map them back."""
+        x = self.client.post(f"{self.base_url}/model-versions/by-hash", json=filehashes)
+        x.raise_for_status()
+        return [CivitaiModelVersion(**item) for item in x.json()]
 
     # def search(
     #     self,
@@ -95,59 +112,110 @@ class Civitai:
     #     x = httpx.get(url, headers=self.headers, params=params, timeout=None)
     #     return CivitaiModelResponse(**x.json())
 
-    def download(self, downloadUrl: str, outdir: str) -> str:
-        # Create a temporary file
-        with tempfile.NamedTemporaryFile(delete=False) as download_file:
-            temp_file_path = download_file.name
-
-        # Check the current size of the temporary file
-        current_size = os.path.getsize(temp_file_path)
-
-        real_filename = None
-
-        while True:
-            try:
-                # Open the temporary file in append mode
-                with open(temp_file_path, "ab") as f:
-                    loguru.logger.info(
-                        f"Downloading {downloadUrl} to {temp_file_path} starting from {current_size} bytes",
-                    )
-                    headers = self.headers.copy()
-                    if current_size:
-                        headers["Range"] = "bytes={current_size}-"
-
-                    with httpx.stream(
-                        "GET",
-                        downloadUrl,
-                        headers=headers,
-                        timeout=None,
-                        follow_redirects=True,
-                    ) as response:
-                        if response.headers.get("Content-Disposition"):
-                            # при продолжении докачки после обрыва скачивания имя пустое
-                            real_filename = parse_content_disposition(response.headers["Content-Disposition"])
-
-                        total = int(response.headers["Content-Length"]) + current_size
-
-                        with tqdm(
-                            total=total,
-                            initial=current_size,
-                            unit_scale=True,
-                            unit_divisor=1024,
-                            unit="B",
-                        ) as progress:
-                            num_bytes_downloaded = response.num_bytes_downloaded + current_size
-                            for chunk in response.iter_bytes():
-                                f.write(chunk)
-                                progress.update(len(chunk))
-                                num_bytes_downloaded += len(chunk)
-                                current_size += len(chunk)
-                    os.makedirs(f"{outdir}/.civitai-fetcher/", exist_ok=True)
-                    shutil.move(temp_file_path, f"{outdir}/.civitai-fetcher/{real_filename}")
-                    break
-            except (httpx.RequestError, httpx.RemoteProtocolError) as e:
-                loguru.logger.exception(f"Request error: {e}")
-                # Handle the error and retry the download
-                continue
-
-        return f"{outdir}/.civitai-fetcher/{real_filename}"
+    def download(
+        self,
+        downloadUrl: str,
+        outdir: str,
+        expected_hashes: CivitaiHashes | None = None,
+        segments: int = 4,
+        bandwidth: TokenBucket | None = None,
+        progress: tqdm | None = None,
+        hash_algorithms: list[str] | None = None,
+        progress_lock: "threading.Lock | None" = None,
+        expected_size: int | None = None,
+    ) -> DownloadResult:
+        downloader = SegmentedDownloader(
+            self.client,
+            segments=segments,
+            retry_policy=self.rate_limiter.retry_policy,
+            bandwidth=bandwidth,
+            progress_lock=progress_lock,
+        )
+        if progress is not None:
+            return downloader.download(downloadUrl, outdir, expected_hashes, progress, hash_algorithms, expected_size)
+        with tqdm(unit_scale=True, unit_divisor=1024, unit="B") as progress:
+            return downloader.download(downloadUrl, outdir, expected_hashes, progress, hash_algorithms)
+
+
+class AsyncCivitai:
+    """Concurrent counterpart of Civitai for metadata lookups.
+
+    The pooled client lives between `async with` enter and exit, so the same instance can be used
+    from several asyncio.run() calls. Pass an httpx.MockTransport as transport to test without network;
+    pacing, retries and the per-host concurrency cap of rate_limiter are applied on top of it, and
+    responses are served from cache first when one is given.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        api_key: str,
+        max_connections: int = 16,
+        rate_limiter: RateLimiter | None = None,
+        cache: ResponseCache | None = None,
+        transport: httpx.AsyncBaseTransport | None = None,
+    ):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.headers = {"Authorization": f"Bearer {self.api_key}"}
+        self.max_connections = max_connections
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.cache = cache
+        self.transport = transport
+        self.client: httpx.AsyncClient | None = None
+
+    async def __aenter__(self) -> "AsyncCivitai":
+        limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+        transport: httpx.AsyncBaseTransport = AsyncRateLimitedTransport(
+            self.rate_limiter,
+            self.transport or httpx.AsyncHTTPTransport(limits=limits),
+        )
+        # cache hits never touch the rate limiter
+        if self.cache is not None:
+            transport = AsyncCachingTransport(self.cache, transport)
+        self.client = httpx.AsyncClient(
+            headers=self.headers,
+            timeout=httpx.Timeout(60.0, connect=10.0),
+            transport=transport,
+        )
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        if self.client is not None:
+            await self.client.aclose()
+        self.client = None
+
+    async def _get(self, url: str) -> httpx.Response:
+        if self.client is None:
+            raise RuntimeError("AsyncCivitai must be used as an async context manager")
+        return await self.client.get(url)
+
+    async def _post(self, url: str, json: object) -> httpx.Response:
+        if self.client is None:
+            raise RuntimeError("AsyncCivitai must be used as an async context manager")
+        return await self.client.post(url, json=json)
+
+    async def get_model(self, model_id: int) -> CivitaiModel | None:
+        x = await self._get(f"{self.base_url}/models/{model_id}")
+        if x.status_code == 404:
+            return None
+        x.raise_for_status()
+        return CivitaiModel(**x.json())
+
+    async def get_modelversion_by_hash(self, filehash: str) -> CivitaiModelVersion | None:
+        x = await self._get(f"{self.base_url}/model-versions/by-hash/{filehash}")
+        if x.status_code == 404:
+            return None
+        x.raise_for_status()
+        return CivitaiModelVersion(**x.json())
+
+    async def get_modelversions_by_hashes(self, filehashes: list[str]) -> list[CivitaiModelVersion]:
+        url = f"{self.base_url}/model-versions/by-hash"
+        # POSTs aren't cached, but the single lookups CivitAI recently answered with 404 are
+        if self.cache is not None:
+            filehashes = [filehash for filehash in filehashes if not self.cache.is_not_found(f"{url}/{filehash}")]
+            if not filehashes:
+                return []
+        x = await self._post(url, json=filehashes)
+        x.raise_for_status()
+        return [CivitaiModelVersion(**item) for item in x.json()]
@@ -1,6 +1,30 @@
+import json
+import re
 import sqlite3
+import time
 
-from src.models import DBAPIFileHash
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+
+from blake3 import blake3
+
+from src.models import (
+    CivitaiModel,
+    CivitaiModelVersion,
+    DBAPIDownload,
+    DBAPIFileHash,
+    DBAPIHttpCacheEntry,
+    DBAPIIntegrityCheck,
+    DBAPIModelPage,
+    DBAPISafetensorsHeader,
+    DBAPIScanDir,
+    DBAPISearchHit,
+    DBAPISiteBuild,
+    DBAPIVersionLink,
+    FileFingerprint,
+    GenerationStats,
+    compute_generation_stats,
+)
 
 TABLES_DDL = (
     """
@@ -8,100 +32,1198 @@ TABLES_DDL = (
         filepath TEXT PRIMARY KEY,
         filehash TEXT,
         modelid INTEGER,
-        modelversionid INTEGER
-    );
-    """,
-    # """
-    # # CREATE TABLE IF NOT EXISTS models (
-    # #     id INTEGER PRIMARY KEY,
-    # #     name TEXT,
-    # #     description TEXT,
-    # #     type TEXT,
-    # #     nsfw INTEGER,
-    # #     stats TEXT,
-    # #     creator TEXT,
-    # #     tags TEXT,
-    # #     model_versions TEXT
-    # # );
-    # # """,
-    # """
-    # CREATE TABLE IF NOT EXISTS model_versions (
-    #     id INTEGER PRIMARY KEY,
-    #     name TEXT,
-    #     description TEXT,
-    #     type TEXT,
-    #     nsfw INTEGER,
-    #     stats TEXT,
-    #     creator TEXT,
-    #     tags TEXT,
-    #     model_versions TEXT
-    # );
-    # """,
-    # """
-    # CREATE TABLE IF NOT EXISTS model_versions_files (
-    #     id INTEGER PRIMARY KEY,
-    #     name TEXT,
-    #     size_kb INTEGER,
-    #     format TEXT,
-    #     fp TEXT,
-    #     size INTEGER,
-    #     download_url TEXT
-    # );
-    # """,
-    # """
-    # CREATE TABLE IF NOT EXISTS model_versions_file_hashes (
-    #     id INTEGER PRIMARY KEY,
-    #     hash TEXT
-    # );
-    # """,
-    # """
-    # CREATE TABLE IF NOT EXISTS model_versions_file_metadata (
-    #     id INTEGER PRIMARY KEY,
-    #     format TEXT,
-    #     fp TEXT,
-    #     size INTEGER
-    # );
-    # """,
+        modelversionid INTEGER,
+        size INTEGER,
+        mtime_ns INTEGER,
+        inode INTEGER
+    );
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS file_hashes_modelversionid ON file_hashes (modelversionid);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS file_digests (
+        filepath TEXT NOT NULL,
+        algorithm TEXT NOT NULL,
+        digest TEXT NOT NULL,
+        PRIMARY KEY (filepath, algorithm)
+    );
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS file_digests_digest ON file_digests (digest);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS http_cache (
+        url TEXT PRIMARY KEY,
+        status INTEGER NOT NULL,
+        etag TEXT,
+        last_modified TEXT,
+        body BLOB NOT NULL,
+        fetched_at REAL NOT NULL
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS download_queue (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        modelid INTEGER,
+        modelversionid INTEGER,
+        fileid INTEGER,
+        url TEXT NOT NULL UNIQUE,
+        outdir TEXT NOT NULL,
+        hashes TEXT,
+        size INTEGER,
+        priority INTEGER NOT NULL DEFAULT 0,
+        status TEXT NOT NULL DEFAULT 'pending',
+        error TEXT,
+        filepath TEXT,
+        updated_at REAL
+    );
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS download_queue_status ON download_queue (status, priority DESC, id);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS models (
+        id INTEGER PRIMARY KEY,
+        name TEXT,
+        type TEXT,
+        description TEXT,
+        tags TEXT,
+        fetched_at REAL,
+        digest TEXT,
+        updated_at REAL
+    );
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS models_type ON models (type);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS model_versions (
+        id INTEGER PRIMARY KEY,
+        model_id INTEGER NOT NULL REFERENCES models (id) ON DELETE CASCADE,
+        position INTEGER,
+        name TEXT NOT NULL,
+        description TEXT,
+        trained_words TEXT,
+        base_model TEXT NOT NULL,
+        base_model_type TEXT,
+        air TEXT,
+        download_url TEXT NOT NULL,
+        generation_stats TEXT
+    );
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS model_versions_model_id ON model_versions (model_id, position);
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS model_versions_base_model ON model_versions (base_model, base_model_type);
+    """,
+    # related versions of the same model: without it the planner joins them through model_versions_base_model,
+    # every version of the base model for every local one
+    """
+    CREATE INDEX IF NOT EXISTS model_versions_model_base
+    ON model_versions (model_id, base_model, base_model_type);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS model_version_files (
+        id INTEGER PRIMARY KEY,
+        model_version_id INTEGER NOT NULL REFERENCES model_versions (id) ON DELETE CASCADE,
+        name TEXT NOT NULL,
+        type TEXT NOT NULL,
+        size_kb REAL NOT NULL,
+        download_url TEXT NOT NULL,
+        format TEXT,
+        size TEXT,
+        fp TEXT
+    );
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS model_version_files_model_version_id ON model_version_files (model_version_id);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS model_version_file_hashes (
+        file_id INTEGER NOT NULL REFERENCES model_version_files (id) ON DELETE CASCADE,
+        algorithm TEXT NOT NULL,
+        hash TEXT NOT NULL,
+        PRIMARY KEY (file_id, algorithm)
+    );
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS model_version_file_hashes_hash ON model_version_file_hashes (hash);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS model_version_images (
+        model_version_id INTEGER NOT NULL REFERENCES model_versions (id) ON DELETE CASCADE,
+        position INTEGER NOT NULL,
+        url TEXT NOT NULL,
+        nsfw_level INTEGER NOT NULL,
+        width INTEGER NOT NULL,
+        height INTEGER NOT NULL,
+        hash TEXT NOT NULL,
+        type TEXT NOT NULL,
+        has_meta INTEGER NOT NULL,
+        on_site INTEGER NOT NULL,
+        meta TEXT,
+        PRIMARY KEY (model_version_id, position)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS scan_dirs (
+        path TEXT PRIMARY KEY,
+        mtime_ns INTEGER,
+        subdirs TEXT NOT NULL
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS scan_files (
+        path TEXT PRIMARY KEY,
+        dir TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        inode INTEGER NOT NULL
+    );
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS scan_files_dir ON scan_files (dir);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS integrity_checks (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        inode INTEGER NOT NULL,
+        error TEXT,
+        sample_checksum TEXT,
+        full_checksum TEXT,
+        checked_at REAL NOT NULL
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS safetensors_headers (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        inode INTEGER NOT NULL,
+        tensor_count INTEGER NOT NULL,
+        parameter_count INTEGER NOT NULL,
+        dtypes TEXT NOT NULL,
+        metadata TEXT NOT NULL,
+        architecture TEXT,
+        rank INTEGER
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS site_pages (
+        path TEXT PRIMARY KEY,
+        hash TEXT NOT NULL,
+        source TEXT
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS site_builds (
+        work_dir TEXT PRIMARY KEY,
+        site_dir TEXT NOT NULL,
+        state TEXT NOT NULL,
+        built_at REAL NOT NULL
+    );
+    """,
+)
+
+# columns added after the first release, applied to databases created by older versions
+TABLES_MIGRATIONS = {
+    "file_hashes": {
+        "size": "INTEGER",
+        "mtime_ns": "INTEGER",
+        "inode": "INTEGER",
+    },
+    "site_pages": {
+        "source": "TEXT",
+    },
+    "model_versions": {
+        "generation_stats": "TEXT",
+    },
+    "models": {
+        "tags": "TEXT",
+        "digest": "TEXT",
+        "updated_at": "REAL",
+    },
+}
+
+# column weights of bm25, in the order of the model_search columns: a trigger word or a name counts the most
+SEARCH_WEIGHTS = (0.0, 10.0, 5.0, 10.0, 3.0, 2.0, 1.0)
+
+
+def fts_query(text: str) -> str:
+    """Words of text as prefixes that all have to match, anything else is dropped so no FTS5 syntax gets through."""
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", text))
+
+
+# a full-text document per model version, rowid is the version id
+SEARCH_DOCUMENTS = """
+    INSERT INTO model_search
+        (rowid, model_id, model_name, version_name, trained_words, tags, base_model, description)
+    SELECT
+        model_versions.id,
+        models.id,
+        models.name,
+        model_versions.name,
+        model_versions.trained_words,
+        models.tags,
+        model_versions.base_model || ' ' || coalesce(model_versions.base_model_type, ''),
+        coalesce(models.description, '') || ' ' || coalesce(model_versions.description, '')
+    FROM model_versions
+    JOIN models ON models.id = model_versions.model_id
+"""
+
+# created after the migrations, the triggers keep the index up to date with every write to the tables
+SEARCH_DDL = (
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS model_search USING fts5 (
+        model_id UNINDEXED,
+        model_name,
+        version_name,
+        trained_words,
+        tags,
+        base_model,
+        description,
+        tokenize = 'unicode61 remove_diacritics 2'
+    );
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS model_versions_search_insert AFTER INSERT ON model_versions BEGIN
+        {SEARCH_DOCUMENTS} WHERE model_versions.id = new.id;
+    END;
+    """,  # noqa: S608
+    f"""
+    CREATE TRIGGER IF NOT EXISTS model_versions_search_update AFTER UPDATE ON model_versions
+    WHEN old.model_id IS NOT new.model_id OR old.name IS NOT new.name OR old.trained_words IS NOT new.trained_words
+        OR old.base_model IS NOT new.base_model OR old.base_model_type IS NOT new.base_model_type
+        OR old.description IS NOT new.description
+    BEGIN
+        DELETE FROM model_search WHERE rowid = old.id;
+        {SEARCH_DOCUMENTS} WHERE model_versions.id = new.id;
+    END;
+    """,  # noqa: S608
+    """
+    CREATE TRIGGER IF NOT EXISTS model_versions_search_delete AFTER DELETE ON model_versions BEGIN
+        DELETE FROM model_search WHERE rowid = old.id;
+    END;
+    """,
+    # model_id isn't indexed by fts5, the versions of the model are found through model_versions
+    f"""
+    CREATE TRIGGER IF NOT EXISTS models_search_update AFTER UPDATE ON models
+    WHEN old.name IS NOT new.name OR old.description IS NOT new.description OR old.tags IS NOT new.tags
+    BEGIN
+        DELETE FROM model_search WHERE rowid IN (SELECT id FROM model_versions WHERE model_id = new.id);
+        {SEARCH_DOCUMENTS} WHERE models.id = new.id;
+    END;
+    """,  # noqa: S608
+)
+
+
+# WAL lets readers work next to the writer and with synchronous=NORMAL commits don't wait for fsync,
+# the database is still consistent after a crash but may lose the last transactions
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -65536",
+    "PRAGMA mmap_size = 268435456",
 )
 
+UPSERT_FILEHASH = """
+    INSERT INTO file_hashes (filepath, filehash, size, mtime_ns, inode)
+    VALUES (:filepath, :filehash, :size, :mtime_ns, :inode)
+    ON CONFLICT (filepath) DO UPDATE SET
+        modelid = CASE WHEN filehash = excluded.filehash THEN modelid END,
+        modelversionid = CASE WHEN filehash = excluded.filehash THEN modelversionid END,
+        filehash = excluded.filehash,
+        size = excluded.size,
+        mtime_ns = excluded.mtime_ns,
+        inode = excluded.inode
+"""
+
 
 def dict_factory(cursor, row):
     return {col[0]: row[idx] for idx, col in enumerate(cursor.description)}
 
 
+class BatchWriter:
+    """Queues file_hashes writes and runs them with executemany, one transaction per flush.
+
+    A flush happens every flush_rows statements or flush_interval seconds, so an interrupted run loses
+    at most what was queued since the previous one. Leaving the `with` block flushes the rest.
+    """
+
+    def __init__(self, db_api: "DBApi", flush_interval: float = 5.0, flush_rows: int = 10_000):
+        self.db_api = db_api
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        # statements grouped by kind for executemany, ordered so that writes to one file keep their order
+        self.groups: list[tuple[str, list[dict | tuple]]] = []
+        self.group_by_sql: dict[str, int] = {}
+        self.group_by_path: dict[str, int] = {}
+        self.pending = 0
+        self.flushed_at = time.monotonic()
+
+    def __enter__(self) -> "BatchWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        # what was queued before an error is valid on its own and is kept
+        self.flush()
+
+    def _queue(self, filepath: str, *statements: tuple[str, dict | tuple]) -> None:
+        for sql, params in statements:
+            # a write joins the last group of its kind, unless a later group touches the same file
+            index = self.group_by_sql.get(sql, -1)
+            if index < self.group_by_path.get(filepath, 0):
+                index = len(self.groups)
+                self.groups.append((sql, []))
+                self.group_by_sql[sql] = index
+            self.groups[index][1].append(params)
+            self.group_by_path[filepath] = index
+        self.pending += len(statements)
+
+        # statements of one call are queued together, so a flush never splits them
+        if self.pending >= self.flush_rows or time.monotonic() - self.flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.groups:
+            with self.db_api.transaction():
+                for sql, params in self.groups:
+                    self.db_api.cursor.executemany(sql, params)
+            self.groups.clear()
+            self.group_by_sql.clear()
+            self.group_by_path.clear()
+            self.pending = 0
+        self.flushed_at = time.monotonic()
+
+    def update_data(self, filepath: str, model_id: int, model_version_id: int) -> None:
+        self._queue(
+            filepath,
+            (
+                "UPDATE file_hashes SET modelid = ?, modelversionid = ? WHERE filepath = ?",
+                (model_id, model_version_id, filepath),
+            ),
+        )
+
+    def update_filehash(
+        self,
+        filepath: str,
+        filehash: str,
+        fingerprint: FileFingerprint,
+        digests: dict[str, str] | None = None,
+    ) -> None:
+        # a changed hash means a different file, so the old model binding is dropped and looked up again
+        statements: list[tuple[str, dict | tuple]] = [
+            (UPSERT_FILEHASH, {"filepath": filepath, "filehash": filehash, **fingerprint.model_dump()}),
+        ]
+        if digests is not None:
+            statements.append(("DELETE FROM file_digests WHERE filepath = ?", (filepath,)))
+            statements.extend(
+                (
+                    "INSERT INTO file_digests (filepath, algorithm, digest) VALUES (?, ?, ?)",
+                    (filepath, algorithm, digest),
+                )
+                for algorithm, digest in digests.items()
+            )
+        self._queue(filepath, *statements)
+
+    def update_primary_filehash(self, filepath: str, filehash: str) -> None:
+        # same file hashed with another algorithm, so the model binding stays
+        self._queue(filepath, ("UPDATE file_hashes SET filehash = ? WHERE filepath = ?", (filehash, filepath)))
+
+    def update_fingerprint(self, filepath: str, fingerprint: FileFingerprint) -> None:
+        self._queue(
+            filepath,
+            (
+                "UPDATE file_hashes SET size = :size, mtime_ns = :mtime_ns, inode = :inode WHERE filepath = :filepath",
+                {"filepath": filepath, **fingerprint.model_dump()},
+            ),
+        )
+
+    def remove_filehash(self, filepath: str) -> None:
+        self._queue(
+            filepath,
+            ("DELETE FROM file_hashes WHERE filepath = ?", (filepath,)),
+            ("DELETE FROM file_digests WHERE filepath = ?", (filepath,)),
+        )
+
+    def put_scan_dir(
+        self,
+        path: str,
+        mtime_ns: int | None,
+        subdirs: list[str],
+        files: dict[str, FileFingerprint],
+    ) -> None:
+        self._queue(
+            path,
+            (
+                "INSERT OR REPLACE INTO scan_dirs (path, mtime_ns, subdirs) VALUES (?, ?, ?)",
+                (path, mtime_ns, json.dumps(subdirs)),
+            ),
+            ("DELETE FROM scan_files WHERE dir = ?", (path,)),
+            *(
+                (
+                    "INSERT INTO scan_files (path, dir, size, mtime_ns, inode) VALUES (?, ?, ?, ?, ?)",
+                    (filepath, path, fingerprint.size, fingerprint.mtime_ns, fingerprint.inode),
+                )
+                for filepath, fingerprint in files.items()
+            ),
+        )
+
+    def remove_scan_dir(self, path: str) -> None:
+        self._queue(
+            path,
+            ("DELETE FROM scan_dirs WHERE path = ?", (path,)),
+            ("DELETE FROM scan_files WHERE dir = ?", (path,)),
+        )
+
+    def put_safetensors_header(self, header: DBAPISafetensorsHeader) -> None:
+        self._queue(
+            header.path,
+            (
+                """
+                INSERT OR REPLACE INTO safetensors_headers
+                    (path, size, mtime_ns, inode, tensor_count, parameter_count, dtypes, metadata, architecture, rank)
+                VALUES
+                    (:path, :size, :mtime_ns, :inode, :tensor_count, :parameter_count, :dtypes, :metadata,
+                     :architecture, :rank)
+                """,
+                {**header.model_dump(), "dtypes": json.dumps(header.dtypes), "metadata": json.dumps(header.metadata)},
+            ),
+        )
+
+    def put_integrity_check(self, check: DBAPIIntegrityCheck) -> None:
+        self._queue(
+            check.path,
+            (
+                """
+                INSERT OR REPLACE INTO integrity_checks
+                    (path, size, mtime_ns, inode, error, sample_checksum, full_checksum, checked_at)
+                VALUES (:path, :size, :mtime_ns, :inode, :error, :sample_checksum, :full_checksum, :checked_at)
+                """,
+                check.model_dump(),
+            ),
+        )
+
+
 class DBApi:
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, journal_mode: str = "WAL", flush_interval: float = 5.0):
         self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.transaction_depth = 0
+        # pragmas like foreign_keys can't be changed inside a transaction, so the connection starts in autocommit mode
         self.conn = sqlite3.connect(
             self.db_path,
-            autocommit=False,
+            autocommit=True,
         )
+        # WAL needs shared memory, which network filesystems don't provide: use DELETE there
+        self.conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+        for pragma in CONNECTION_PRAGMAS:
+            self.conn.execute(pragma)
+        self.conn.autocommit = False
         self.conn.row_factory = dict_factory
         self.cursor = self.conn.cursor()
         self.__init_tables()
 
     def __init_tables(self):
+        tables = {row["name"] for row in self.cursor.execute("SELECT name FROM sqlite_master").fetchall()}
         for ddl in TABLES_DDL:
             self.cursor.execute(ddl)
+        for table, columns in TABLES_MIGRATIONS.items():
+            existing = {row["name"] for row in self.cursor.execute(f"PRAGMA table_info({table})").fetchall()}
+            for column, column_type in columns.items():
+                if column not in existing:
+                    self.cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+        for ddl in SEARCH_DDL:
+            self.cursor.execute(ddl)
+        if "model_search" not in tables:
+            # metadata stored before the search index existed
+            self.cursor.execute(SEARCH_DOCUMENTS)
         self.conn.commit()
 
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Commit everything written inside the block at once, nested blocks join the outer one."""
+        self.transaction_depth += 1
+        try:
+            yield
+        except BaseException:
+            if self.transaction_depth == 1:
+                self.conn.rollback()
+            raise
+        else:
+            if self.transaction_depth == 1:
+                self.conn.commit()
+        finally:
+            self.transaction_depth -= 1
+
+    def _commit(self) -> None:
+        if not self.transaction_depth:
+            self.conn.commit()
+
+    def batch(self, flush_interval: float | None = None, flush_rows: int = 10_000) -> BatchWriter:
+        return BatchWriter(self, self.flush_interval if flush_interval is None else flush_interval, flush_rows)
+
     def get_filehashes(self) -> dict[str, DBAPIFileHash]:
         data = self.cursor.execute("SELECT * FROM file_hashes").fetchall()
-        return {row["filepath"]: DBAPIFileHash(**row) for row in data}
+        digests: dict[str, dict[str, str]] = {}
+        for row in self.cursor.execute("SELECT * FROM file_digests").fetchall():
+            digests.setdefault(row["filepath"], {})[row["algorithm"]] = row["digest"]
+        return {row["filepath"]: DBAPIFileHash(**row, digests=digests.get(row["filepath"], {})) for row in data}
+
+    # single writes, each in its own transaction; loops should use batch() instead
 
     def update_data(self, filepath: str, model_id: int, model_version_id: int) -> None:
+        with self.batch() as batch:
+            batch.update_data(filepath, model_id, model_version_id)
+
+    def update_filehash(
+        self,
+        filepath: str,
+        filehash: str,
+        fingerprint: FileFingerprint,
+        digests: dict[str, str] | None = None,
+    ) -> None:
+        with self.batch() as batch:
+            batch.update_filehash(filepath, filehash, fingerprint, digests)
+
+    def update_primary_filehash(self, filepath: str, filehash: str) -> None:
+        with self.batch() as batch:
+            batch.update_primary_filehash(filepath, filehash)
+
+    def update_fingerprint(self, filepath: str, fingerprint: FileFingerprint) -> None:
+        with self.batch() as batch:
+            batch.update_fingerprint(filepath, fingerprint)
+
+    def remove_filehash(self, filepath: str) -> None:
+        with self.batch() as batch:
+            batch.remove_filehash(filepath)
+
+    def get_scan_index(self) -> tuple[dict[str, DBAPIScanDir], dict[str, dict[str, FileFingerprint]]]:
+        dirs = {
+            row["path"]: DBAPIScanDir(path=row["path"], mtime_ns=row["mtime_ns"], subdirs=json.loads(row["subdirs"]))
+            for row in self.cursor.execute("SELECT * FROM scan_dirs").fetchall()
+        }
+        files: dict[str, dict[str, FileFingerprint]] = {}
+        for row in self.cursor.execute("SELECT * FROM scan_files").fetchall():
+            files.setdefault(row["dir"], {})[row["path"]] = FileFingerprint(
+                size=row["size"],
+                mtime_ns=row["mtime_ns"],
+                inode=row["inode"],
+            )
+        return dirs, files
+
+    def get_integrity_checks(self) -> dict[str, DBAPIIntegrityCheck]:
+        rows = self.cursor.execute("SELECT * FROM integrity_checks").fetchall()
+        return {row["path"]: DBAPIIntegrityCheck(**row) for row in rows}
+
+    def get_safetensors_headers(self) -> dict[str, DBAPISafetensorsHeader]:
+        rows = self.cursor.execute("SELECT * FROM safetensors_headers").fetchall()
+        return {row["path"]: self._safetensors_header(row) for row in rows}
+
+    def get_unmatched_safetensors_headers(self) -> list[DBAPISafetensorsHeader]:
+        """Headers of the files no CivitAI model version was found for."""
+        rows = self.cursor.execute(
+            """
+            SELECT safetensors_headers.* FROM safetensors_headers
+            JOIN file_hashes ON file_hashes.filepath = safetensors_headers.path
+            WHERE file_hashes.modelversionid IS NULL
+            ORDER BY safetensors_headers.path
+            """,
+        ).fetchall()
+        return [self._safetensors_header(row) for row in rows]
+
+    @staticmethod
+    def _safetensors_header(row: dict) -> DBAPISafetensorsHeader:
+        return DBAPISafetensorsHeader(
+            **{**row, "dtypes": json.loads(row["dtypes"]), "metadata": json.loads(row["metadata"])},
+        )
+
+    def get_http_cache(self, url: str) -> DBAPIHttpCacheEntry | None:
+        row = self.cursor.execute("SELECT * FROM http_cache WHERE url = ?", (url,)).fetchone()
+        return DBAPIHttpCacheEntry(**row) if row else None
+
+    def put_http_cache(self, entry: DBAPIHttpCacheEntry) -> None:
         self.cursor.execute(
-            "UPDATE file_hashes SET modelid = ?, modelversionid = ? WHERE filepath = ?",
-            (model_id, model_version_id, filepath),
+            """
+            INSERT OR REPLACE INTO http_cache (url, status, etag, last_modified, body, fetched_at)
+            VALUES (:url, :status, :etag, :last_modified, :body, :fetched_at)
+            """,
+            entry.model_dump(),
         )
-        self.conn.commit()
+        self._commit()
 
-    def update_filehash(self, filepath: str, filehash: str) -> None:
-        # sqlite insert if not exists
-        self.cursor.execute("INSERT OR IGNORE INTO file_hashes (filepath) VALUES (?)", (filepath,))
-        self.cursor.execute("UPDATE file_hashes SET filehash = ? WHERE filepath = ?", (filehash, filepath))
-        self.conn.commit()
+    def touch_http_cache(self, url: str, fetched_at: float) -> None:
+        self.cursor.execute("UPDATE http_cache SET fetched_at = ? WHERE url = ?", (fetched_at, url))
+        self._commit()
 
-    def remove_filehash(self, filepath: str) -> None:
-        self.cursor.execute("DELETE FROM file_hashes WHERE filepath = ?", (filepath,))
-        self.conn.commit()
+    def get_site_pages(self) -> tuple[dict[str, str], dict[str, str | None]]:
+        """Hashes of the pages and of what they were rendered from, by path."""
+        rows = self.cursor.execute("SELECT * FROM site_pages").fetchall()
+        return {row["path"]: row["hash"] for row in rows}, {row["path"]: row["source"] for row in rows}
+
+    def put_site_page(self, path: str, page_hash: str, source: str | None = None) -> None:
+        self.cursor.execute(
+            "INSERT OR REPLACE INTO site_pages (path, hash, source) VALUES (?, ?, ?)",
+            (path, page_hash, source),
+        )
+        self._commit()
+
+    def remove_site_page(self, path: str) -> None:
+        self.cursor.execute("DELETE FROM site_pages WHERE path = ?", (path,))
+        self._commit()
+
+    def get_site_build(self, work_dir: str) -> DBAPISiteBuild | None:
+        row = self.cursor.execute("SELECT * FROM site_builds WHERE work_dir = ?", (work_dir,)).fetchone()
+        return DBAPISiteBuild(**row) if row else None
+
+    def put_site_build(self, work_dir: str, site_dir: str, state: str) -> None:
+        self.cursor.execute(
+            "INSERT OR REPLACE INTO site_builds (work_dir, site_dir, state, built_at) VALUES (?, ?, ?, ?)",
+            (work_dir, site_dir, state, time.time()),
+        )
+        self._commit()
+
+    def enqueue_download(
+        self,
+        url: str,
+        outdir: str,
+        model_id: int | None = None,
+        model_version_id: int | None = None,
+        file_id: int | None = None,
+        hashes: dict[str, str | None] | None = None,
+        size: int | None = None,
+        priority: int = 0,
+    ) -> None:
+        # a file already in the queue keeps its state, only its priority can be raised
+        self.cursor.execute(
+            """
+            INSERT INTO download_queue
+                (modelid, modelversionid, fileid, url, outdir, hashes, size, priority, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (url) DO UPDATE SET priority = max(priority, excluded.priority)
+            """,
+            (
+                model_id,
+                model_version_id,
+                file_id,
+                url,
+                outdir,
+                json.dumps(hashes) if hashes else None,
+                size,
+                priority,
+                time.time(),
+            ),
+        )
+        self._commit()
+
+    def get_downloads(self, status: str | None = None) -> list[DBAPIDownload]:
+        query = "SELECT * FROM download_queue"
+        params: tuple = ()
+        if status is not None:
+            query += " WHERE status = ?"
+            params = (status,)
+        data = self.cursor.execute(f"{query} ORDER BY priority DESC, id", params).fetchall()
+        for row in data:
+            row["hashes"] = json.loads(row["hashes"]) if row["hashes"] else None
+        return [DBAPIDownload(**row) for row in data]
+
+    def update_download(self, download_id: int, status: str, error: str | None = None, filepath: str | None = None):
+        self.cursor.execute(
+            "UPDATE download_queue SET status = ?, error = ?, filepath = ?, updated_at = ? WHERE id = ?",
+            (status, error, filepath, time.time(), download_id),
+        )
+        self._commit()
+
+    def requeue_unfinished_downloads(self, retry_failed: bool = False) -> None:
+        # transfers interrupted by a crash or ^C resume from their sidecar state, failed ones keep their error
+        # until a retry is asked for: a hash mismatch or a dead URL would fail again on every run
+        self.cursor.execute(
+            """
+            UPDATE download_queue SET status = 'pending', error = NULL
+            WHERE status = 'active' OR (status = 'failed' AND ?)
+            """,
+            (retry_failed,),
+        )
+        self._commit()
+
+    def has_model_versions(self) -> bool:
+        return self.cursor.execute("SELECT 1 FROM model_versions LIMIT 1").fetchone() is not None
+
+    def get_model_version_ids(self) -> set[int]:
+        return {row["id"] for row in self.cursor.execute("SELECT id FROM model_versions").fetchall()}
+
+    def get_fetched_model_ids(self) -> set[int]:
+        rows = self.cursor.execute("SELECT id FROM models WHERE fetched_at IS NOT NULL").fetchall()
+        return {row["id"] for row in rows}
+
+    def upsert_model(self, model: CivitaiModel) -> None:
+        # updated_at moves only when what the API sent differs from last time, the pages of the model depend on it
+        now = time.time()
+        self.cursor.execute(
+            """
+            INSERT INTO models (id, name, type, description, tags, fetched_at, digest, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET
+                name = excluded.name,
+                type = excluded.type,
+                description = excluded.description,
+                tags = excluded.tags,
+                fetched_at = excluded.fetched_at,
+                digest = excluded.digest,
+                updated_at = CASE WHEN digest IS excluded.digest THEN updated_at ELSE excluded.updated_at END
+            """,
+            (
+                model.id,
+                model.name,
+                model.type,
+                model.description,
+                json.dumps(model.tags) if model.tags is not None else None,
+                now,
+                blake3(model.model_dump_json().encode()).hexdigest(),
+                now,
+            ),
+        )
+        # one pass over the images of every version
+        stats = compute_generation_stats(
+            model_version for model_version in model.modelVersions if model_version.images is not None
+        )
+        for position, model_version in enumerate(model.modelVersions):
+            self._upsert_model_version(model_version, model.id, position, stats.get(model_version.id))
+        # versions CivitAI no longer lists are dropped, unless a local file is bound to them
+        self.cursor.execute(
+            """
+            DELETE FROM model_versions
+            WHERE model_id = ?
+                AND id NOT IN (SELECT value FROM json_each(?))
+                AND id NOT IN (SELECT modelversionid FROM file_hashes WHERE modelversionid IS NOT NULL)
+            """,
+            (model.id, json.dumps([model_version.id for model_version in model.modelVersions])),
+        )
+        if self.cursor.rowcount:
+            # a version kept for a local file that's gone since
+            self.cursor.execute("UPDATE models SET updated_at = ? WHERE id = ?", (now, model.id))
+        self._commit()
+
+    def upsert_model_version(self, model_version: CivitaiModelVersion) -> None:
+        model_id = model_version.model_id()
+        if model_id is None:
+            raise ValueError(f"Model version {model_version.id} has no model id")
+        # a version found by hash arrives before its model, the stub is filled in once the model is fetched
+        self.cursor.execute(
+            "INSERT INTO models (id, name, type) VALUES (?, ?, ?) ON CONFLICT (id) DO NOTHING",
+            (
+                model_id,
+                model_version.model.name if model_version.model else None,
+                model_version.model.type if model_version.model else None,
+            ),
+        )
+        stats = model_version.generation_stats() if model_version.images is not None else None
+        self._upsert_model_version(model_version, model_id, model_version.index, stats)
+        # the version may differ from what the model endpoint sent, so the next fetch of the model counts as a change
+        self.cursor.execute(
+            "UPDATE models SET digest = NULL, updated_at = ? WHERE id = ?",
+            (time.time(), model_id),
+        )
+        self._commit()
+
+    def _upsert_model_version(
+        self,
+        model_version: CivitaiModelVersion,
+        model_id: int,
+        position: int | None,
+        stats: GenerationStats | None = None,
+    ) -> None:
+        # not INSERT OR REPLACE: it deletes the row first, and the delete cascades to files and images
+        self.cursor.execute(
+            """
+            INSERT INTO model_versions
+                (id, model_id, position, name, description, trained_words, base_model, base_model_type, air,
+                download_url)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET
+                model_id = excluded.model_id,
+                position = coalesce(excluded.position, position),
+                name = excluded.name,
+                description = coalesce(excluded.description, description),
+                trained_words = coalesce(excluded.trained_words, trained_words),
+                base_model = excluded.base_model,
+                base_model_type = coalesce(excluded.base_model_type, base_model_type),
+                air = coalesce(excluded.air, air),
+                download_url = excluded.download_url
+            """,
+            (
+                model_version.id,
+                model_id,
+                position,
+                model_version.name,
+                model_version.description,
+                json.dumps(model_version.trainedWords) if model_version.trainedWords is not None else None,
+                model_version.baseModel,
+                model_version.baseModelType,
+                model_version.air,
+                model_version.downloadUrl,
+            ),
+        )
+
+        self.cursor.execute("DELETE FROM model_version_files WHERE model_version_id = ?", (model_version.id,))
+        self.cursor.executemany(
+            """
+            INSERT INTO model_version_files
+                (id, model_version_id, name, type, size_kb, download_url, format, size, fp)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (
+                    file.id,
+                    model_version.id,
+                    file.name,
+                    file.type,
+                    file.sizeKB,
+                    file.downloadUrl,
+                    file.metadata.format,
+                    file.metadata.size,
+                    file.metadata.fp,
+                )
+                for file in model_version.files
+            ],
+        )
+        self.cursor.executemany(
+            "INSERT INTO model_version_file_hashes (file_id, algorithm, hash) VALUES (?, ?, ?)",
+            [
+                (file.id, algorithm, filehash.upper())
+                for file in model_version.files
+                for algorithm, filehash in file.hashes.model_dump(exclude_none=True).items()
+            ],
+        )
+
+        # the same version from the model endpoint may come without images, the known ones are kept then
+        if model_version.images is not None:
+            self.cursor.execute("DELETE FROM model_version_images WHERE model_version_id = ?", (model_version.id,))
+            self.cursor.executemany(
+                """
+                INSERT INTO model_version_images
+                    (model_version_id, position, url, nsfw_level, width, height, hash, type, has_meta, on_site, meta)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                [
+                    (
+                        model_version.id,
+                        position,
+                        image.url,
+                        image.nsfwLevel,
+                        image.width,
+                        image.height,
+                        image.hash,
+                        image.type,
+                        image.hasMeta,
+                        image.onSite,
+                        json.dumps(image.meta) if image.meta is not None else None,
+                    )
+                    for position, image in enumerate(model_version.images)
+                ],
+            )
+            self.cursor.execute(
+                "UPDATE model_versions SET generation_stats = ? WHERE id = ?",
+                (stats.model_dump_json() if stats is not None else None, model_version.id),
+            )
+
+    def find_model_version_by_hashes(self, filehashes: Iterable[str]) -> tuple[int, int] | None:
+        """(model id, model version id) of a known version with a file matching one of the hashes, in order."""
+        filehashes = [filehash.upper() for filehash in filehashes]
+        found = self.find_model_versions_by_hashes(filehashes)
+        return next((found[filehash] for filehash in filehashes if filehash in found), None)
+
+    def find_model_versions_by_hashes(self, filehashes: Iterable[str]) -> dict[str, tuple[int, int]]:
+        """Upper case hashes of known files to (model id, model version id), in one query for all of them."""
+        found: dict[str, tuple[int, int]] = {}
+        for row in self.cursor.execute(
+            """
+            SELECT model_version_file_hashes.hash, model_versions.model_id, model_versions.id
+            FROM model_version_file_hashes
+            JOIN model_version_files ON model_version_files.id = model_version_file_hashes.file_id
+            JOIN model_versions ON model_versions.id = model_version_files.model_version_id
+            WHERE model_version_file_hashes.hash IN (SELECT value FROM json_each(?))
+            ORDER BY model_versions.id
+            """,
+            (json.dumps(sorted({filehash.upper() for filehash in filehashes})),),
+        ).fetchall():
+            found.setdefault(row["hash"], (row["model_id"], row["id"]))
+        return found
+
+    def get_model_pages(self, model_ids: Iterable[int]) -> list[DBAPIModelPage]:
+        """What the page of each fetched model depends on, in id order, without loading the models."""
+        ids = json.dumps(sorted(set(model_ids)))
+        pages = {
+            row["modelid"]: DBAPIModelPage(**row)
+            for row in self.cursor.execute(
+                """
+                SELECT id AS modelid, type AS model_type, updated_at FROM models
+                WHERE id IN (SELECT value FROM json_each(?)) AND fetched_at IS NOT NULL
+                ORDER BY id
+                """,
+                (ids,),
+            ).fetchall()
+        }
+        for row in self.cursor.execute(
+            """
+            SELECT DISTINCT model_versions.model_id, model_versions.id FROM model_versions
+            JOIN file_hashes ON file_hashes.modelversionid = model_versions.id
+            WHERE model_versions.model_id IN (SELECT value FROM json_each(?))
+            ORDER BY model_versions.id
+            """,
+            (ids,),
+        ).fetchall():
+            if row["model_id"] in pages:
+                pages[row["model_id"]].local_versions.append(row["id"])
+        return list(pages.values())
+
+    def iter_models(
+        self,
+        model_ids: Iterable[int],
+        images: bool = True,
+        chunk_size: int = 500,
+    ) -> Iterator[CivitaiModel]:
+        """get_models a chunk of ids at a time in id order, so only one chunk is in memory."""
+        ids = sorted(set(model_ids))
+        for start in range(0, len(ids), chunk_size):
+            yield from self.get_models(ids[start : start + chunk_size], images=images)
+
+    def get_models(self, model_ids: Iterable[int], images: bool = True) -> list[CivitaiModel]:
+        """Fetched models with all their versions, files and images, in a query per table.
+
+        Stub models created for versions found by hash are skipped until the model itself is fetched.
+        Without images versions come with images None and their stored generation stats, which is
+        all the index needs.
+        """
+        ids = json.dumps(list(model_ids))
+        models = {
+            row["id"]: {**row, "tags": json.loads(row["tags"]) if row["tags"] else None, "modelVersions": []}
+            for row in self.cursor.execute(
+                """
+                SELECT id, name, type, description, tags FROM models
+                WHERE id IN (SELECT value FROM json_each(?)) AND fetched_at IS NOT NULL
+                ORDER BY id
+                """,
+                (ids,),
+            ).fetchall()
+        }
+
+        versions: dict[int, dict] = {}
+        generation_stats: dict[int, str] = {}
+        for row in self.cursor.execute(
+            """
+            SELECT * FROM model_versions
+            WHERE model_id IN (SELECT value FROM json_each(?))
+            ORDER BY model_id, position IS NULL, position, id DESC
+            """,
+            (ids,),
+        ).fetchall():
+            model = models.get(row["model_id"])
+            if model is None:
+                continue
+            version = {
+                "id": row["id"],
+                "modelId": row["model_id"],
+                "index": row["position"],
+                "name": row["name"],
+                "description": row["description"],
+                "trainedWords": json.loads(row["trained_words"]) if row["trained_words"] else None,
+                "baseModel": row["base_model"],
+                "baseModelType": row["base_model_type"],
+                "air": row["air"],
+                "downloadUrl": row["download_url"],
+                "model": {"name": model["name"], "type": model["type"]},
+                "files": [],
+                "images": [] if images or not row["generation_stats"] else None,
+            }
+            versions[row["id"]] = version
+            model["modelVersions"].append(version)
+            if row["generation_stats"]:
+                generation_stats[row["id"]] = row["generation_stats"]
+
+        files: dict[int, dict] = {}
+        for row in self.cursor.execute(
+            """
+            SELECT model_version_files.* FROM model_version_files
+            JOIN model_versions ON model_versions.id = model_version_files.model_version_id
+            WHERE model_versions.model_id IN (SELECT value FROM json_each(?))
+            ORDER BY model_version_files.id
+            """,
+            (ids,),
+        ).fetchall():
+            if row["model_version_id"] not in versions:
+                continue
+            file = {
+                "id": row["id"],
+                "sizeKB": row["size_kb"],
+                "name": row["name"],
+                "type": row["type"],
+                "downloadUrl": row["download_url"],
+                "metadata": {"format": row["format"], "size": row["size"], "fp": row["fp"]},
+                "hashes": {},
+            }
+            files[row["id"]] = file
+            versions[row["model_version_id"]]["files"].append(file)
+
+        for row in self.cursor.execute(
+            """
+            SELECT model_version_file_hashes.* FROM model_version_file_hashes
+            JOIN model_version_files ON model_version_files.id = model_version_file_hashes.file_id
+            JOIN model_versions ON model_versions.id = model_version_files.model_version_id
+            WHERE model_versions.model_id IN (SELECT value FROM json_each(?))
+            """,
+            (ids,),
+        ).fetchall():
+            if row["file_id"] in files:
+                files[row["file_id"]]["hashes"][row["algorithm"]] = row["hash"]
+
+        for row in self.cursor.execute(
+            """
+            SELECT model_version_images.* FROM model_version_images
+            JOIN model_versions ON model_versions.id = model_version_images.model_version_id
+            WHERE model_versions.model_id IN (SELECT value FROM json_each(?))
+                AND (? OR model_versions.generation_stats IS NULL)
+            ORDER BY model_version_images.model_version_id, model_version_images.position
+            """,
+            (ids, images),
+        ).fetchall():
+            # versions stored before their stats were kept get their images anyway, to compute them from
+            if row["model_version_id"] in versions and versions[row["model_version_id"]]["images"] is not None:
+                versions[row["model_version_id"]]["images"].append(
+                    {
+                        "url": row["url"],
+                        "nsfwLevel": row["nsfw_level"],
+                        "width": row["width"],
+                        "height": row["height"],
+                        "hash": row["hash"],
+                        "type": row["type"],
+                        "hasMeta": bool(row["has_meta"]),
+                        "onSite": bool(row["on_site"]),
+                        "meta": json.loads(row["meta"]) if row["meta"] else None,
+                    },
+                )
+
+        result = [CivitaiModel.model_validate(model) for model in models.values()]
+        # versions stored before the stats were kept compute them on first use
+        for civitai_model in result:
+            for model_version in civitai_model.modelVersions:
+                if model_version.id in generation_stats:
+                    model_version._stats = GenerationStats.model_validate_json(generation_stats[model_version.id])
+        return result
+
+    def _find_version_links(
+        self,
+        condition: str,
+        base_model: str | None,
+        model_type: str | None,
+    ) -> list[DBAPIVersionLink]:
+        # versions of the same model related to the ones that have a local file
+        rows = self.cursor.execute(
+            f"""
+            SELECT
+                models.id AS modelid,
+                models.name AS model_name,
+                models.type AS model_type,
+                local.id AS modelversionid,
+                local.name AS version_name,
+                local.base_model,
+                local.base_model_type,
+                other.id AS other_modelversionid,
+                other.name AS other_version_name,
+                other.base_model_type AS other_base_model_type
+            FROM model_versions AS local
+            JOIN models ON models.id = local.model_id
+            JOIN model_versions AS other
+                ON other.model_id = local.model_id AND other.base_model = local.base_model AND other.id != local.id
+            WHERE local.id IN (SELECT modelversionid FROM file_hashes)
+                AND (:base_model IS NULL OR local.base_model = :base_model)
+                AND (:model_type IS NULL OR models.type = :model_type)
+                AND {condition}
+            ORDER BY models.name, local.position, local.id, other.position
+            """,  # noqa: S608
+            {"base_model": base_model, "model_type": model_type},
+        ).fetchall()
+        return [DBAPIVersionLink(**row) for row in rows]
+
+    def find_newer_versions(
+        self,
+        base_model: str | None = None,
+        model_type: str | None = None,
+    ) -> list[DBAPIVersionLink]:
+        """Later versions for the same base model, e.g. every SDXL 1.0 LORA with an update."""
+        return self._find_version_links(
+            "other.position < local.position AND other.base_model_type IS local.base_model_type",
+            base_model,
+            model_type,
+        )
+
+    def find_inpaint_versions(
+        self,
+        base_model: str | None = None,
+        model_type: str | None = None,
+    ) -> list[DBAPIVersionLink]:
+        return self._find_version_links(
+            "other.base_model_type = 'Inpainting' AND local.base_model_type IS NOT 'Inpainting'",
+            base_model,
+            model_type,
+        )
+
+    def search(self, query: str, limit: int = 20, local_only: bool = False) -> list[DBAPISearchHit]:
+        """Model versions matching every word of query by prefix, ranked by bm25."""
+        match = fts_query(query)
+        if not match:
+            return []
+        rows = self.cursor.execute(
+            f"""
+            SELECT
+                models.id AS modelid,
+                models.name AS model_name,
+                models.type AS model_type,
+                model_versions.id AS modelversionid,
+                model_versions.name AS version_name,
+                model_versions.base_model,
+                model_versions.trained_words,
+                (
+                    SELECT min(filepath) FROM file_hashes WHERE file_hashes.modelversionid = model_versions.id
+                ) AS filepath,
+                bm25(model_search, {", ".join(map(str, SEARCH_WEIGHTS))}) AS rank
+            FROM model_search
+            JOIN model_versions ON model_versions.id = model_search.rowid
+            JOIN models ON models.id = model_versions.model_id
+            WHERE model_search MATCH :match
+                AND (NOT :local_only OR model_versions.id IN (SELECT modelversionid FROM file_hashes))
+            ORDER BY rank
+            LIMIT :limit
+            """,  # noqa: S608
+            {"match": match, "local_only": local_only, "limit": limit},
+        ).fetchall()
+        return [self._search_hit(row) for row in rows]
+
+    def get_search_documents(self) -> list[DBAPISearchHit]:
+        """Every version with a local file, what a search page of the site needs to know about them."""
+        rows = self.cursor.execute(
+            """
+            SELECT
+                models.id AS modelid,
+                models.name AS model_name,
+                models.type AS model_type,
+                model_versions.id AS modelversionid,
+                model_versions.name AS version_name,
+                model_versions.base_model,
+                model_versions.trained_words
+            FROM model_versions
+            JOIN models ON models.id = model_versions.model_id
+            WHERE model_versions.id IN (SELECT modelversionid FROM file_hashes) AND models.fetched_at IS NOT NULL
+            ORDER BY models.id, model_versions.position, model_versions.id
+            """,
+        ).fetchall()
+        return [self._search_hit(row) for row in rows]
+
+    @staticmethod
+    def _search_hit(row: dict) -> DBAPISearchHit:
+        return DBAPISearchHit(**{**row, "trained_words": json.loads(row["trained_words"] or "[]")})
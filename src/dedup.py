@@ -0,0 +1,285 @@
+import math
+import mmap
+import os
+
+from collections import defaultdict
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+import loguru
+import numpy as np
+
+from blake3 import blake3
+from pydantic import BaseModel
+
+from src.tensorreader import SafetensorsError, read_safetensors_header, validate_safetensors_header
+
+NUMPY_DTYPES: dict[str, Any] = {
+    "BOOL": np.bool_,
+    "U8": np.uint8,
+    "I8": np.int8,
+    "I16": np.int16,
+    "U16": np.uint16,
+    "F16": np.float16,
+    "I32": np.int32,
+    "U32": np.uint32,
+    "F32": np.float32,
+    "I64": np.int64,
+    "U64": np.uint64,
+    "F64": np.float64,
+}
+
+# relative error of rounding to each float dtype with some headroom: a copy converted to a coarser dtype
+# is within the tolerance of the coarser one everywhere. Integer and fp8 tensors have to match exactly
+FLOAT_TOLERANCES = {"F64": 1e-12, "F32": 1e-6, "F16": 1e-3, "BF16": 1e-2}
+# fp16 flushes anything below its smallest subnormal to zero
+ABSOLUTE_TOLERANCE = 1e-7
+
+# elements compared at once when streaming two tensors side by side
+CHUNK_ELEMENTS = 1 << 22
+
+
+class TensorSpan(BaseModel):
+    dtype: str
+    shape: list[int]
+    begin: int  # absolute offsets in the file
+    end: int
+
+    @property
+    def elements(self) -> int:
+        return math.prod(self.shape)
+
+
+class SafetensorsLayout(BaseModel):
+    path: str
+    size: int
+    metadata: dict[str, str]
+    tensors: dict[str, TensorSpan]
+
+    def shapes(self) -> tuple[tuple[str, tuple[int, ...]], ...]:
+        """Tensor names and shapes, the same for copies of a model in any dtype."""
+        return tuple(sorted((name, tuple(tensor.shape)) for name, tensor in self.tensors.items()))
+
+    def dtypes(self) -> tuple[str, ...]:
+        return tuple(self.tensors[name].dtype for name in sorted(self.tensors))
+
+    def tolerance(self) -> float:
+        return max((FLOAT_TOLERANCES.get(tensor.dtype, 0.0) for tensor in self.tensors.values()), default=0.0)
+
+
+class DuplicateGroup(BaseModel):
+    # identical: same header and tensors; same weights: same tensors, other metadata;
+    # near: the same values within rounding, in other dtypes
+    kind: str
+    files: list[str]
+    sizes: list[int]
+
+    @classmethod
+    def of(cls, kind: str, layouts: list[SafetensorsLayout]) -> "DuplicateGroup":
+        return cls(kind=kind, files=[layout.path for layout in layouts], sizes=[layout.size for layout in layouts])
+
+    @property
+    def reclaimable(self) -> int:
+        """Bytes freed by keeping only the smallest file."""
+        return sum(self.sizes) - min(self.sizes)
+
+
+def read_layout(path: str) -> SafetensorsLayout | None:
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            header, data_start = read_safetensors_header(fd, size)
+            validate_safetensors_header(header, size - data_start)
+        finally:
+            os.close(fd)
+    except (OSError, SafetensorsError) as e:
+        loguru.logger.warning(f"Skipping {path}: {e}")
+        return None
+
+    tensors = {
+        name: TensorSpan(
+            dtype=info["dtype"],
+            shape=info["shape"],
+            begin=data_start + info["data_offsets"][0],
+            end=data_start + info["data_offsets"][1],
+        )
+        for name, info in header.items()
+        if name != "__metadata__"
+    }
+    return SafetensorsLayout(path=path, size=size, metadata=header.get("__metadata__", {}), tensors=tensors)
+
+
+def to_float(data: bytes | memoryview | np.ndarray, dtype: str) -> np.ndarray:
+    """Tensor elements as float64, fp8 stays raw bytes."""
+    if dtype == "BF16":
+        # bfloat16 is the upper half of a float32
+        return (np.frombuffer(data, np.uint16).astype(np.uint32) << 16).view(np.float32).astype(np.float64)
+    return np.frombuffer(data, NUMPY_DTYPES.get(dtype, np.uint8)).astype(np.float64)
+
+
+def sample_values(layout: SafetensorsLayout, samples: int = 256, tensors: int = 4) -> np.ndarray:
+    """Evenly spaced elements of the largest tensors, a few pages of I/O per file."""
+    names = sorted(layout.tensors, key=lambda name: (-layout.tensors[name].elements, name))[:tensors]
+    values = []
+    with open(layout.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for name in names:
+            tensor = layout.tensors[name]
+            if not tensor.elements:
+                continue
+            itemsize = (tensor.end - tensor.begin) // tensor.elements
+            indices = np.linspace(0, tensor.elements - 1, min(samples, tensor.elements)).astype(np.int64)
+            # fancy indexing copies, so nothing keeps the mmap exported after the loop
+            raw = np.frombuffer(mm, np.uint8, count=tensor.end - tensor.begin, offset=tensor.begin)
+            picked = raw.reshape(tensor.elements, itemsize)[indices].tobytes()
+            del raw
+            values.append(to_float(picked, tensor.dtype))
+    return np.concatenate(values) if values else np.empty(0)
+
+
+def tensor_hashes(layout: SafetensorsLayout, blocksize: int = 1 << 24) -> dict[str, str]:
+    """blake3 of each tensor's bytes, the header doesn't take part."""
+    hashes = {}
+    with (
+        open(layout.path, "rb") as f,
+        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm,
+        memoryview(mm) as view,
+    ):
+        for name, tensor in layout.tensors.items():
+            hasher = blake3()
+            for offset in range(tensor.begin, tensor.end, blocksize):
+                with view[offset : min(offset + blocksize, tensor.end)] as block:
+                    hasher.update(block)
+            hashes[name] = hasher.hexdigest()
+    return hashes
+
+
+def same_weights(reference: SafetensorsLayout, other: SafetensorsLayout) -> bool:
+    """Every tensor of other is within the rounding error of its dtype from the reference one."""
+    rtol = max(reference.tolerance(), other.tolerance())
+    with (
+        open(reference.path, "rb") as f_ref,
+        open(other.path, "rb") as f_other,
+        mmap.mmap(f_ref.fileno(), 0, access=mmap.ACCESS_READ) as mm_ref,
+        mmap.mmap(f_other.fileno(), 0, access=mmap.ACCESS_READ) as mm_other,
+        memoryview(mm_ref) as view_ref,
+        memoryview(mm_other) as view_other,
+    ):
+        for name, tensor in reference.tensors.items():
+            other_tensor = other.tensors[name]
+            size_ref = (tensor.end - tensor.begin) // max(1, tensor.elements)
+            size_other = (other_tensor.end - other_tensor.begin) // max(1, tensor.elements)
+            for start in range(0, tensor.elements, CHUNK_ELEMENTS):
+                count = min(CHUNK_ELEMENTS, tensor.elements - start)
+                with (
+                    view_ref[tensor.begin + start * size_ref : tensor.begin + (start + count) * size_ref] as a,
+                    view_other[
+                        other_tensor.begin + start * size_other : other_tensor.begin + (start + count) * size_other
+                    ] as b,
+                ):
+                    close = np.allclose(
+                        to_float(a, tensor.dtype),
+                        to_float(b, other_tensor.dtype),
+                        rtol=rtol,
+                        atol=ABSOLUTE_TOLERANCE if rtol else 0.0,
+                        equal_nan=True,
+                    )
+                if not close:
+                    return False
+    return True
+
+
+class DedupFinder:
+    """Groups .safetensors files holding the same weights, whatever their metadata or dtype.
+
+    Only headers are read to shortlist files with the same tensor names and shapes, a few sampled
+    values split the shortlist further, and only the files left are read in full: tensor by tensor
+    over mmap, so files bigger than RAM are fine.
+    """
+
+    def __init__(self, workers: int = 4, samples: int = 256):
+        self.workers = max(1, workers)
+        self.samples = samples
+
+    def find(self, files: Iterable[str]) -> list[DuplicateGroup]:
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="dedup") as executor:
+            layouts = [layout for layout in executor.map(read_layout, files) if layout and layout.tensors]
+
+            by_shapes: dict[tuple, list[SafetensorsLayout]] = defaultdict(list)
+            for layout in layouts:
+                by_shapes[layout.shapes()].append(layout)
+            shortlist = [layout for group in by_shapes.values() if len(group) > 1 for layout in group]
+            loguru.logger.info(f"{len(shortlist)} of {len(layouts)} files share their tensor layout with another one")
+
+            samples = dict(
+                zip(
+                    (layout.path for layout in shortlist),
+                    executor.map(lambda layout: sample_values(layout, self.samples), shortlist),
+                    strict=True,
+                ),
+            )
+            candidates = [
+                cluster
+                for group in by_shapes.values()
+                if len(group) > 1
+                for cluster in self._cluster(group, samples)
+                if len(cluster) > 1
+            ]
+
+            groups = []
+            for cluster in candidates:
+                groups.extend(self._confirm(executor, cluster))
+        return sorted(groups, key=lambda group: -group.reclaimable)
+
+    @staticmethod
+    def _cluster(group: list[SafetensorsLayout], samples: dict[str, np.ndarray]) -> list[list[SafetensorsLayout]]:
+        clusters: list[list[SafetensorsLayout]] = []
+        for layout in group:
+            for cluster in clusters:
+                rtol = max(cluster[0].tolerance(), layout.tolerance())
+                if np.allclose(
+                    samples[cluster[0].path],
+                    samples[layout.path],
+                    rtol=rtol,
+                    atol=ABSOLUTE_TOLERANCE if rtol else 0.0,
+                    equal_nan=True,
+                ):
+                    cluster.append(layout)
+                    break
+            else:
+                clusters.append([layout])
+        return clusters
+
+    @staticmethod
+    def _confirm(executor: ThreadPoolExecutor, cluster: list[SafetensorsLayout]) -> list[DuplicateGroup]:
+        # files in the same dtypes are compared by tensor hashes
+        by_dtypes: dict[tuple, list[SafetensorsLayout]] = defaultdict(list)
+        for layout in cluster:
+            by_dtypes[layout.dtypes()].append(layout)
+        exact: list[list[SafetensorsLayout]] = []
+        for same_dtypes in by_dtypes.values():
+            by_hashes: dict[tuple, list[SafetensorsLayout]] = defaultdict(list)
+            for layout, hashes in zip(same_dtypes, executor.map(tensor_hashes, same_dtypes), strict=True):
+                by_hashes[tuple(sorted(hashes.items()))].append(layout)
+            exact.extend(by_hashes.values())
+
+        # every tier lists one file of each group of the tier below, so what they reclaim adds up
+        groups: list[DuplicateGroup] = []
+        for layouts in exact:
+            by_header: dict[str, list[SafetensorsLayout]] = defaultdict(list)
+            for layout in layouts:
+                by_header[repr((sorted(layout.metadata.items()), sorted(layout.tensors.items())))].append(layout)
+            groups.extend(DuplicateGroup.of("identical", copies) for copies in by_header.values() if len(copies) > 1)
+            if len(by_header) > 1:
+                groups.append(DuplicateGroup.of("same weights", [copies[0] for copies in by_header.values()]))
+
+        # one file of each exact group against the most precise one, value by value
+        if len(exact) > 1:
+            exact.sort(key=lambda layouts: -layouts[0].size)
+            reference = exact[0][0]
+            matches = executor.map(lambda layouts: same_weights(reference, layouts[0]), exact[1:])
+            near = exact[:1] + [layouts for layouts, match in zip(exact[1:], matches, strict=True) if match]
+            if len(near) > 1:
+                groups.append(DuplicateGroup.of("near", [layouts[0] for layouts in near]))
+        return groups
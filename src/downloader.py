@@ -0,0 +1,408 @@
+import hashlib
+import os
+import re
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlparse
+
+import httpx
+import loguru
+
+from pydantic import BaseModel
+from tqdm import tqdm
+
+from src.models import CivitaiHashes
+from src.ratelimit import RetryPolicy, TokenBucket
+from src.utils import MultiHasher, gen_filehashes
+
+# CivitaiHashes field -> gen_filehashes algorithm
+CIVITAI_HASH_ALGORITHMS = {"BLAKE3": "blake3", "SHA256": "sha256", "AutoV2": "autov2", "CRC32": "crc32"}
+
+
+def parse_content_disposition(header):
+    # Define a regular expression pattern to match the filename parameter
+    pattern = r'filename=["\']?([^"\';]+)["\']?'
+    match = re.search(pattern, header)
+    if match:
+        filename = match[1]
+        # Remove quotes around the filename if present
+        if filename.startswith('"') and filename.endswith('"') or filename.startswith("'") and filename.endswith("'"):
+            filename = filename[1:-1]
+        return filename
+    return None
+
+
+class DownloadSegment(BaseModel):
+    start: int
+    end: int  # inclusive
+    done: int = 0
+
+    @property
+    def size(self) -> int:
+        return self.end - self.start + 1
+
+    @property
+    def finished(self) -> bool:
+        return self.done >= self.size
+
+
+class DownloadState(BaseModel):
+    url: str
+    filename: str
+    size: int
+    ranges: bool
+    segments: list[DownloadSegment]
+
+    @property
+    def done(self) -> int:
+        return sum(segment.done for segment in self.segments)
+
+
+class DownloadProbe(BaseModel):
+    filename: str
+    size: int | None
+    ranges: bool
+
+
+class DownloadResult(BaseModel):
+    filepath: str
+    digests: dict[str, str] = {}
+
+
+def expected_digests(expected: CivitaiHashes) -> dict[str, str]:
+    return {
+        algorithm: value.lower()
+        for field, algorithm in CIVITAI_HASH_ALGORITHMS.items()
+        if (value := getattr(expected, field, None))
+    }
+
+
+def verify_file_hashes(path: str, expected: CivitaiHashes, digests: dict[str, str] | None = None) -> None:
+    """Compare the file with every digest CivitAI published for it.
+
+    Digests computed while downloading are used when they cover everything, otherwise the file is read once.
+    """
+    wanted = expected_digests(expected)
+    if not wanted:
+        loguru.logger.warning(f"No known hashes to verify {path} against")
+        return
+
+    actual = digests if digests and set(wanted) <= set(digests) else gen_filehashes(path, wanted)
+    mismatched = [algorithm for algorithm, value in wanted.items() if actual[algorithm] != value]
+    if mismatched:
+        raise ValueError(f"Hash mismatch for {path}: {', '.join(mismatched)}")
+
+
+class StreamingHasher:
+    """Digest a file while its segments are still being written.
+
+    Segments finish out of order but digests need the bytes in order, so a background thread follows
+    the contiguous downloaded prefix and reads it back with os.pread. Those pages were written moments
+    ago and come from the page cache, not from the disk.
+    """
+
+    def __init__(self, fd: int, state: DownloadState, lock: threading.Lock, algorithms: list[str]):
+        self.fd = fd
+        self.state = state
+        self.lock = lock
+        self.hasher = MultiHasher(algorithms)
+        self.position = 0
+        self.blocksize = 1 << 22
+        self.condition = threading.Condition()
+        self.finished = False
+        self.aborted = False
+        # set when bytes already hashed were thrown away, the digests are then computed from the file
+        self.invalid = False
+        self.error: BaseException | None = None
+        self.thread = threading.Thread(target=self._run, name="download-hasher", daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def notify(self) -> None:
+        with self.condition:
+            self.condition.notify()
+
+    def invalidate(self) -> None:
+        self.invalid = True
+
+    def stop(self, abort: bool = False) -> dict[str, str] | None:
+        with self.condition:
+            self.finished = True
+            self.aborted = abort
+            self.condition.notify()
+        self.thread.join()
+        if abort or self.invalid:
+            return None
+        if self.error is not None:
+            raise self.error
+        return self.hasher.hexdigests()
+
+    def _contiguous_end(self) -> int:
+        with self.lock:
+            end = 0
+            for segment in sorted(self.state.segments, key=lambda segment: segment.start):
+                end = segment.start + segment.done
+                if not segment.finished:
+                    break
+            return end
+
+    def _run(self) -> None:
+        try:
+            while True:
+                with self.condition:
+                    end = self._contiguous_end()
+                    while self.position >= end and not self.finished:
+                        self.condition.wait(timeout=1.0)
+                        end = self._contiguous_end()
+                    if self.aborted or self.invalid or (self.finished and self.position >= end):
+                        return
+
+                while self.position < end and not self.aborted:
+                    block = os.pread(self.fd, min(self.blocksize, end - self.position), self.position)
+                    if not block:
+                        raise OSError(f"Unexpected end of file at {self.position}")
+                    self.hasher.update(block)
+                    self.position += len(block)
+        except BaseException as e:
+            self.error = e
+
+
+class SegmentedDownloader:
+    """Download a file over several pooled connections into a preallocated file.
+
+    Every segment is a byte range written with os.pwrite at its own offset. Progress is kept in a sidecar
+    state file next to the partial file, so a restarted download continues exactly where each segment stopped.
+    """
+
+    def __init__(
+        self,
+        client: httpx.Client,
+        segments: int = 4,
+        min_segment_size: int = 64 << 20,
+        chunk_size: int = 1 << 20,
+        retry_policy: RetryPolicy | None = None,
+        state_interval: float = 5.0,
+        bandwidth: TokenBucket | None = None,
+        progress_lock: "threading.Lock | None" = None,
+    ):
+        self.client = client
+        self.segments = max(1, segments)
+        self.min_segment_size = min_segment_size
+        self.chunk_size = chunk_size
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.state_interval = state_interval
+        # bytes per second, may be shared by several downloaders to cap the total
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.state_lock = threading.Lock()
+        # guards the progress bar, shared by all downloaders that update the same one
+        self.progress_lock = progress_lock or threading.Lock()
+
+    def probe(self, url: str) -> DownloadProbe:
+        with self.client.stream("GET", url, headers={"Range": "bytes=0-0"}, follow_redirects=True) as response:
+            response.raise_for_status()
+            filename = None
+            if response.headers.get("Content-Disposition"):
+                filename = parse_content_disposition(response.headers["Content-Disposition"])
+            if not filename:
+                filename = unquote(os.path.basename(urlparse(str(response.url)).path)) or "download"
+
+            content_range = re.match(r"bytes \d+-\d+/(\d+)", response.headers.get("Content-Range", ""))
+            if response.status_code == 206 and content_range:
+                return DownloadProbe(filename=filename, size=int(content_range[1]), ranges=True)
+
+            length = response.headers.get("Content-Length")
+            return DownloadProbe(filename=filename, size=int(length) if length else None, ranges=False)
+
+    def plan(self, url: str, probe: DownloadProbe) -> DownloadState:
+        if probe.size is None:
+            # unknown length: a single stream that ends whenever the server stops sending
+            segments = [DownloadSegment(start=0, end=sys.maxsize)]
+            return DownloadState(url=url, filename=probe.filename, size=0, ranges=False, segments=segments)
+
+        count = max(1, min(self.segments, probe.size // self.min_segment_size)) if probe.ranges else 1
+        bounds = [probe.size * i // count for i in range(count + 1)]
+        return DownloadState(
+            url=url,
+            filename=probe.filename,
+            size=probe.size,
+            ranges=probe.ranges,
+            segments=[DownloadSegment(start=bounds[i], end=bounds[i + 1] - 1) for i in range(count)],
+        )
+
+    def download(
+        self,
+        url: str,
+        outdir: str,
+        expected_hashes: CivitaiHashes | None = None,
+        progress: tqdm | None = None,
+        hash_algorithms: list[str] | None = None,
+        expected_size: int | None = None,
+    ) -> DownloadResult:
+        """Download url into outdir and return the path with the digests computed on the way.
+
+        A progress bar shared by several downloads has their expected sizes in its total already,
+        each download corrects the total by the difference to the size the server reports.
+        """
+        workdir = os.path.join(outdir, ".civitai-fetcher")
+        os.makedirs(workdir, exist_ok=True)
+        part_path = os.path.join(workdir, f"download-{hashlib.sha1(url.encode()).hexdigest()[:16]}.part")  # noqa: S324
+        state_path = f"{part_path}.json"
+
+        probe = self.probe(url)
+        state = self._load_state(state_path, part_path, url, probe)
+        if state is None:
+            state = self.plan(url, probe)
+            loguru.logger.info(f"Downloading {url}: {state.size} bytes in {len(state.segments)} segments")
+            with open(part_path, "wb") as f:
+                if state.size:
+                    # reserve the space up front, so parallel segments don't fragment the file
+                    try:
+                        os.posix_fallocate(f.fileno(), 0, state.size)
+                    except (AttributeError, OSError):
+                        f.truncate(state.size)
+        else:
+            loguru.logger.info(f"Resuming {url} from {state.done} of {state.size} bytes")
+        self._save_state(state_path, state)
+
+        if progress is not None:
+            with self.progress_lock:
+                progress.total = (progress.total or 0) + state.size - (expected_size or 0)
+                progress.update(state.done)
+
+        # what the caller wants to store plus whatever CivitAI published, so verification needs no extra read
+        algorithms = list(hash_algorithms or [])
+        if expected_hashes is not None:
+            algorithms.extend(expected_digests(expected_hashes))
+
+        fd = os.open(part_path, os.O_RDWR)
+        hasher = StreamingHasher(fd, state, self.lock, algorithms) if algorithms else None
+        digests: dict[str, str] | None = None
+        try:
+            if hasher is not None:
+                hasher.start()
+            segments = [segment for segment in state.segments if not segment.finished]
+            if segments:
+                with ThreadPoolExecutor(max_workers=len(segments), thread_name_prefix="download") as executor:
+                    futures = [
+                        executor.submit(self._fetch_segment, fd, state, state_path, segment, progress, hasher)
+                        for segment in segments
+                    ]
+                    for future in futures:
+                        future.result()
+            os.fsync(fd)
+            if hasher is not None:
+                digests = hasher.stop()
+        finally:
+            if hasher is not None and hasher.thread.is_alive():
+                hasher.stop(abort=True)
+            os.close(fd)
+
+        if algorithms and digests is None:
+            digests = gen_filehashes(part_path, algorithms)
+
+        if expected_hashes is not None:
+            try:
+                verify_file_hashes(part_path, expected_hashes, digests)
+            except ValueError:
+                # a corrupted file can't be resumed, start from scratch next time
+                os.remove(part_path)
+                os.remove(state_path)
+                raise
+
+        destination = os.path.join(workdir, state.filename)
+        os.replace(part_path, destination)
+        os.remove(state_path)
+        return DownloadResult(filepath=destination, digests=digests or {})
+
+    def _load_state(self, state_path: str, part_path: str, url: str, probe: DownloadProbe) -> DownloadState | None:
+        if not os.path.exists(state_path) or not os.path.exists(part_path):
+            return None
+        with open(state_path) as f:
+            state = DownloadState.model_validate_json(f.read())
+        if state.url != url or state.size != (probe.size or 0) or not state.ranges or not probe.ranges:
+            loguru.logger.warning(f"Remote file changed or can't be resumed, restarting {url}")
+            return None
+        return state
+
+    def _save_state(self, state_path: str, state: DownloadState) -> None:
+        with self.state_lock:
+            with self.lock:
+                data = state.model_dump_json()
+            with open(f"{state_path}.tmp", "w") as f:
+                f.write(data)
+            os.replace(f"{state_path}.tmp", state_path)
+
+    def _fetch_segment(
+        self,
+        fd: int,
+        state: DownloadState,
+        state_path: str,
+        segment: DownloadSegment,
+        progress: tqdm | None,
+        hasher: StreamingHasher | None = None,
+    ) -> None:
+        attempt = 0
+        saved_at = time.monotonic()
+        while not segment.finished:
+            headers = {}
+            if state.ranges:
+                headers["Range"] = f"bytes={segment.start + segment.done}-{segment.end}"
+            elif segment.done:
+                # no range support: the only way to recover is to start over
+                if progress is not None:
+                    with self.progress_lock:
+                        progress.update(-segment.done)
+                if hasher is not None:
+                    hasher.invalidate()
+                segment.done = 0
+
+            try:
+                with self.client.stream("GET", state.url, headers=headers, follow_redirects=True) as response:
+                    response.raise_for_status()
+                    if state.ranges and response.status_code != 206:
+                        raise httpx.RemoteProtocolError(f"Expected a partial response, got {response.status_code}")
+
+                    for chunk in response.iter_bytes(self.chunk_size):
+                        os.pwrite(fd, chunk, segment.start + segment.done)
+                        with self.lock:
+                            segment.done += len(chunk)
+                        if progress is not None:
+                            with self.progress_lock:
+                                progress.update(len(chunk))
+                        if hasher is not None:
+                            hasher.notify()
+                        attempt = 0
+                        if self.bandwidth is not None:
+                            time.sleep(self.bandwidth.reserve(len(chunk)))
+
+                        if time.monotonic() - saved_at > self.state_interval:
+                            # only persist progress that has reached the disk
+                            os.fsync(fd)
+                            self._save_state(state_path, state)
+                            saved_at = time.monotonic()
+
+                    if not state.size:
+                        # size was unknown, whatever arrived is the whole file
+                        with self.lock:
+                            state.size = segment.done
+                            segment.end = segment.done - 1
+                        if progress is not None:
+                            with self.progress_lock:
+                                progress.total = (progress.total or 0) + state.size
+                        break
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                os.fsync(fd)
+                self._save_state(state_path, state)
+                if not self.retry_policy.should_retry(attempt):
+                    raise
+                delay = self.retry_policy.delay(attempt)
+                loguru.logger.warning(f"Segment {segment.start}-{segment.end} failed: {e}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+
+        self._save_state(state_path, state)
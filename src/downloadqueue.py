@@ -0,0 +1,135 @@
+import threading
+
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+import loguru
+
+from tqdm import tqdm
+
+from src.civitai import Civitai
+from src.db import DBApi
+from src.downloader import DownloadResult
+from src.models import CivitaiFile, CivitaiModelVersion, DBAPIDownload, FileFingerprint
+from src.ratelimit import TokenBucket
+
+
+def pick_best_file(model_version: CivitaiModelVersion) -> CivitaiFile | None:
+    # training data, configs and VAEs share the list with the model itself
+    files = [file for file in model_version.files if file.type == "Model"] or model_version.files
+    return max(files, key=lambda file: file.metadata.priority, default=None)
+
+
+class DownloadQueue:
+    """Persistent download queue: N transfers at a time under one bandwidth cap, highest priority first."""
+
+    def __init__(
+        self,
+        civitai_api: Civitai,
+        db_api: DBApi,
+        concurrency: int = 2,
+        segments: int = 4,
+        bandwidth_limit: int = 0,
+        hash_algorithm: str = "blake3",
+        hash_algorithms: list[str] | None = None,
+    ):
+        self.civitai_api = civitai_api
+        self.db_api = db_api
+        self.hash_algorithm = hash_algorithm
+        self.hash_algorithms = list(dict.fromkeys([hash_algorithm, *(hash_algorithms or [])]))
+        self.concurrency = max(1, concurrency)
+        self.segments = segments
+        # one bucket for all transfers, so the cap holds for the sum of them
+        self.bandwidth = TokenBucket(bandwidth_limit) if bandwidth_limit > 0 else None
+
+    def enqueue_file(
+        self,
+        file: CivitaiFile,
+        outdir: str,
+        model_id: int | None = None,
+        model_version_id: int | None = None,
+        priority: int = 0,
+    ) -> None:
+        loguru.logger.info(f"Queueing {file.name} [{file.metadata.fp}, {file.metadata.size}] to {outdir}")
+        self.db_api.enqueue_download(
+            url=file.downloadUrl,
+            outdir=outdir,
+            model_id=model_id,
+            model_version_id=model_version_id,
+            file_id=file.id,
+            hashes=file.hashes.model_dump(exclude_none=True),
+            size=int(file.sizeKB * 1024),
+            priority=priority,
+        )
+
+    def enqueue_version(self, model_version: CivitaiModelVersion, outdir: str, priority: int = 0) -> bool:
+        file = pick_best_file(model_version)
+        if not file:
+            loguru.logger.warning(f"No files to download for model version {model_version.id}")
+            return False
+        self.enqueue_file(file, outdir, model_version.model_id(), model_version.id, priority)
+        return True
+
+    def run(self, retry_failed: bool = False) -> list[DBAPIDownload]:
+        self.db_api.requeue_unfinished_downloads(retry_failed)
+        queue = self.db_api.get_downloads(status="pending")
+        if not queue:
+            loguru.logger.info("Download queue is empty")
+            return []
+
+        loguru.logger.info(f"Downloading {len(queue)} files, {self.concurrency} at a time")
+        inflight: dict[Future[DownloadResult], DBAPIDownload] = {}
+        finished: list[DBAPIDownload] = []
+
+        # all transfers share one bar and one lock to update it, so it shows the total throughput and ETA
+        # from the start; each transfer corrects its expected size once the server tells the real one
+        progress_lock = threading.Lock()
+        total = sum(item.size or 0 for item in queue)
+        with (
+            ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="download-queue") as executor,
+            tqdm(total=total, unit="B", unit_scale=True, unit_divisor=1024) as progress,
+        ):
+            while queue or inflight:
+                while queue and len(inflight) < self.concurrency:
+                    item = queue.pop(0)
+                    self.db_api.update_download(item.id, "active")
+                    future = executor.submit(
+                        self.civitai_api.download,
+                        item.url,
+                        item.outdir,
+                        expected_hashes=item.hashes,
+                        segments=self.segments,
+                        bandwidth=self.bandwidth,
+                        progress=progress,
+                        hash_algorithms=self.hash_algorithms,
+                        progress_lock=progress_lock,
+                        expected_size=item.size,
+                    )
+                    inflight[future] = item
+
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = inflight.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        loguru.logger.error(f"Failed to download {item.url}: {e}")
+                        item.status, item.error = "failed", str(e)
+                    else:
+                        loguru.logger.info(f"Downloaded {result.filepath}")
+                        item.status, item.filepath = "done", result.filepath
+                        self._index(item, result)
+                    self.db_api.update_download(item.id, item.status, error=item.error, filepath=item.filepath)
+                    finished.append(item)
+
+        return finished
+
+    def _index(self, item: DBAPIDownload, result: DownloadResult) -> None:
+        # the file was hashed while it streamed in, so the next scan finds it up to date and already bound
+        self.db_api.update_filehash(
+            result.filepath,
+            result.digests[self.hash_algorithm],
+            FileFingerprint.from_path(result.filepath),
+            result.digests,
+        )
+        if item.modelid is not None and item.modelversionid is not None:
+            self.db_api.update_data(result.filepath, item.modelid, item.modelversionid)
@@ -0,0 +1,66 @@
+import time
+
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+import loguru
+
+from blake3 import blake3
+from tqdm import tqdm
+
+from src.metrics import HASH_BUCKETS, metrics
+from src.models import FileFingerprint
+from src.utils import gen_filehashes
+
+
+def hash_files(
+    files: Iterable[tuple[str, FileFingerprint]],
+    algorithms: list[str],
+    workers: int = 4,
+    max_inflight_bytes: int = 4 << 30,
+) -> Iterator[tuple[str, FileFingerprint, dict[str, str]]]:
+    """Hash several files at once and yield (path, fingerprint, digests) in completion order.
+
+    Hashers release the GIL, so a thread pool is enough. Files are memory-mapped, nothing is buffered:
+    max_inflight_bytes bounds the total size of the files being read at once, not memory. A new file is
+    started only while that total stays under it; a single file bigger than the limit still runs alone.
+    """
+    workers = max(1, workers)
+    # the pool is the parallelism, blake3 threads of its own in every worker would oversubscribe the cores
+    max_threads = 1 if workers > 1 else blake3.AUTO
+    queue = deque(files)
+    total_bytes = sum(fingerprint.size for _, fingerprint in queue)
+    inflight: dict[Future[dict[str, str]], tuple[str, FileFingerprint, float]] = {}
+    inflight_bytes = 0
+
+    with (
+        ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hasher") as executor,
+        tqdm(total=total_bytes, unit="B", unit_scale=True, unit_divisor=1024, disable=not queue) as progress,
+    ):
+        while queue or inflight:
+            while (
+                queue
+                and len(inflight) < workers
+                and (not inflight or inflight_bytes + queue[0][1].size <= max_inflight_bytes)
+            ):
+                path, fingerprint = queue.popleft()
+                future = executor.submit(gen_filehashes, path, algorithms, max_threads=max_threads)
+                inflight[future] = (path, fingerprint, time.perf_counter())
+                inflight_bytes += fingerprint.size
+
+            done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, fingerprint, started = inflight.pop(future)
+                inflight_bytes -= fingerprint.size
+                progress.update(fingerprint.size)
+                try:
+                    digests = future.result()
+                except OSError as e:
+                    loguru.logger.error(f"Failed to hash {path}: {e}")
+                    metrics.count("hash_errors")
+                    continue
+                metrics.count("hashed_files")
+                metrics.count("hashed_bytes", fingerprint.size)
+                metrics.observe("hash_file_seconds", time.perf_counter() - started, HASH_BUCKETS)
+                yield path, fingerprint, digests
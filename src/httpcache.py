@@ -0,0 +1,134 @@
+import re
+import time
+import zlib
+
+import httpx
+
+from pydantic import BaseModel
+
+from src.db import DBApi
+from src.models import DBAPIHttpCacheEntry
+
+
+class ResponseCacheStats(BaseModel):
+    hits: int = 0
+    negative_hits: int = 0
+    revalidated: int = 0
+    misses: int = 0
+
+
+class ResponseCache:
+    """Persistent cache of API responses with per-endpoint TTLs and negative caching of 404s.
+
+    ttls maps a regular expression matched against the URL path to the TTL (seconds) of a 200 response;
+    URLs matching none of them are not cached. A 404 is kept for not_found_ttl seconds.
+    """
+
+    def __init__(self, db_api: DBApi, ttls: dict[str, int], not_found_ttl: int):
+        self.db_api = db_api
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in ttls.items()]
+        self.not_found_ttl = not_found_ttl
+        self.stats = ResponseCacheStats()
+
+    def ttl(self, request: httpx.Request) -> int | None:
+        if request.method != "GET":
+            return None
+        return next((ttl for pattern, ttl in self.ttls if pattern.search(request.url.path)), None)
+
+    def get(self, url: str) -> DBAPIHttpCacheEntry | None:
+        return self.db_api.get_http_cache(url)
+
+    def is_fresh(self, entry: DBAPIHttpCacheEntry, ttl: int) -> bool:
+        max_age = self.not_found_ttl if entry.status == 404 else ttl
+        return time.time() - entry.fetched_at < max_age
+
+    def is_not_found(self, url: str) -> bool:
+        """A GET of url was answered with 404 recently enough to be served from the cache."""
+        ttl = self.ttl(httpx.Request("GET", url))
+        entry = self.get(url) if ttl is not None else None
+        if entry is None or entry.status != 404 or not self.is_fresh(entry, ttl or 0):
+            return False
+        self.stats.negative_hits += 1
+        return True
+
+    def store(self, url: str, response: httpx.Response) -> None:
+        self.db_api.put_http_cache(
+            DBAPIHttpCacheEntry(
+                url=url,
+                status=response.status_code,
+                etag=response.headers.get("ETag"),
+                last_modified=response.headers.get("Last-Modified"),
+                body=zlib.compress(response.content),
+                fetched_at=time.time(),
+            ),
+        )
+
+    def touch(self, url: str) -> None:
+        self.db_api.touch_http_cache(url, time.time())
+
+
+def _cached_response(entry: DBAPIHttpCacheEntry, request: httpx.Request, cache_status: str) -> httpx.Response:
+    return httpx.Response(
+        status_code=entry.status,
+        headers={"Content-Type": "application/json", "X-Cache": cache_status},
+        content=zlib.decompress(entry.body),
+        request=request,
+    )
+
+
+class AsyncCachingTransport(httpx.AsyncBaseTransport):
+    def __init__(self, cache: ResponseCache, transport: httpx.AsyncBaseTransport):
+        self.cache = cache
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        ttl = self.cache.ttl(request)
+        if ttl is None:
+            return await self.transport.handle_async_request(request)
+
+        url = str(request.url)
+        entry = self.cache.get(url)
+        if entry and self.cache.is_fresh(entry, ttl):
+            if entry.status == 404:
+                self.cache.stats.negative_hits += 1
+            else:
+                self.cache.stats.hits += 1
+            return _cached_response(entry, request, "HIT")
+
+        if entry and entry.status == 200:
+            if entry.etag:
+                request.headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                request.headers["If-Modified-Since"] = entry.last_modified
+
+        response = await self.transport.handle_async_request(request)
+
+        if response.status_code == 304 and entry:
+            await response.aclose()
+            self.cache.touch(url)
+            self.cache.stats.revalidated += 1
+            return _cached_response(entry, request, "REVALIDATED")
+
+        self.cache.stats.misses += 1
+        if response.status_code not in (200, 404):
+            return response
+
+        # the body is decoded by now, so it must not be announced as compressed any more
+        content = await response.aread()
+        headers = [
+            (name, value)
+            for name, value in response.headers.multi_items()
+            if name.lower() not in ("content-encoding", "content-length", "transfer-encoding")
+        ]
+        response = httpx.Response(
+            status_code=response.status_code,
+            headers=headers,
+            content=content,
+            extensions=response.extensions,
+            request=request,
+        )
+        self.cache.store(url, response)
+        return response
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
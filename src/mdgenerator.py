@@ -1,15 +1,86 @@
-from jinja2 import Environment, FileSystemLoader
+import functools
+import multiprocessing
+import os
 
-from src.models import CivitaiModel
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+
+from blake3 import blake3
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+from src.models import CivitaiModel, DBAPIModelPage
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), "templates")
+
+
+@functools.cache
+def get_environment() -> Environment:
+    # templates are compiled once per process, the bytecode cache in the temp dir spares that in the next runs
+    return Environment(
+        loader=FileSystemLoader(TEMPLATES_DIR),
+        bytecode_cache=FileSystemBytecodeCache(),
+        auto_reload=False,
+    )
+
+
+@functools.cache
+def templates_hash() -> str:
+    hasher = blake3()
+    for name in sorted(get_environment().list_templates()):
+        with open(os.path.join(TEMPLATES_DIR, name), "rb") as f:
+            hasher.update(f.read())
+    return hasher.hexdigest()
+
+
+def model_page_source(page: DBAPIModelPage) -> str:
+    """Hash of what the page of the model depends on, to skip loading and rendering unchanged ones.
+
+    The templates, when the data of the model last changed and which of its versions have a local file.
+    """
+    hasher = blake3(templates_hash().encode())
+    hasher.update(f"{page.updated_at!r}:{sorted(page.local_versions)}".encode())
+    return hasher.hexdigest()
 
 
 def model_to_markdown(model: CivitaiModel) -> str:
-    env = Environment(loader=FileSystemLoader("src/templates"))
-    template = env.get_template("model.md.j2")
-    return template.render(model=model)
+    return get_environment().get_template("model.md.j2").render(model=model)
+
+
+def models_to_markdown(models: Iterable[CivitaiModel]) -> str:
+    # the template goes through models once, a generator keeps only the current one alive
+    return "".join(get_environment().get_template("index.md.j2").generate(models=models))
+
+
+def _init_worker() -> None:
+    get_environment().get_template("model.md.j2")
+
+
+def _render_chunk(models: list[CivitaiModel]) -> list[str]:
+    return [model_to_markdown(model) for model in models]
+
+
+def render_model_pages(
+    models: list[CivitaiModel],
+    workers: int = 1,
+    chunksize: int = 64,
+) -> Iterator[tuple[CivitaiModel, str]]:
+    """Pages of the models in their order, rendered by worker processes when there are enough of them.
 
+    Workers are started by a fork server, not forked from this process: it runs threads (hashers, tqdm)
+    and a fork could copy a lock one of them holds. Models are pickled to the workers a chunk at a time,
+    which costs about as much as rendering them, so the workers only pay off with several cores.
+    """
+    if workers <= 1 or len(models) <= chunksize:
+        for model in models:
+            yield model, model_to_markdown(model)
+        return
 
-def models_to_markdown(models: list[CivitaiModel]) -> str:
-    env = Environment(loader=FileSystemLoader("src/templates"))
-    template = env.get_template("index.md.j2")
-    return template.render(models=models)
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    chunks = [models[start : start + chunksize] for start in range(0, len(models), chunksize)]
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context(method),
+        initializer=_init_worker,
+    ) as executor:
+        for chunk, pages in zip(chunks, executor.map(_render_chunk, chunks), strict=True):
+            yield from zip(chunk, pages, strict=True)
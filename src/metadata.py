@@ -1,13 +1,50 @@
+import asyncio
+import glob
 import os
+import time
 
+from collections.abc import Iterable, Iterator, Mapping
+from itertools import groupby
+from operator import attrgetter
+from typing import Any
+
+import httpx
 import loguru
 
-from tqdm import tqdm
+from pydantic import ValidationError
+from tqdm.asyncio import tqdm_asyncio
+
+from src.civitai import AsyncCivitai, index_by_hash
+from src.db import BatchWriter, DBApi
+from src.hasher import hash_files
+from src.metrics import metrics
+from src.models import CivitaiModel, CivitaiModelVersion, DBAPIFileHash, DBAPIVersionLink, FileFingerprint
+from src.scanner import FileScanner, ScanResult
+from src.tensorreader import get_corrupted_files
+from src.utils import recursively_find_all_files_by_extension_in_folder
+
+
+def verify_filehashes(db_api: DBApi, files: dict[str, FileFingerprint]) -> dict[str, list[str]]:
+    """Compare stored stat fingerprints with the ones of a full scan without hashing anything."""
+    records = db_api.get_filehashes()
+    drift: dict[str, list[str]] = {"changed": [], "new": [], "unverified": [], "missing": []}
+
+    for path, fingerprint in files.items():
+        record = records.pop(path, None)
+        if not record or not record.filehash:
+            drift["new"].append(path)
+        elif record.fingerprint is None:
+            drift["unverified"].append(path)
+        elif record.fingerprint != fingerprint:
+            drift["changed"].append(path)
 
-from src.civitai import Civitai
-from src.db import DBApi
-from src.models import CivitaiModel, CivitaiModelVersion, DBAPIFileHash
-from src.utils import find_position_by_id, gen_filehash, recursively_find_all_files_by_extension_in_folder
+    drift["missing"] = sorted(records)
+    return drift
+
+
+def _first_match(item: DBAPIFileHash, by_hash: Mapping[str, Any]) -> Any:
+    """What the first of the lookup hashes of the file maps to in by_hash, keyed by upper case hashes."""
+    return next((by_hash[filehash.upper()] for filehash in item.lookup_hashes() if filehash.upper() in by_hash), None)
 
 
 class MetadataManipulator:
@@ -18,11 +55,18 @@ class MetadataManipulator:
         models_path: str,
         loras_path: str,
         work_dir: str,
-        civitai_api: Civitai,
+        civitai_api: AsyncCivitai,
         db_api: DBApi,
         hash_algorithm: str = "blake3",
+        hash_algorithms: list[str] | None = None,
+        hash_workers: int = 4,
+        hash_max_inflight_bytes: int = 4 << 30,
+        integrity_level: str = "header",
         force_calc_hashes: bool = False,
         skip_fetch_metadata: bool = False,
+        scan: ScanResult | None = None,
+        model_batch_size: int = 500,
+        by_hash_batch_size: int = 100,
     ):
         self.csv_file_path = csv_file_path
         self.base_path = base_path
@@ -34,10 +78,21 @@ class MetadataManipulator:
         self.civitai_api = civitai_api
         self.db_api = db_api
         self.hash_algorithm = hash_algorithm
+        # the primary algorithm is always computed, extra digests come along in the same read
+        self.hash_algorithms = list(dict.fromkeys([hash_algorithm, *(hash_algorithms or [])]))
+        self.hash_workers = hash_workers
+        self.hash_max_inflight_bytes = hash_max_inflight_bytes
+        # level of the checks of files that change while watching, a full run checks them before
+        self.integrity_level = integrity_level
         self.force_calc_hashes = force_calc_hashes
         self.skip_fetch_metadata = skip_fetch_metadata
-        self.model_versions: list[CivitaiModelVersion] = []
-        self.models: list[CivitaiModel] = []
+        self.scan = scan or FileScanner(db_api).scan(
+            [os.path.join(base_path, folder) for folder in (models_path, loras_path)],
+        )
+        self.model_batch_size = model_batch_size
+        self.by_hash_batch_size = by_hash_batch_size
+        # models of the local files, loaded from the DB a batch at a time when they're needed
+        self.model_ids: set[int] = set()
         # self.parse_csv()
         # self.inject_filepath()
 
@@ -45,103 +100,297 @@ class MetadataManipulator:
         self.update_model_version_metadata()
 
     def precalc_filehashes(self):
-        old_hashes = self.db_api.get_filehashes()
-        old_filenames = set(old_hashes.keys())
-
+        files: dict[str, FileFingerprint] = {}
         for folder in (self.models_path, self.loras_path):
-            loguru.logger.info(f"Calculating {self.hash_algorithm} for {folder}")
-            paths = recursively_find_all_files_by_extension_in_folder(
-                folder=os.path.join(self.base_path, folder),
-                extension="safetensors",
-            ).values()
-            for path in paths:
-                if path in old_filenames:
-                    old_filenames.remove(path)
-
-                if self.force_calc_hashes or path not in old_hashes or not old_hashes[path].filehash:
-                    self.db_api.update_filehash(path, gen_filehash(path, algorithm=self.hash_algorithm))
-
-        if old_filenames:
-            loguru.logger.warning(f"Files not found: {old_filenames}, removing db records")
-            for path in old_filenames:
-                self.db_api.remove_filehash(path)
+            files.update(self.scan.under(os.path.join(self.base_path, folder)))
+        self._update_filehashes(files, self.db_api.get_filehashes().keys() - files.keys())
 
-    def update_model_version_metadata(self) -> list[DBAPIFileHash]:
-        loguru.logger.info("Fetching model versions by hash")
-        models_not_found = []
-        items = self.db_api.get_filehashes().values()
+    def _update_filehashes(self, files: dict[str, FileFingerprint], removed: Iterable[str]) -> None:
+        old_hashes = self.db_api.get_filehashes()
+        to_hash: list[tuple[str, FileFingerprint]] = []
+
+        # stat-only updates of unchanged files are cheap and many, they're committed in batches
+        with self.db_api.batch() as batch:
+            # the scan stats before hashing, so a file modified while being hashed shows up as changed next time
+            for path, fingerprint in files.items():
+                record = old_hashes.get(path)
+                if self.force_calc_hashes or self._needs_hashing(batch, path, record, fingerprint):
+                    to_hash.append((path, fingerprint))
+
+            removed = set(removed)
+            if removed:
+                loguru.logger.warning(f"Files not found: {removed}, removing db records")
+                for path in removed:
+                    batch.remove_filehash(path)
+
+        loguru.logger.info(f"Calculating {', '.join(self.hash_algorithms)} for {len(to_hash)} files")
+        if not to_hash:
+            return
+        hashed_bytes = 0
+        started = time.perf_counter()
+        # a digest costs a full read of the file, so each one is committed as soon as it is ready
+        with metrics.stage("hash"):
+            for path, fingerprint, digests in hash_files(
+                to_hash,
+                algorithms=self.hash_algorithms,
+                workers=self.hash_workers,
+                max_inflight_bytes=self.hash_max_inflight_bytes,
+            ):
+                self.db_api.update_filehash(path, digests[self.hash_algorithm], fingerprint, digests)
+                hashed_bytes += fingerprint.size
+        metrics.set("hash_bytes_per_second", hashed_bytes / max(time.perf_counter() - started, 1e-9))
+
+    def _needs_hashing(
+        self,
+        batch: BatchWriter,
+        path: str,
+        record: DBAPIFileHash | None,
+        fingerprint: FileFingerprint,
+    ) -> bool:
+        if not record or not record.filehash:
+            return True
+
+        if record.fingerprint is None:
+            # records created before fingerprints existed: trust the stored hash and remember the stat
+            batch.update_fingerprint(path, fingerprint)
+        elif record.fingerprint != fingerprint:
+            loguru.logger.info(f"{path} changed on disk ({record.fingerprint} -> {fingerprint}), rehashing")
+            return True
+
+        # a stored hash without a digest row comes from an older version and was made with HASH_ALGORITHM
+        digests = {self.hash_algorithm: record.filehash, **record.digests}
+        missing = [algorithm for algorithm in self.hash_algorithms if algorithm not in digests]
+        if missing:
+            loguru.logger.info(f"{path} has no {', '.join(missing)} digests yet, rehashing")
+            return True
+
+        if record.filehash != digests[self.hash_algorithm]:
+            # HASH_ALGORITHM was switched and its digest is already known, no need to read the file
+            batch.update_primary_filehash(path, digests[self.hash_algorithm])
+        return False
 
-        for item in items:
-            if not item.modelid or not item.modelversionid:
-                if self.skip_fetch_metadata:
-                    continue
+    def update_model_version_metadata(self) -> list[DBAPIFileHash]:
+        with metrics.stage("fetch"):
+            return asyncio.run(self._update_model_version_metadata())
+
+    async def _find_modelversion(self, api: AsyncCivitai, item: DBAPIFileHash) -> CivitaiModelVersion | None:
+        # fall back from the primary hash to the other stored digests, no file is read again
+        for filehash in item.lookup_hashes():
+            try:
+                modelversion = await api.get_modelversion_by_hash(filehash=filehash)
+            except (httpx.HTTPError, ValidationError) as e:
+                loguru.logger.error(f"Failed to fetch model version by hash {filehash}: {e}")
+                return None
+            if modelversion:
+                return modelversion
+        return None
+
+    async def _find_modelversions(
+        self,
+        api: AsyncCivitai,
+        items: list[DBAPIFileHash],
+    ) -> list[CivitaiModelVersion | None]:
+        """Versions of the files in order, every hash of a batch of files in one request.
+
+        Only the files none of the hashes matched, or whose batch failed, are looked up one hash at a time.
+        """
+        # as they are, so hashes the single lookups cached as not found are recognized
+        filehashes = list(dict.fromkeys(filehash for item in items for filehash in item.lookup_hashes()))
+        batches = [
+            filehashes[start : start + self.by_hash_batch_size]
+            for start in range(0, len(filehashes), self.by_hash_batch_size)
+        ]
+        loguru.logger.info(f"Fetching model versions of {len(items)} files by hash in {len(batches)} requests")
+        by_hash: dict[str, CivitaiModelVersion] = {}
+        for found in await tqdm_asyncio.gather(*(self._find_modelversions_batch(api, batch) for batch in batches)):
+            by_hash.update(found)
+
+        found_versions = [_first_match(item, by_hash) for item in items]
+        misses = [index for index, model_version in enumerate(found_versions) if model_version is None]
+        if misses:
+            loguru.logger.info(f"Fetching model versions of {len(misses)} files one hash at a time")
+            fallback = await tqdm_asyncio.gather(*(self._find_modelversion(api, items[index]) for index in misses))
+            for index, model_version in zip(misses, fallback, strict=True):
+                found_versions[index] = model_version
+        return found_versions
+
+    async def _find_modelversions_batch(
+        self,
+        api: AsyncCivitai,
+        filehashes: list[str],
+    ) -> dict[str, CivitaiModelVersion]:
+        try:
+            return index_by_hash(await api.get_modelversions_by_hashes(filehashes))
+        except (httpx.HTTPError, ValidationError) as e:
+            loguru.logger.error(f"Failed to fetch model versions of {len(filehashes)} hashes: {e}")
+            return {}
+
+    async def _fetch_model(self, api: AsyncCivitai, model_id: int) -> CivitaiModel | None:
+        try:
+            return await api.get_model(model_id=model_id)
+        except (httpx.HTTPError, ValidationError) as e:
+            loguru.logger.error(f"Failed to fetch model {model_id}: {e}")
+            return None
+
+    def _import_json_metadata(self) -> None:
+        # metadata used to live in JSON files next to the models, they're moved into the database once
+        folder = os.path.join(self.base_path, ".civitai-fetcher")
+        if self.db_api.has_model_versions() or not os.path.isdir(folder):
+            return
+
+        # models first, so the versions found by hash keep their own details as before
+        with self.db_api.transaction():
+            for pattern, model_class in (("model-*.json", CivitaiModel), ("modelversion-*.json", CivitaiModelVersion)):
+                paths = sorted(glob.glob(os.path.join(folder, pattern)))
+                loguru.logger.info(f"Importing {len(paths)} {pattern} files into the database")
+                for path in paths:
+                    try:
+                        with open(path) as f:
+                            data = model_class.model_validate_json(f.read())
+                    except (OSError, ValidationError) as e:
+                        loguru.logger.warning(f"Skipping {path}: {e}")
+                        continue
+                    if isinstance(data, CivitaiModel):
+                        self.db_api.upsert_model(data)
+                    elif data.model_id():
+                        self.db_api.upsert_model_version(data)
+
+    async def _update_model_version_metadata(self) -> list[DBAPIFileHash]:
+        self._import_json_metadata()
+
+        async with self.civitai_api as api:
+            models_not_found = await self._resolve(api, list(self.db_api.get_filehashes().values()))
+
+            model_ids = {item.modelid for item in self.db_api.get_filehashes().values() if item.modelid}
+            fetched_model_ids = self.db_api.get_fetched_model_ids()
+            await self._fetch_models(
+                api,
+                [
+                    model_id
+                    for model_id in model_ids
+                    if not self.skip_fetch_metadata or model_id not in fetched_model_ids
+                ],
+            )
+
+        models_not_found = self._resolve_locally(models_not_found)
+        self.model_ids = {item.modelid for item in self.db_api.get_filehashes().values() if item.modelid}
+        return models_not_found
 
-                modelversion = self.civitai_api.get_modelversion_by_hash(filehash=item.filehash)
+    def sync_files(self, changed: dict[str, FileFingerprint], removed: Iterable[str]) -> set[int]:
+        """Check, hash and look up files that changed on disk, returns the ids of the models they belong to."""
+        with metrics.stage("integrity"):
+            # keeps integrity_checks and safetensors_headers as current as a full run would
+            get_corrupted_files(self.base_path, changed, self.db_api, self.integrity_level, self.hash_workers)
+        with metrics.stage("sync"):
+            return asyncio.run(self._sync_files(changed, removed))
+
+    async def _sync_files(self, changed: dict[str, FileFingerprint], removed: Iterable[str]) -> set[int]:
+        records = self.db_api.get_filehashes()
+        affected = {
+            record.modelid
+            for record in (records[path] for path in [*changed, *removed] if path in records)
+            if record.modelid is not None
+        }
+
+        self._update_filehashes(changed, removed)
+        records = self.db_api.get_filehashes()
+        items = [records[path] for path in changed if path in records]
+
+        async with self.civitai_api as api:
+            not_found = await self._resolve(api, items)
+            records = self.db_api.get_filehashes()
+            # a new file of a model already fetched was bound locally, only new models are worth a request
+            model_ids = {
+                record.modelid for record in (records[item.filepath] for item in items) if record.modelid is not None
+            }
+            await self._fetch_models(api, list(model_ids - self.db_api.get_fetched_model_ids()))
+        self._resolve_locally(not_found)
+
+        records = self.db_api.get_filehashes()
+        affected |= {
+            record.modelid for record in (records[item.filepath] for item in items) if record.modelid is not None
+        }
+
+        # models without local files any more drop out of the catalog
+        local_model_ids = {record.modelid for record in records.values()}
+        self.model_ids = (self.model_ids - affected) | (affected & local_model_ids)
+        return affected
+
+    async def _resolve(self, api: AsyncCivitai, items: list[DBAPIFileHash]) -> list[DBAPIFileHash]:
+        """Bind files to their model versions, returns the ones nothing was found for."""
+        known_versions = self.db_api.get_model_version_ids()
+        items = [item for item in items if not item.modelid or item.modelversionid not in known_versions]
+        # any version of an already fetched model is known with its file hashes, no request needed
+        known_hashes = self.db_api.find_model_versions_by_hashes(
+            filehash for item in items for filehash in item.lookup_hashes()
+        )
+        unresolved = []
+        models_not_found = []
+        with self.db_api.transaction():
+            for item in items:
+                found = _first_match(item, known_hashes)
+                if found:
+                    self.db_api.update_data(filepath=item.filepath, model_id=found[0], model_version_id=found[1])
+                elif not self.skip_fetch_metadata:
+                    unresolved.append(item)
+
+        found_versions = await self._find_modelversions(api, unresolved)
+
+        with self.db_api.transaction():
+            for item, modelversion in zip(unresolved, found_versions, strict=True):
                 if not modelversion:
                     models_not_found.append(item)
                     loguru.logger.warning(f"Model not found: {item.filehash} for {item.filepath}")
                     continue
 
-                if modelversion.modelId:
+                model_id = modelversion.model_id()
+                if model_id:
+                    self.db_api.upsert_model_version(modelversion)
                     self.db_api.update_data(
                         filepath=item.filepath,
-                        model_id=modelversion.modelId,
+                        model_id=model_id,
                         model_version_id=modelversion.id,
                     )
+        return models_not_found
 
-                metafilename = f"{self.base_path}/.civitai-fetcher/modelversion-{modelversion.id}.json"
-
-                with open(metafilename, "w") as f:
-                    f.write(modelversion.model_dump_json(indent=4))
-            else:
-                metafilename = f"{self.base_path}/.civitai-fetcher/modelversion-{item.modelversionid}.json"
-                with open(metafilename) as f:
-                    modelversion = CivitaiModelVersion.model_validate_json(f.read())
-
-            self.model_versions.append(modelversion)
-
-        model_ids = {x.modelid for x in self.db_api.get_filehashes().values() if x.modelid}
+    async def _fetch_models(self, api: AsyncCivitai, model_ids: list[int]) -> None:
         loguru.logger.info(f"Fetching {len(model_ids)} models by id")
-        with tqdm(total=len(model_ids), initial=0) as progress:
-            fetched_model_ids = set()
-            for model_id in model_ids:
-                progress.update(1)
+        fetched = await tqdm_asyncio.gather(*(self._fetch_model(api, model_id) for model_id in model_ids))
 
-                metafilename = f"{self.base_path}/.civitai-fetcher/model-{model_id}.json"
+        with self.db_api.transaction():
+            for model_id, model in zip(model_ids, fetched, strict=True):
+                if not model:
+                    loguru.logger.warning(f"Model not found: {model_id}")
+                    continue
+                self.db_api.upsert_model(model)
 
-                if os.path.exists(metafilename) and (self.skip_fetch_metadata or model_id in fetched_model_ids):
-                    with open(metafilename) as f:
-                        model = CivitaiModel.model_validate_json(f.read())
+    def _resolve_locally(self, items: list[DBAPIFileHash]) -> list[DBAPIFileHash]:
+        # the models just fetched may list a version the by-hash lookup missed
+        models_not_found = []
+        known_hashes = self.db_api.find_model_versions_by_hashes(
+            filehash for item in items for filehash in item.lookup_hashes()
+        )
+        with self.db_api.transaction():
+            for item in items:
+                found = _first_match(item, known_hashes)
+                if found:
+                    self.db_api.update_data(filepath=item.filepath, model_id=found[0], model_version_id=found[1])
                 else:
-                    model = self.civitai_api.get_model(model_id=model_id)
-                    if not model:
-                        loguru.logger.warning(f"Model not found: {model_id}")
-                        continue
-
-                    fetched_model_ids.add(model_id)
-
-                    with open(metafilename, "w") as f:
-                        f.write(model.model_dump_json(indent=4))
-                # if model.id == 573152:
-                #     import ipdb
-
-                #     ipdb.set_trace()
-                for mv in self.model_versions:
-                    if mv.modelId == model_id:
-                        # mv.model = model
-                        for idx, mv2 in enumerate(model.modelVersions):
-                            if not model.modelVersions[idx].modelId:
-                                model.modelVersions[idx].modelId = model_id
-
-                            if mv2.id == mv.id:
-                                mv.index = mv2.index
-                                model.modelVersions[idx] = mv
-                                model.modelVersions[idx]._exists = True
-
-                self.models.append(model)
-
+                    models_not_found.append(item)
         return models_not_found
 
+    def iter_models(self, model_ids: Iterable[int] | None = None, images: bool = True) -> Iterator[CivitaiModel]:
+        """Models of the local files (or model_ids) in id order, model_batch_size of them in memory at a time."""
+        local_versions = {item.modelversionid for item in self.db_api.get_filehashes().values() if item.modelversionid}
+        for model in self.db_api.iter_models(
+            self.model_ids if model_ids is None else model_ids,
+            images=images,
+            chunk_size=self.model_batch_size,
+        ):
+            for mv in model.modelVersions:
+                mv._exists = mv.id in local_versions
+            yield model
+
     def list_models_with_versions(self) -> list[CivitaiModel]:
         # models: dict[int, CivitaiModel] = {}
 
@@ -158,7 +407,7 @@ class MetadataManipulator:
         #             mv2._exists = True
         #             break
 
-        return self.models
+        return list(self.iter_models())
 
     # def parse_csv(self):
     #     with open(self.csv_file_path) as f:
@@ -171,55 +420,20 @@ class MetadataManipulator:
         for model in self.modelmeta:
             model.filepath = paths.get(f"{model.model_name}.safetensors", None)
 
-    def find_new_versions(self):
-        for mv in self.model_versions:
-            if not mv.model or not mv.model.modelVersions:
-                continue
+    def find_new_versions(self, base_model: str | None = None, model_type: str | None = None):
+        self._log_version_links("New version", self.db_api.find_newer_versions(base_model, model_type))
 
-            position_in_model_versions = find_position_by_id(mv.model.modelVersions, "id", mv.id)
-            if position_in_model_versions == 0:
-                continue
+    def find_inpaint_versions(self, base_model: str | None = None, model_type: str | None = None):
+        self._log_version_links("Inpaint version", self.db_api.find_inpaint_versions(base_model, model_type))
 
-            new_versions = [
-                new_model
-                for new_model in mv.model.modelVersions[:position_in_model_versions]
-                if new_model.baseModel == mv.baseModel and new_model.baseModelType == mv.baseModelType
-            ]
-            if not new_versions:
-                continue
+    def _log_version_links(self, title: str, links: list[DBAPIVersionLink]):
+        for _, group in groupby(links, key=attrgetter("modelversionid")):
+            group_links = list(group)
+            mv = group_links[0]
+            loguru.logger.info(f"{mv.model_name}@{mv.version_name}. [{mv.base_model}, {mv.base_model_type}] {mv.url()}")
 
-            print(f"{mv.model.name}@{mv.name}. [{mv.baseModel}, {mv.baseModelType}] {mv.url()}")
-
-            for new_model in new_versions:
-                print(
-                    f"\tNew version: {new_model.id} @{new_model.name} [{new_model.baseModel}, {new_model.baseModelType}]",
-                )
-                # for file in new_model.files:
-                #     print(
-                #         f"\t\t{file.name} {file.sizeKB} {file.metadata.format} {file.metadata.fp} {file.metadata.size} {file.downloadUrl}",
-                #     )
-
-    def find_inpaint_versions(self):
-        for mv in self.model_versions:
-            if not mv.model or not mv.model.modelVersions or mv.baseModelType == "Inpainting":
-                continue
-
-            inpaint_versions = [
-                new_model
-                for new_model in mv.model.modelVersions
-                if new_model.baseModel == mv.baseModel and new_model.baseModelType == "Inpainting"
-            ]
-
-            if not inpaint_versions:
-                continue
-
-            print(f"{mv.model.name}@{mv.name}. [{mv.baseModel}, {mv.baseModelType}] {mv.url()}")
-
-            for new_model in inpaint_versions:
-                print(
-                    f"\tInpaint version: {new_model.id} @{new_model.name} [{new_model.baseModel}, {new_model.baseModelType}]",
+            for link in group_links:
+                loguru.logger.info(
+                    f"\t{title}: {link.other_modelversionid} @{link.other_version_name} "
+                    f"[{mv.base_model}, {link.other_base_model_type}]",
                 )
-                # for file in new_model.files:
-                #     print(
-                #         f"\t\t{file.name} {file.sizeKB} {file.metadata.format} {file.metadata.fp} {file.metadata.size} {file.downloadUrl}",
-                #     )
@@ -0,0 +1,154 @@
+import bisect
+import json
+import os
+import re
+import threading
+import time
+
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+
+from pydantic import BaseModel
+
+# seconds, from a cached API response to a slow download of a model page
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# seconds to hash a file, from a small embedding to a large checkpoint on a slow disk
+HASH_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+PROMETHEUS_PREFIX = "civitai_fetcher"
+
+
+class Histogram(BaseModel):
+    buckets: list[float]
+    counts: list[int]  # per bucket, not cumulative, the last one is +Inf
+    sum: float = 0.0
+    count: int = 0
+
+    @classmethod
+    def of(cls, buckets: tuple[float, ...]) -> "Histogram":
+        return cls(buckets=list(buckets), counts=[0] * (len(buckets) + 1))
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Stage timers, counters, gauges and histograms of a run, reported as JSON and as a Prometheus textfile.
+
+    Stages add up, so one run several times (watch mode) reports the total. Stats objects other parts
+    already keep, like RateLimiter.stats, are registered with collect() and read when the report is made.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.stages: dict[str, float] = {}
+        self.counters: dict[str, float] = {}
+        self.gauges: dict[str, float] = {}
+        self.histograms: dict[str, Histogram] = {}
+        self.collectors: dict[str, Callable[[], BaseModel]] = {}
+
+    def count(self, name: str, value: float = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name: str, value: float) -> None:
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name: str, value: float, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        with self.lock:
+            self.histograms.setdefault(name, Histogram.of(buckets)).observe(value)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0.0) + elapsed
+
+    def collect(self, prefix: str, stats: Callable[[], BaseModel]) -> None:
+        """Report the fields of stats() as counters named prefix_field."""
+        self.collectors[prefix] = stats
+
+    def report(self) -> dict:
+        with self.lock:
+            counters = dict(self.counters)
+            for prefix, stats in self.collectors.items():
+                counters.update({f"{prefix}_{name}": value for name, value in stats().model_dump().items()})
+            return {
+                "started_at": self.started_at,
+                "duration": time.time() - self.started_at,
+                "stages": dict(self.stages),
+                "counters": counters,
+                "gauges": dict(self.gauges),
+                "histograms": {name: histogram.model_dump() for name, histogram in self.histograms.items()},
+            }
+
+    def summary(self) -> str:
+        return ", ".join(f"{name} {seconds:.1f}s" for name, seconds in self.stages.items())
+
+    def write_json(self, path: str) -> None:
+        _write_atomically(path, json.dumps(self.report(), indent=2))
+
+    def write_prometheus(self, path: str) -> None:
+        """For the textfile collector of node_exporter, which may read the file at any time."""
+        _write_atomically(path, to_prometheus(self.report()))
+
+
+def _metric_name(name: str) -> str:
+    return f"{PROMETHEUS_PREFIX}_{re.sub(r'[^a-zA-Z0-9_]', '_', name)}"
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def to_prometheus(report: dict) -> str:
+    lines = [
+        f"# TYPE {_metric_name('run_start_time_seconds')} gauge",
+        f"{_metric_name('run_start_time_seconds')} {_format_value(report['started_at'])}",
+        f"# TYPE {_metric_name('run_duration_seconds')} gauge",
+        f"{_metric_name('run_duration_seconds')} {_format_value(report['duration'])}",
+        f"# TYPE {_metric_name('stage_duration_seconds')} gauge",
+    ]
+    lines.extend(
+        f'{_metric_name("stage_duration_seconds")}{{stage="{stage}"}} {_format_value(seconds)}'
+        for stage, seconds in report["stages"].items()
+    )
+    for name, value in sorted(report["counters"].items()):
+        lines.append(f"# TYPE {_metric_name(name)}_total counter")
+        lines.append(f"{_metric_name(name)}_total {_format_value(value)}")
+    for name, value in sorted(report["gauges"].items()):
+        lines.append(f"# TYPE {_metric_name(name)} gauge")
+        lines.append(f"{_metric_name(name)} {_format_value(value)}")
+    for name, histogram in sorted(report["histograms"].items()):
+        metric = _metric_name(name)
+        lines.append(f"# TYPE {metric} histogram")
+        cumulative = 0
+        for bucket, count in zip([*histogram["buckets"], "+Inf"], histogram["counts"], strict=True):
+            cumulative += count
+            lines.append(f'{metric}_bucket{{le="{bucket}"}} {cumulative}')
+        lines.append(f"{metric}_sum {_format_value(histogram['sum'])}")
+        lines.append(f"{metric}_count {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def _write_atomically(path: str, content: str) -> None:
+    # readers see the previous report or the new one, never half of it
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+# one registry per process, the hot paths report to it without it being passed around
+metrics = Metrics()
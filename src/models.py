@@ -1,22 +1,73 @@
-from itertools import groupby
-from operator import itemgetter
+import math
+import os
+
+from collections.abc import Iterable
 from typing import Any, Union
 
+import numpy as np
+
 from pydantic import BaseModel
 from pydantic_settings import BaseSettings
 
-from src.utils import aggregate_min_max
+from src.utils import grouped_stats
+
+# CRC32 is too short to identify a model reliably, so it's never used for lookups
+HASH_LOOKUP_ORDER = ("blake3", "sha256", "autov2")
 
 
 class Settings(BaseSettings):
     CIVITAI_API_BASE_URL: str
     CIVITAI_API_TOKEN: str
+    CIVITAI_MAX_CONNECTIONS: int = 16
+    # requests in flight per host
+    CIVITAI_MAX_CONCURRENCY: int = 8
+    # requests per second, halved on every 429 and slowly raised back
+    CIVITAI_RATE_LIMIT: float = 5.0
+    CIVITAI_MAX_RETRIES: int = 5
+    # seconds a cached response is used without asking the API, then it's revalidated with ETag/Last-Modified
+    CIVITAI_CACHE_TTL_MODEL: int = 24 * 60 * 60
+    CIVITAI_CACHE_TTL_BY_HASH: int = 7 * 24 * 60 * 60
+    CIVITAI_CACHE_TTL_NOT_FOUND: int = 24 * 60 * 60
+    # hashes per POST /model-versions/by-hash, the API takes up to 100
+    CIVITAI_BY_HASH_BATCH_SIZE: int = 100
+    DOWNLOAD_CONCURRENCY: int = 2
+    DOWNLOAD_SEGMENTS: int = 4
+    # bytes per second for all downloads together, 0 is unlimited
+    DOWNLOAD_BANDWIDTH_LIMIT: int = 0
     MODEL_LIST_FILE: str
     BASE_PATH: str
     WORK_DIR: str
     MODELS_PATH: str
     LORAS_PATH: str
     HASH_ALGORITHM: str = "blake3"
+    # digests computed in the same read as HASH_ALGORITHM and kept for lookups
+    HASH_ALGORITHMS: list[str] = ["blake3", "sha256", "autov2", "crc32"]
+    HASH_WORKERS: int = 4
+    # total size of the files hashed at once; they're memory-mapped, so it bounds concurrent reads, not memory
+    HASH_MAX_INFLIGHT_BYTES: int = 4 << 30
+    # WAL doesn't work on network filesystems, use DELETE if WORK_DIR is on one
+    DB_JOURNAL_MODE: str = "WAL"
+    # seconds between commits of batched writes, the most work an interrupted run can lose
+    DB_FLUSH_INTERVAL: float = 5.0
+    # seconds a file has to stay unchanged before the watch mode picks it up
+    WATCH_DEBOUNCE: float = 5.0
+    # rescan interval when inotify isn't available
+    WATCH_POLL_INTERVAL: float = 60.0
+    # header, sample or full, see tensorreader.INTEGRITY_LEVELS
+    INTEGRITY_CHECK_LEVEL: str = "header"
+    # processes rendering model pages, only faster than rendering in this one with several free cores
+    RENDER_WORKERS: int = 1
+    # models loaded from the DB and rendered at a time, bounds memory whatever the size of the library
+    MODEL_BATCH_SIZE: int = 500
+    # let mkdocs rebuild only the pages that changed, faster but the navigation of the others can get stale
+    SITE_DIRTY_BUILD: bool = False
+    # write search.json with the trigger words of every local version next to the pages, for a client-side search
+    SITE_SEARCH_JSON: bool = False
+    # JSON report of the stage timings and counters of each run, relative to WORK_DIR;
+    # mkdocs.yml keeps it out of the site by name, change exclude_docs there along with it
+    METRICS_REPORT_FILE: str = "metrics.json"
+    # the same as a Prometheus textfile, e.g. in the --collector.textfile.directory of node_exporter
+    METRICS_TEXTFILE: str | None = None
 
 
 class CivitaiFileMetadata(BaseModel):
@@ -95,6 +146,7 @@ class CivitaiModelVersion(BaseModel):
     images: list[CivitaiImage] | None = None
 
     _exists: bool = False
+    _stats: "GenerationStats | None" = None
 
     def model_id(self) -> int | None:
         return self.modelId or (self.model.id if self.model else None)
@@ -103,29 +155,145 @@ class CivitaiModelVersion(BaseModel):
         model_id = self.model_id()
         return f"https://civitai.com/models/{model_id}?modelVersionId={self.id}" if model_id else None
 
-    def get_meta(self):
-        elements = [x.meta for x in self.images if x.hasMeta and x.meta.get("sampler")]
-        for element in elements:
-            sampler_full = element.get("sampler")
-            if element.get("Schedule type"):
-                sampler_full = f"{sampler_full} {element.get('Schedule type')}"
-            element["sampler_full"] = sampler_full
-
-        elements.sort(key=itemgetter("sampler_full"))
-
-        result = {}
-        for sampler, sampler_group in groupby(elements, key=itemgetter("sampler_full")):
-            sampler_grou_list = list(sampler_group)
-            result[sampler] = aggregate_min_max(sampler_grou_list)
-        return result
+    def generation_stats(self) -> "GenerationStats":
+        if self._stats is None:
+            self._stats = compute_generation_stats([self])[self.id]
+        return self._stats
 
 
 class CivitaiModel(CivitaiShortModel):
     id: int
     description: str | None = None
+    tags: list[str] | None = None
     modelVersions: list[CivitaiModelVersion]
 
 
+class SamplerStats(BaseModel):
+    images: int
+    cfgScale: list[int | float]  # min, max
+    steps: list[int | float]
+    cfgScale_percentiles: list[int | float]  # GENERATION_PERCENTILES
+    steps_percentiles: list[int | float]
+
+
+class GenerationStats(BaseModel):
+    """What the example images of a version were generated with."""
+
+    samplers: dict[str, SamplerStats] = {}
+    resolution: str | None = None  # the most common one
+    scheduler: str | None = None
+
+
+GENERATION_PERCENTILES = (25, 50, 75)
+
+
+def _plain(number: float) -> int | float:
+    # 7.0 is shown as 7, as CivitAI sends it
+    return int(number) if number.is_integer() else number
+
+
+def _to_floats(values: list[Any]) -> np.ndarray:
+    try:
+        # None becomes nan
+        return np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        return np.array([_to_float(value) for value in values], dtype=np.float64)
+
+
+def _to_float(value: Any) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def _encode(values: list[str]) -> tuple[list[str], np.ndarray]:
+    """Distinct values in alphabetical order and the index of each value among them."""
+    names = sorted(set(values))
+    codes = {name: code for code, name in enumerate(names)}
+    return names, np.array([codes[value] for value in values], dtype=np.int64)
+
+
+def _most_common(owners: np.ndarray, values: list[str]) -> dict[int, str]:
+    """The most frequent value of each owner, ties go to the alphabetically first one."""
+    if not values:
+        return {}
+    names, codes = _encode(values)
+    pairs, counts = np.unique(owners * len(names) + codes, return_counts=True)
+    pair_owners = pairs // len(names)
+    order = np.lexsort((-counts, pair_owners))
+    first = np.unique(pair_owners[order], return_index=True)[1]
+    return {int(pairs[i] // len(names)): names[pairs[i] % len(names)] for i in order[first]}
+
+
+def compute_generation_stats(model_versions: Iterable[CivitaiModelVersion]) -> dict[int, GenerationStats]:
+    """Stats of many versions at once: a column per parameter, aggregated per (version, sampler) by numpy."""
+    model_version_ids = []
+    rows = []
+    for index, model_version in enumerate(model_versions):
+        model_version_ids.append(model_version.id)
+        for image in model_version.images or ():
+            meta = image.meta
+            if not image.hasMeta or not meta or not meta.get("sampler"):
+                continue
+            rows.append(
+                (
+                    index,
+                    meta["sampler"],
+                    meta.get("Schedule type"),
+                    meta.get("Size") or f"{image.width}x{image.height}",
+                    meta.get("cfgScale"),
+                    meta.get("steps"),
+                ),
+            )
+
+    columns = [list(column) for column in zip(*rows, strict=True)] or [[] for _ in range(6)]
+    owners, samplers, schedulers, resolutions, cfg_scales, steps = columns
+    owners_array = np.array(owners, dtype=np.int64)
+    with_scheduler = [i for i, scheduler in enumerate(schedulers) if scheduler]
+    common_resolutions = _most_common(owners_array, resolutions)
+    common_schedulers = _most_common(owners_array[with_scheduler], [schedulers[i] for i in with_scheduler])
+    # the data is built here, validating it again would take longer than computing it
+    stats = {
+        model_version_id: GenerationStats.model_construct(
+            samplers={},
+            resolution=common_resolutions.get(index),
+            scheduler=common_schedulers.get(index),
+        )
+        for index, model_version_id in enumerate(model_version_ids)
+    }
+
+    # images without cfgScale or steps don't take part
+    cfg_array, steps_array = _to_floats(cfg_scales), _to_floats(steps)
+    complete = ~(np.isnan(cfg_array) | np.isnan(steps_array))
+    if not complete.any():
+        return stats
+    sampler_names = [
+        f"{sampler} {scheduler}" if scheduler else sampler
+        for sampler, scheduler, is_complete in zip(samplers, schedulers, complete, strict=True)
+        if is_complete
+    ]
+    names, codes = _encode(sampler_names)
+    # sorted by version, then by sampler name: the order the pages list samplers in
+    groups = owners_array[complete] * len(names) + codes
+    keys, counts = np.unique(groups, return_counts=True)
+    cfg_min, cfg_max, cfg_percentiles = (
+        column.tolist() for column in grouped_stats(groups, cfg_array[complete], GENERATION_PERCENTILES)[1:]
+    )
+    steps_min, steps_max, steps_percentiles = (
+        column.tolist() for column in grouped_stats(groups, steps_array[complete], GENERATION_PERCENTILES)[1:]
+    )
+    for i, (key, count) in enumerate(zip(keys.tolist(), counts.tolist(), strict=True)):
+        stats[model_version_ids[key // len(names)]].samplers[names[key % len(names)]] = SamplerStats.model_construct(
+            images=count,
+            cfgScale=[_plain(cfg_min[i]), _plain(cfg_max[i])],
+            steps=[_plain(steps_min[i]), _plain(steps_max[i])],
+            cfgScale_percentiles=[_plain(value) for value in cfg_percentiles[i]],
+            steps_percentiles=[_plain(value) for value in steps_percentiles[i]],
+        )
+    return stats
+
+
 # class CivitaiResponseMetadata(BaseModel):
 #     nextCursor: str | None = None
 #     currentPage: int | None = None
@@ -162,8 +330,149 @@ class CivitaiModel(CivitaiShortModel):
 #     )
 
 
+class FileFingerprint(BaseModel):
+    size: int
+    mtime_ns: int
+    inode: int
+
+    @classmethod
+    def from_path(cls, path: str) -> "FileFingerprint":
+        stat = os.stat(path)
+        return cls(size=stat.st_size, mtime_ns=stat.st_mtime_ns, inode=stat.st_ino)
+
+
 class DBAPIFileHash(BaseModel):
     filepath: str
     filehash: str | None = None
     modelid: int | None = None
     modelversionid: int | None = None
+    size: int | None = None
+    mtime_ns: int | None = None
+    inode: int | None = None
+    digests: dict[str, str] = {}
+
+    @property
+    def fingerprint(self) -> FileFingerprint | None:
+        if self.size is None or self.mtime_ns is None or self.inode is None:
+            return None
+        return FileFingerprint(size=self.size, mtime_ns=self.mtime_ns, inode=self.inode)
+
+    def lookup_hashes(self) -> list[str]:
+        """Hashes to try against CivitAI, most specific first."""
+        hashes = [self.filehash, *(self.digests.get(algorithm) for algorithm in HASH_LOOKUP_ORDER)]
+        return list(dict.fromkeys(filehash for filehash in hashes if filehash))
+
+
+class DBAPIScanDir(BaseModel):
+    path: str
+    mtime_ns: int | None = None  # None when it was too recent to be trusted
+    subdirs: list[str] = []
+
+
+class DBAPIIntegrityCheck(BaseModel):
+    path: str
+    size: int | None = None
+    mtime_ns: int | None = None
+    inode: int | None = None
+    error: str | None = None
+    sample_checksum: str | None = None
+    full_checksum: str | None = None
+    checked_at: float | None = None
+
+    @property
+    def fingerprint(self) -> FileFingerprint | None:
+        if self.size is None or self.mtime_ns is None or self.inode is None:
+            return None
+        return FileFingerprint(size=self.size, mtime_ns=self.mtime_ns, inode=self.inode)
+
+
+class DBAPISafetensorsHeader(BaseModel):
+    path: str
+    size: int
+    mtime_ns: int
+    inode: int
+    tensor_count: int
+    parameter_count: int
+    dtypes: dict[str, int]  # tensors per dtype
+    metadata: dict[str, str]  # selected __metadata__ keys
+    architecture: str | None = None  # SD 1.5, SD 2, SDXL, SD 3, Flux
+    rank: int | None = None  # LoRA rank
+
+    @property
+    def fingerprint(self) -> FileFingerprint:
+        return FileFingerprint(size=self.size, mtime_ns=self.mtime_ns, inode=self.inode)
+
+
+class DBAPIHttpCacheEntry(BaseModel):
+    url: str
+    status: int
+    etag: str | None = None
+    last_modified: str | None = None
+    body: bytes
+    fetched_at: float
+
+
+class DBAPIModelPage(BaseModel):
+    """What the page of a model is rendered from, as far as telling whether it changed goes."""
+
+    modelid: int
+    model_type: str | None = None
+    updated_at: float | None = None  # when the model's data last changed
+    local_versions: list[int] = []  # versions with a local file
+
+
+class DBAPISiteBuild(BaseModel):
+    work_dir: str
+    site_dir: str
+    state: str  # hash of mkdocs.yml and of every page the site was built from
+    built_at: float
+
+
+class DBAPIDownload(BaseModel):
+    id: int
+    modelid: int | None = None
+    modelversionid: int | None = None
+    fileid: int | None = None
+    url: str
+    outdir: str
+    hashes: CivitaiHashes | None = None
+    size: int | None = None
+    priority: int = 0
+    status: str = "pending"  # enum (pending, active, done, failed)
+    error: str | None = None
+    filepath: str | None = None
+
+
+class DBAPIVersionLink(BaseModel):
+    """A version with a local file and another version of the same model related to it."""
+
+    modelid: int
+    model_name: str | None = None
+    model_type: str | None = None
+    modelversionid: int
+    version_name: str
+    base_model: str
+    base_model_type: str | None = None
+    other_modelversionid: int
+    other_version_name: str
+    other_base_model_type: str | None = None
+
+    def url(self) -> str:
+        return f"https://civitai.com/models/{self.modelid}?modelVersionId={self.modelversionid}"
+
+
+class DBAPISearchHit(BaseModel):
+    """A model version matching a full-text search, best first."""
+
+    modelid: int
+    model_name: str | None = None
+    model_type: str | None = None
+    modelversionid: int
+    version_name: str
+    base_model: str
+    trained_words: list[str] = []
+    filepath: str | None = None  # a local file of the version
+    rank: float = 0.0
+
+    def url(self) -> str:
+        return f"https://civitai.com/models/{self.modelid}?modelVersionId={self.modelversionid}"
@@ -0,0 +1,274 @@
+import asyncio
+import email.utils
+import random
+import threading
+import time
+
+from collections.abc import AsyncIterator, Callable, Iterator
+from datetime import UTC, datetime
+
+import httpx
+import loguru
+
+from pydantic import BaseModel
+
+from src.metrics import metrics
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class RateLimitStats(BaseModel):
+    requests: int = 0
+    retries: int = 0
+    throttled_responses: int = 0
+    throttled_seconds: float = 0.0
+    errors: int = 0
+
+
+class TokenBucket:
+    """Thread-safe token bucket with additive-increase/multiplicative-decrease of the rate.
+
+    reserve() takes a token right away and returns how long the caller has to wait for it, so the same
+    bucket paces both threads (time.sleep) and coroutines (asyncio.sleep).
+    """
+
+    def __init__(self, rate: float, burst: float | None = None, min_rate: float = 0.5, increase: float = 0.1):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.increase = increase
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= tokens
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def slow_down(self) -> None:
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+
+    def speed_up(self) -> None:
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+class RetryPolicy:
+    def __init__(self, max_retries: int = 5, backoff_base: float = 0.5, backoff_max: float = 60.0):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def should_retry(self, attempt: int, response: httpx.Response | None = None) -> bool:
+        if attempt >= self.max_retries:
+            return False
+        return response is None or response.status_code in RETRY_STATUS_CODES
+
+    def delay(self, attempt: int, response: httpx.Response | None = None) -> float:
+        retry_after = parse_retry_after(response.headers.get("Retry-After")) if response is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        # exponential backoff with full jitter
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))  # noqa: S311
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=UTC)
+    return max(0.0, (retry_at - datetime.now(UTC)).total_seconds())
+
+
+class RateLimiter:
+    """Pacing, retry policy, per-host concurrency cap and counters shared by all Civitai clients."""
+
+    def __init__(
+        self,
+        rate: float = 5.0,
+        max_per_host: int = 8,
+        retry_policy: RetryPolicy | None = None,
+    ):
+        self.bucket = TokenBucket(rate)
+        self.max_per_host = max_per_host
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.stats = RateLimitStats()
+        self.stats_lock = threading.Lock()
+        self.host_semaphores: dict[str, threading.BoundedSemaphore] = {}
+
+    def count(self, **increments: float) -> None:
+        with self.stats_lock:
+            for name, value in increments.items():
+                setattr(self.stats, name, getattr(self.stats, name) + value)
+
+    def host_semaphore(self, host: str) -> threading.BoundedSemaphore:
+        with self.stats_lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self.host_semaphores[host]
+
+    def on_response(self, response: httpx.Response) -> None:
+        if response.status_code == 429:
+            self.bucket.slow_down()
+            self.count(throttled_responses=1)
+            loguru.logger.warning(f"Throttled by {response.request.url.host}, rate is now {self.bucket.rate:.2f}/s")
+        elif response.status_code < 500:
+            self.bucket.speed_up()
+
+
+class _ReleasingStream(httpx.SyncByteStream, httpx.AsyncByteStream):
+    """Response body that gives the per-host slot back once the body is closed."""
+
+    def __init__(self, stream: httpx.SyncByteStream | httpx.AsyncByteStream, release: Callable[[], None]):
+        self.stream = stream
+        self.release = release
+        self.released = False
+
+    def _release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.release()
+
+    def __iter__(self) -> Iterator[bytes]:
+        yield from self.stream  # type: ignore[misc]
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self.stream:  # type: ignore[union-attr]
+            yield chunk
+
+    def close(self) -> None:
+        try:
+            self.stream.close()  # type: ignore[union-attr]
+        finally:
+            self._release()
+
+    async def aclose(self) -> None:
+        try:
+            await self.stream.aclose()  # type: ignore[union-attr]
+        finally:
+            self._release()
+
+
+def _wrap_response(response: httpx.Response, request: httpx.Request, release: Callable[[], None]) -> httpx.Response:
+    return httpx.Response(
+        status_code=response.status_code,
+        headers=response.headers,
+        stream=_ReleasingStream(response.stream, release),
+        extensions=response.extensions,
+        request=request,
+    )
+
+
+class RateLimitedTransport(httpx.BaseTransport):
+    def __init__(self, limiter: RateLimiter, transport: httpx.BaseTransport | None = None):
+        self.limiter = limiter
+        self.transport = transport or httpx.HTTPTransport()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        policy = self.limiter.retry_policy
+        semaphore = self.limiter.host_semaphore(request.url.host)
+        attempt = 0
+        while True:
+            wait = self.limiter.bucket.reserve()
+            if wait:
+                self.limiter.count(throttled_seconds=wait)
+                time.sleep(wait)
+
+            semaphore.acquire()
+            self.limiter.count(requests=1)
+            started = time.perf_counter()
+            try:
+                response = self.transport.handle_request(request)
+                metrics.observe("civitai_request_seconds", time.perf_counter() - started)
+            except httpx.TransportError:
+                semaphore.release()
+                self.limiter.count(errors=1)
+                if not policy.should_retry(attempt):
+                    raise
+                response = None
+            except BaseException:
+                semaphore.release()
+                raise
+
+            if response is not None:
+                response.request = request
+                self.limiter.on_response(response)
+                if not policy.should_retry(attempt, response):
+                    return _wrap_response(response, request, semaphore.release)
+                response.close()
+                semaphore.release()
+
+            delay = policy.delay(attempt, response)
+            self.limiter.count(retries=1, throttled_seconds=delay)
+            loguru.logger.info(f"Retrying {request.method} {request.url} in {delay:.1f}s (attempt {attempt + 1})")
+            time.sleep(delay)
+            attempt += 1
+
+    def close(self) -> None:
+        self.transport.close()
+
+
+class AsyncRateLimitedTransport(httpx.AsyncBaseTransport):
+    def __init__(self, limiter: RateLimiter, transport: httpx.AsyncBaseTransport | None = None):
+        self.limiter = limiter
+        self.transport = transport or httpx.AsyncHTTPTransport()
+        # asyncio semaphores are bound to one event loop, so they live with the transport, not the limiter
+        self.host_semaphores: dict[str, asyncio.Semaphore] = {}
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        policy = self.limiter.retry_policy
+        semaphore = self.host_semaphores.setdefault(request.url.host, asyncio.Semaphore(self.limiter.max_per_host))
+        attempt = 0
+        while True:
+            wait = self.limiter.bucket.reserve()
+            if wait:
+                self.limiter.count(throttled_seconds=wait)
+                await asyncio.sleep(wait)
+
+            await semaphore.acquire()
+            self.limiter.count(requests=1)
+            started = time.perf_counter()
+            try:
+                response = await self.transport.handle_async_request(request)
+                metrics.observe("civitai_request_seconds", time.perf_counter() - started)
+            except httpx.TransportError:
+                semaphore.release()
+                self.limiter.count(errors=1)
+                if not policy.should_retry(attempt):
+                    raise
+                response = None
+            except BaseException:
+                semaphore.release()
+                raise
+
+            if response is not None:
+                response.request = request
+                self.limiter.on_response(response)
+                if not policy.should_retry(attempt, response):
+                    return _wrap_response(response, request, semaphore.release)
+                await response.aclose()
+                semaphore.release()
+
+            delay = policy.delay(attempt, response)
+            self.limiter.count(retries=1, throttled_seconds=delay)
+            loguru.logger.info(f"Retrying {request.method} {request.url} in {delay:.1f}s (attempt {attempt + 1})")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
@@ -1,23 +1,186 @@
 import argparse
+import atexit
+import itertools
+import json
 import os
+import sys
 
+import httpx
 import loguru
 
-from mkdocs.commands import build
-from mkdocs.config import load_config
+from pydantic import ValidationError
 
-from .models import Settings
-from src.civitai import Civitai
+from .models import FileFingerprint, Settings
+from src.civitai import AsyncCivitai, Civitai
 from src.db import DBApi
-from src.mdgenerator import model_to_markdown, models_to_markdown
-from src.metadata import MetadataManipulator
-from src.tensorreader import get_corrupted_files
+from src.dedup import DedupFinder
+from src.downloadqueue import DownloadQueue
+from src.httpcache import ResponseCache
+from src.mdgenerator import model_page_source, models_to_markdown, render_model_pages
+from src.metadata import MetadataManipulator, verify_filehashes
+from src.metrics import metrics
+from src.ratelimit import RateLimiter, RetryPolicy
+from src.scanner import FileScanner, ScanResult
+from src.sitewriter import SiteWriter
+from src.tensorreader import INTEGRITY_LEVELS, get_corrupted_files
+from src.watcher import Watcher
 
 # loguru.logger.update(
 #     {"format": "<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>"}
 # )
 
 
+# model types that go to LORAS_PATH, everything else is downloaded to MODELS_PATH
+LORA_MODEL_TYPES = {"LORA", "LoCon", "DoRA"}
+
+
+def download(args: argparse.Namespace, settings: Settings, dbapi: DBApi, rate_limiter: RateLimiter) -> None:
+    api = Civitai(base_url=settings.CIVITAI_API_BASE_URL, api_key=settings.CIVITAI_API_TOKEN, rate_limiter=rate_limiter)
+    queue = DownloadQueue(
+        civitai_api=api,
+        db_api=dbapi,
+        concurrency=args.concurrency or settings.DOWNLOAD_CONCURRENCY,
+        segments=settings.DOWNLOAD_SEGMENTS,
+        bandwidth_limit=settings.DOWNLOAD_BANDWIDTH_LIMIT if args.bandwidth is None else args.bandwidth,
+        hash_algorithm=settings.HASH_ALGORITHM,
+        hash_algorithms=settings.HASH_ALGORITHMS,
+    )
+
+    unavailable: list[int] = []
+    for model_version_id in args.model_version_ids:
+        try:
+            model_version = api.get_model_version(model_version_id)
+        except (httpx.HTTPError, ValidationError) as e:
+            # the other versions are still queued and the queue still runs
+            loguru.logger.error(f"Failed to fetch model version {model_version_id}: {e}")
+            unavailable.append(model_version_id)
+            continue
+        if not model_version:
+            loguru.logger.warning(f"Model version not found: {model_version_id}")
+            continue
+        folder = settings.MODELS_PATH
+        if model_version.model and model_version.model.type in LORA_MODEL_TYPES:
+            folder = settings.LORAS_PATH
+        queue.enqueue_version(model_version, os.path.join(settings.BASE_PATH, folder), priority=args.priority)
+
+    if unavailable:
+        loguru.logger.warning(f"Model versions not queued: {', '.join(map(str, unavailable))}")
+    failed = [item for item in queue.run(retry_failed=args.retry_failed) if item.status == "failed"]
+    if failed:
+        loguru.logger.warning(f"{len(failed)} downloads failed, run download --retry_failed to try them again")
+
+
+def dedup(settings: Settings, scan: ScanResult) -> None:
+    groups = DedupFinder(workers=settings.HASH_WORKERS).find(sorted(scan.files))
+    for group in groups:
+        loguru.logger.info(f"{group.kind}, {group.reclaimable / 2**30:.2f} GiB to reclaim:")
+        for path, size in zip(group.files, group.sizes, strict=True):
+            loguru.logger.info(f"    {path} ({size / 2**30:.2f} GiB)")
+    loguru.logger.info(
+        f"{len(groups)} groups of duplicates, {sum(group.reclaimable for group in groups) / 2**30:.2f} GiB to reclaim",
+    )
+
+
+def search(args: argparse.Namespace, dbapi: DBApi) -> None:
+    hits = dbapi.search(" ".join(args.query), limit=args.limit, local_only=args.local)
+    for hit in hits:
+        loguru.logger.info(
+            f"{hit.model_name} @ {hit.version_name} [{hit.base_model}, {hit.model_type}] {hit.url()}"
+            f"{f' {hit.filepath}' if hit.filepath else ''}",
+        )
+        if hit.trained_words:
+            loguru.logger.info(f"    {', '.join(hit.trained_words)}")
+    loguru.logger.info(f"{len(hits)} hits")
+
+
+def model_page(model_type: str | None, model_id: int) -> str:
+    return f"{model_type}/model-{model_id}.md"
+
+
+def write_model_pages(settings: Settings, site: SiteWriter, meta: MetadataManipulator, model_ids: set[int]) -> None:
+    # pages are told stale from a stamp kept in the DB, only their models are loaded, a batch at a time
+    pages = meta.db_api.get_model_pages(model_ids)
+    sources = {page.modelid: model_page_source(page) for page in pages}
+    stale = [
+        page.modelid
+        for page in pages
+        if not site.keep(model_page(page.model_type, page.modelid), sources[page.modelid])
+    ]
+    metrics.count("site_pages_rendered", len(stale))
+    for batch in itertools.batched(meta.iter_models(stale), settings.MODEL_BATCH_SIZE):
+        site.write_pages(
+            (model_page(model.type, model.id), page, sources[model.id])
+            for model, page in render_model_pages(list(batch), workers=settings.RENDER_WORKERS)
+        )
+    if stale:
+        loguru.logger.info(f"Rendered {len(stale)} of {len(pages)} model pages")
+
+
+def write_index(settings: Settings, site: SiteWriter, meta: MetadataManipulator) -> None:
+    # the index shows only the stats of versions, their images stay in the DB
+    site.write("index.md", models_to_markdown(meta.iter_models(images=False)))
+    if settings.SITE_SEARCH_JSON:
+        documents = [
+            {
+                **document.model_dump(
+                    include={"model_name", "model_type", "version_name", "base_model", "trained_words"},
+                ),
+                "page": f"{document.model_type}/model-{document.modelid}.html",
+                "url": document.url(),
+            }
+            for document in meta.db_api.get_search_documents()
+        ]
+        site.write("search.json", json.dumps(documents, ensure_ascii=False, separators=(",", ":")))
+
+
+def write_site(settings: Settings, site: SiteWriter, meta: MetadataManipulator) -> None:
+    with metrics.stage("render"):
+        write_model_pages(settings, site, meta, meta.model_ids)
+        write_index(settings, site, meta)
+        site.remove_unwritten()
+    site.build(dirty=settings.SITE_DIRTY_BUILD)
+
+
+def write_metrics(settings: Settings) -> None:
+    metrics.write_json(os.path.join(settings.WORK_DIR, settings.METRICS_REPORT_FILE))
+    if settings.METRICS_TEXTFILE:
+        metrics.write_prometheus(settings.METRICS_TEXTFILE)
+    loguru.logger.info(f"Stages: {metrics.summary()}")
+
+
+def watch(
+    settings: Settings,
+    dbapi: DBApi,
+    meta: MetadataManipulator,
+    scan: ScanResult,
+    site: SiteWriter,
+) -> None:
+    roots = [os.path.join(settings.BASE_PATH, folder) for folder in (settings.MODELS_PATH, settings.LORAS_PATH)]
+
+    def on_change(changed: dict[str, FileFingerprint], removed: list[str]) -> None:
+        model_ids = meta.sync_files(changed, removed)
+        with metrics.stage("render"):
+            write_model_pages(settings, site, meta, model_ids & meta.model_ids)
+            # the last local file of the model is gone, the model itself stays in the DB
+            for page in dbapi.get_model_pages(model_ids - meta.model_ids):
+                site.remove(model_page(page.model_type, page.modelid))
+            write_index(settings, site, meta)
+        site.build(dirty=settings.SITE_DIRTY_BUILD)
+        # a long running watch reports after every change, not only when it's stopped
+        write_metrics(settings)
+
+    files = {path: fingerprint for root in roots for path, fingerprint in scan.under(root).items()}
+    watcher = Watcher(
+        roots,
+        on_change,
+        scanner=FileScanner(dbapi),
+        files=files,
+        debounce=settings.WATCH_DEBOUNCE,
+        poll_interval=settings.WATCH_POLL_INTERVAL,
+    )
+    watcher.run()
+
+
 def run():
     parser = argparse.ArgumentParser(description="Process some data.")
     parser.add_argument(
@@ -32,12 +195,133 @@ def run():
         default=False,
         help="Skip fetching metadata (default: False)",
     )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        default=False,
+        help="Only compare stored file fingerprints with the files on disk and report drift, hash nothing",
+    )
+    parser.add_argument(
+        "--full_scan",
+        action="store_true",
+        default=False,
+        help="List every directory instead of only the ones whose mtime changed",
+    )
+    parser.add_argument(
+        "--integrity",
+        choices=INTEGRITY_LEVELS,
+        default=None,
+        help="How deep to check .safetensors files: header layout only, sampled or full checksums "
+        "(default: INTEGRITY_CHECK_LEVEL)",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    download_parser = subparsers.add_parser(
+        "download",
+        help="Queue the best file of each model version and download everything pending in the queue",
+    )
+    download_parser.add_argument("model_version_ids", type=int, nargs="*", help="Model version IDs to queue")
+    download_parser.add_argument("--priority", type=int, default=0, help="Higher priorities are downloaded first")
+    download_parser.add_argument("--concurrency", type=int, default=None, help="Parallel transfers")
+    download_parser.add_argument(
+        "--bandwidth",
+        type=int,
+        default=None,
+        help="Total download rate limit in bytes per second, 0 is unlimited",
+    )
+    download_parser.add_argument(
+        "--retry_failed",
+        action="store_true",
+        help="Try failed downloads again, otherwise they stay failed with their error",
+    )
+    subparsers.add_parser(
+        "watch",
+        help="Sync once, then keep watching MODELS_PATH and LORAS_PATH and update the pages of new files",
+    )
+    search_parser = subparsers.add_parser(
+        "search",
+        help="Find model versions by trigger words, tags, names, base model or description",
+    )
+    search_parser.add_argument("query", nargs="+", help="Words to look for, each matches as a prefix")
+    search_parser.add_argument("--limit", type=int, default=20, help="Most hits to show")
+    search_parser.add_argument("--local", action="store_true", help="Only versions with a local file")
+    subparsers.add_parser(
+        "dedup",
+        help="Report files holding the same weights: byte copies, other metadata, or the same model in another dtype",
+    )
     args = parser.parse_args()
 
     settings = Settings()
-    api = Civitai(base_url=settings.CIVITAI_API_BASE_URL, api_key=settings.CIVITAI_API_TOKEN)
-    dbapi = DBApi(db_path=f"{settings.WORK_DIR}/db.sqlite")
-    corrupted_tensors = get_corrupted_files(base_path=settings.BASE_PATH)
+    rate_limiter = RateLimiter(
+        rate=settings.CIVITAI_RATE_LIMIT,
+        max_per_host=settings.CIVITAI_MAX_CONCURRENCY,
+        retry_policy=RetryPolicy(max_retries=settings.CIVITAI_MAX_RETRIES),
+    )
+    metrics.collect("civitai", lambda: rate_limiter.stats)
+    dbapi = DBApi(
+        db_path=f"{settings.WORK_DIR}/db.sqlite",
+        journal_mode=settings.DB_JOURNAL_MODE,
+        flush_interval=settings.DB_FLUSH_INTERVAL,
+    )
+
+    if args.command == "download":
+        download(args, settings, dbapi, rate_limiter)
+        return
+    if args.command == "search":
+        search(args, dbapi)
+        return
+    if args.command != "dedup" and not args.verify:
+        # only a sync reports, written however it ends: a failed nightly run is the one worth looking at,
+        # and an interactive command would replace its report with one of its own
+        atexit.register(write_metrics, settings)
+
+    response_cache = ResponseCache(
+        dbapi,
+        ttls={
+            r"/models/\d+$": settings.CIVITAI_CACHE_TTL_MODEL,
+            r"/model-versions/by-hash/[^/]+$": settings.CIVITAI_CACHE_TTL_BY_HASH,
+        },
+        not_found_ttl=settings.CIVITAI_CACHE_TTL_NOT_FOUND,
+    )
+    metrics.collect("civitai_cache", lambda: response_cache.stats)
+    api = AsyncCivitai(
+        base_url=settings.CIVITAI_API_BASE_URL,
+        api_key=settings.CIVITAI_API_TOKEN,
+        max_connections=settings.CIVITAI_MAX_CONNECTIONS,
+        rate_limiter=rate_limiter,
+        cache=response_cache,
+    )
+
+    # one scan serves every step of the run
+    models_path = os.path.join(settings.BASE_PATH, settings.MODELS_PATH)
+    loras_path = os.path.join(settings.BASE_PATH, settings.LORAS_PATH)
+    with metrics.stage("scan"):
+        scan = FileScanner(dbapi).scan(
+            [settings.BASE_PATH, models_path, loras_path],
+            full=args.full_scan or args.verify,
+        )
+    metrics.set("scanned_files", len(scan.files))
+
+    if args.command == "dedup":
+        with metrics.stage("dedup"):
+            dedup(settings, scan)
+        return
+
+    if args.verify:
+        drift = verify_filehashes(dbapi, {**scan.under(models_path), **scan.under(loras_path)})
+        for kind, drifted_paths in drift.items():
+            for path in drifted_paths:
+                loguru.logger.warning(f"{kind}: {path}")
+        loguru.logger.info(", ".join(f"{kind}: {len(drifted_paths)}" for kind, drifted_paths in drift.items()))
+        sys.exit(1 if any(drift.values()) else 0)
+
+    with metrics.stage("integrity"):
+        corrupted_tensors = get_corrupted_files(
+            base_path=settings.BASE_PATH,
+            files=scan.files,
+            db_api=dbapi,
+            level=args.integrity or settings.INTEGRITY_CHECK_LEVEL,
+            workers=settings.HASH_WORKERS,
+        )
     if corrupted_tensors:
         loguru.logger.warning(f"{corrupted_tensors=}")
 
@@ -50,37 +334,41 @@ def run():
         civitai_api=api,
         db_api=dbapi,
         hash_algorithm=settings.HASH_ALGORITHM,
+        hash_algorithms=settings.HASH_ALGORITHMS,
+        hash_workers=settings.HASH_WORKERS,
+        hash_max_inflight_bytes=settings.HASH_MAX_INFLIGHT_BYTES,
+        integrity_level=args.integrity or settings.INTEGRITY_CHECK_LEVEL,
         force_calc_hashes=args.force_calc_hashes,
         skip_fetch_metadata=args.skip_fetch_metadata,
+        scan=scan,
+        model_batch_size=settings.MODEL_BATCH_SIZE,
+        by_hash_batch_size=settings.CIVITAI_BY_HASH_BATCH_SIZE,
     )
+    loguru.logger.info(f"CivitAI API: {rate_limiter.stats}, cache: {response_cache.stats}")
+    for header in dbapi.get_unmatched_safetensors_headers():
+        # what the file's own header tells about it, for files CivitAI doesn't know
+        loguru.logger.info(
+            f"Not on CivitAI: {header.path} [{header.architecture or 'unknown'}"
+            f"{f', rank {header.rank}' if header.rank else ''}, {header.parameter_count / 1e6:.1f}M parameters]",
+        )
 
     # # alert about newer versions
     # meta.find_new_versions()
     # print()
     # # alert about having inpaint versions
     # meta.find_inpaint_versions()
-    models = meta.list_models_with_versions()
-    for model in models:
-        # if model.id == 573152:
-        #     import ipdb
-
-        #     ipdb.set_trace()
-        os.makedirs(f"{settings.WORK_DIR}/{model.type}", exist_ok=True)
-        with open(f"{settings.WORK_DIR}/{model.type}/model-{model.id}.md", "w") as f:
-            f.write(model_to_markdown(model))
+    # if model.id == 573152:
+    #     import ipdb
 
-    with open(f"{settings.WORK_DIR}/index.md", "w") as f:
-        f.write(models_to_markdown(models))
+    #     ipdb.set_trace()
+    site = SiteWriter(dbapi, settings.WORK_DIR)
+    write_site(settings, site, meta)
 
     # for failed in tf_failed:
     #     print(failed.model_version_metadata.files)
-    # api.download(
-    #     "https://civitai.com/api/download/models/474400",
-    #     "/stablediff/models/fetched/",
-    # )
 
-    config = load_config(config_file="mkdocs.yml", docs_dir=settings.WORK_DIR)
-    build.build(config)
+    if args.command == "watch":
+        watch(settings, dbapi, meta, scan, site)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,121 @@
+import os
+import time
+
+from collections.abc import Iterable
+
+import loguru
+
+from pydantic import BaseModel
+
+from src.db import BatchWriter, DBApi
+from src.models import FileFingerprint
+
+
+class ScanResult(BaseModel):
+    files: dict[str, FileFingerprint] = {}
+    scanned_dirs: int = 0
+    cached_dirs: int = 0
+
+    def under(self, folder: str) -> dict[str, FileFingerprint]:
+        prefix = os.path.join(folder, "")
+        return {path: fingerprint for path, fingerprint in self.files.items() if path.startswith(prefix)}
+
+
+class FileScanner:
+    """Find files by extension, listing only the directories that changed since the previous scan.
+
+    Adding, removing or renaming an entry changes the mtime of its directory, so for an unchanged
+    directory the listing stored last time is reused. A file rewritten in place doesn't touch the
+    directory mtime, so the files of the listing are still stat'ed one by one; full=True lists everything.
+    """
+
+    def __init__(self, db_api: DBApi, extension: str = ".safetensors", mtime_granularity_ns: int = 2_000_000_000):
+        self.db_api = db_api
+        self.extension = extension
+        # coarse mtimes (FAT, some network filesystems) can hide a change made right after the scan
+        self.mtime_granularity_ns = mtime_granularity_ns
+
+    def scan(self, roots: Iterable[str], full: bool = False) -> ScanResult:
+        started_ns = time.time_ns()
+        roots = [root.rstrip(os.sep) or os.sep for root in roots]
+        known_dirs, known_files = self.db_api.get_scan_index()
+        result = ScanResult()
+        visited: set[str] = set()
+        stack = list(roots)
+
+        with self.db_api.batch() as batch:
+            while stack:
+                path = stack.pop()
+                if path in visited:
+                    continue
+                try:
+                    # stat before listing, so a change made during the scan is seen next time
+                    mtime_ns = os.stat(path).st_mtime_ns
+                except OSError as e:
+                    loguru.logger.warning(f"Can't scan {path}: {e}")
+                    continue
+                visited.add(path)
+
+                known = known_dirs.get(path)
+                if not full and known and known.mtime_ns == mtime_ns:
+                    subdirs, files = known.subdirs, self._restat(known_files.get(path, {}))
+                    if files != known_files.get(path, {}):
+                        batch.put_scan_dir(path, mtime_ns, subdirs, files)
+                    result.cached_dirs += 1
+                else:
+                    try:
+                        subdirs, files = self._list(path)
+                    except OSError as e:
+                        loguru.logger.warning(f"Can't list {path}: {e}")
+                        continue
+                    stored_mtime_ns: int | None = mtime_ns
+                    if mtime_ns > started_ns - self.mtime_granularity_ns:
+                        stored_mtime_ns = None
+                    batch.put_scan_dir(path, stored_mtime_ns, subdirs, files)
+                    result.scanned_dirs += 1
+
+                result.files.update(files)
+                stack.extend(subdirs)
+
+            self._forget(batch, known_dirs.keys() - visited, roots)
+
+        loguru.logger.info(
+            f"Found {len(result.files)} files, listed {result.scanned_dirs} directories, "
+            f"{result.cached_dirs} unchanged",
+        )
+        return result
+
+    def _list(self, path: str) -> tuple[list[str], dict[str, FileFingerprint]]:
+        subdirs: list[str] = []
+        files: dict[str, FileFingerprint] = {}
+        with os.scandir(path) as entries:
+            for entry in entries:
+                # like os.walk: symlinked directories aren't followed, symlinked files are
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.name.endswith(self.extension) and entry.is_file():
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        # removed since it was listed
+                        continue
+                    files[entry.path] = FileFingerprint(size=stat.st_size, mtime_ns=stat.st_mtime_ns, inode=stat.st_ino)
+        return subdirs, files
+
+    @staticmethod
+    def _restat(files: dict[str, FileFingerprint]) -> dict[str, FileFingerprint]:
+        current = {}
+        for path in files:
+            try:
+                current[path] = FileFingerprint.from_path(path)
+            except OSError:
+                # removed since the directory was stat'ed, the next scan lists it again
+                continue
+        return current
+
+    def _forget(self, batch: BatchWriter, paths: Iterable[str], roots: list[str]) -> None:
+        # directories that are gone; ones outside the scanned roots belong to other scans and stay
+        prefixes = tuple(os.path.join(root, "") for root in roots)
+        for path in paths:
+            if path in roots or path.startswith(prefixes):
+                batch.remove_scan_dir(path)
@@ -0,0 +1,111 @@
+import contextlib
+import glob
+import os
+
+from collections.abc import Iterable
+
+import loguru
+
+from blake3 import blake3
+from mkdocs.commands import build
+from mkdocs.config import load_config
+
+from src.db import DBApi
+from src.metrics import metrics
+
+
+def content_hash(content: str | bytes) -> str:
+    return blake3(content.encode() if isinstance(content, str) else content).hexdigest()
+
+
+class SiteWriter:
+    """Writes the markdown pages of the site only when they change and builds it only when something did.
+
+    Page hashes live in the site_pages table, the state the site was last built from in site_builds:
+    a run that renders the same pages with the same mkdocs.yml doesn't touch a single file.
+    """
+
+    def __init__(self, db_api: DBApi, work_dir: str, config_file: str = "mkdocs.yml"):
+        self.db_api = db_api
+        self.work_dir = work_dir
+        self.config_file = config_file
+        self.pages, self.sources = db_api.get_site_pages()
+        if not self.pages:
+            # pages written before their hashes were kept, adopted so the stale ones can be removed
+            for path in glob.glob("*/model-*.md", root_dir=work_dir):
+                self.pages[path] = ""
+        self.written: set[str] = set()
+        self.changed: set[str] = set()
+
+    def keep(self, path: str, source: str) -> bool:
+        """Keep the page as it is if it was rendered from the same source, otherwise it has to be written."""
+        if self.sources.get(path) != source or not os.path.exists(os.path.join(self.work_dir, path)):
+            return False
+        self.written.add(path)
+        return True
+
+    def write(self, path: str, content: str, source: str | None = None) -> bool:
+        """Write a page, path is relative to work_dir. False when it's already up to date."""
+        self.written.add(path)
+        digest = content_hash(content)
+        full_path = os.path.join(self.work_dir, path)
+        if self.pages.get(path) == digest and os.path.exists(full_path):
+            if source != self.sources.get(path):
+                self.sources[path] = source
+                self.db_api.put_site_page(path, digest, source)
+            return False
+
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "w") as f:
+            f.write(content)
+        self.pages[path] = digest
+        self.sources[path] = source
+        self.changed.add(path)
+        self.db_api.put_site_page(path, digest, source)
+        metrics.count("site_pages_written")
+        return True
+
+    def write_pages(self, pages: Iterable[tuple[str, str, str | None]]) -> int:
+        """Write (path, content, source) triples in one transaction, returns how many changed."""
+        with self.db_api.transaction():
+            return sum(self.write(path, content, source) for path, content, source in pages)
+
+    def remove(self, path: str) -> None:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(self.work_dir, path))
+        if self.pages.pop(path, None) is not None:
+            self.changed.add(path)
+            metrics.count("site_pages_removed")
+        self.sources.pop(path, None)
+        self.written.discard(path)
+        self.db_api.remove_site_page(path)
+
+    def remove_unwritten(self) -> list[str]:
+        """Remove the pages of models gone since the previous run, everything not written by this one."""
+        stale = sorted(self.pages.keys() - self.written)
+        with self.db_api.transaction():
+            for path in stale:
+                self.remove(path)
+        if stale:
+            loguru.logger.info(f"Removed {len(stale)} stale pages")
+        return stale
+
+    def build(self, dirty: bool = False) -> bool:
+        """Build the site unless it was built from the same pages and config. dirty rebuilds only changed pages."""
+        with open(self.config_file, "rb") as f:
+            state = content_hash(
+                f.read() + "".join(sorted(f"{path}:{digest}" for path, digest in self.pages.items())).encode(),
+            )
+        built = self.db_api.get_site_build(self.work_dir)
+        if built is not None and built.state == state and os.path.isdir(built.site_dir):
+            loguru.logger.info("Site is up to date")
+            return False
+
+        loguru.logger.info(f"Building the site, {len(self.changed)} pages changed")
+        config = load_config(config_file=self.config_file, docs_dir=self.work_dir)
+        with metrics.stage("site_build"):
+            build.build(config, dirty=dirty and built is not None)
+        # saved only after a successful build, so an interrupted one is repeated next time
+        self.db_api.put_site_build(self.work_dir, config["site_dir"], state)
+        self.changed.clear()
+        return True
@@ -1,43 +1,348 @@
 import json
+import math
+import mmap
+import os
 import struct
+import time
 
-from safetensors import safe_open
+from collections import Counter
+from collections.abc import Iterable, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
 
-from src.utils import recursively_find_all_files_by_extension_in_folder
+import loguru
 
+from blake3 import blake3
 
-def parse_safetensor_header(f):
-    f.seek(0)
-    header = f.read(8)
-    # Interpret the bytes as a little-endian unsigned 64-bit integer
-    length_of_header = struct.unpack("<Q", header)[0]
-    # read bytes from 8 to 7+length_of_header
-    f.seek(8)
-    metadata = f.read(length_of_header)
-    # Interpret the response as a JSON object
-    json.loads(metadata.decode("utf-8"))
-    return True
+from src.db import DBApi
+from src.metrics import metrics
+from src.models import DBAPIIntegrityCheck, DBAPISafetensorsHeader, FileFingerprint
+from src.utils import gen_filehashes, recursively_find_all_files_by_extension_in_folder
 
+# bytes per element of every dtype safetensors can store
+DTYPE_SIZES = {
+    "BOOL": 1,
+    "U8": 1,
+    "I8": 1,
+    "F8_E5M2": 1,
+    "F8_E4M3": 1,
+    "I16": 2,
+    "U16": 2,
+    "F16": 2,
+    "BF16": 2,
+    "I32": 4,
+    "U32": 4,
+    "F32": 4,
+    "I64": 8,
+    "U64": 8,
+    "F64": 8,
+}
 
-def can_read_safetensor_metadata(filename: str, quick=True):
-    if not quick:
-        tf = safe_open(filename, framework="tf", device="cpu")
-        return len(tf.keys()) > 0
+# the same limit the safetensors library puts on the header
+MAX_HEADER_SIZE = 100 << 20
 
+# header: only the layout is validated; sample: a few blocks spread over the data are read and checksummed;
+# full: the whole file is read and checksummed. Checksums are compared with the ones of the previous check
+# of the same unchanged file, so they find bit rot and unreadable sectors
+INTEGRITY_LEVELS = ("header", "sample", "full")
+
+
+# __metadata__ keys kept in the index, kohya-ss training parameters; modelspec.* keys are kept as well
+METADATA_KEYS = (
+    "ss_base_model_version",
+    "ss_sd_model_name",
+    "ss_network_module",
+    "ss_network_dim",
+    "ss_network_alpha",
+    "ss_output_name",
+    "ss_resolution",
+    "ss_num_train_images",
+    "ss_num_epochs",
+    "ss_steps",
+    "ss_training_comment",
+    "ss_tag_frequency",
+)
+
+# prefixes of ss_base_model_version and modelspec.architecture values
+ARCHITECTURE_PREFIXES = (
+    ("sdxl", "SDXL"),
+    ("stable-diffusion-xl", "SDXL"),
+    ("sd_v1", "SD 1.5"),
+    ("stable-diffusion-v1", "SD 1.5"),
+    ("sd_v2", "SD 2"),
+    ("stable-diffusion-v2", "SD 2"),
+    ("sd3", "SD 3"),
+    ("stable-diffusion-v3", "SD 3"),
+    ("stable-diffusion-3", "SD 3"),
+    ("flux", "Flux"),
+)
+
+# tensor name fragments of checkpoints and LoRAs that didn't record what they were trained on, most specific first
+ARCHITECTURE_TENSORS = (
+    ("double_blocks", "Flux"),
+    ("joint_blocks", "SD 3"),
+    ("conditioner.embedders.1", "SDXL"),
+    ("lora_te2_", "SDXL"),
+    ("lora_te1_", "SDXL"),
+    ("cond_stage_model.model.", "SD 2"),
+    ("cond_stage_model.transformer.", "SD 1.5"),
+    ("lora_te_", "SD 1.5"),
+)
+
+
+class SafetensorsError(ValueError):
+    pass
+
+
+def read_safetensors_header(fd: int, file_size: int) -> tuple[dict[str, Any], int]:
+    """Parsed header and the offset the tensor data starts at."""
+    if file_size < 8:
+        raise SafetensorsError(f"file is too short: {file_size} bytes")
+    (header_size,) = struct.unpack("<Q", os.pread(fd, 8, 0))
+    if header_size > MAX_HEADER_SIZE or 8 + header_size > file_size:
+        raise SafetensorsError(f"header size {header_size} doesn't fit the file of {file_size} bytes")
+
+    with mmap.mmap(fd, 8 + header_size, access=mmap.ACCESS_READ) as mm:
+        try:
+            header = json.loads(mm[8:])
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            raise SafetensorsError(f"header isn't valid JSON: {e}") from e
+    if not isinstance(header, dict):
+        raise SafetensorsError("header isn't a JSON object")
+    return header, 8 + header_size
+
+
+def validate_safetensors_header(header: dict[str, Any], data_size: int) -> None:
+    """Tensors have known dtypes, their sizes match their shapes and they cover the data without gaps."""
+    metadata = header.get("__metadata__", {})
+    if not isinstance(metadata, dict) or not all(isinstance(value, str) for value in metadata.values()):
+        raise SafetensorsError("__metadata__ isn't a string to string map")
+
+    spans = []
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        if not isinstance(info, dict):
+            raise SafetensorsError(f"{name}: tensor info isn't an object")
+        dtype, shape, offsets = info.get("dtype"), info.get("shape"), info.get("data_offsets")
+        if dtype not in DTYPE_SIZES:
+            raise SafetensorsError(f"{name}: unknown dtype {dtype}")
+        if not isinstance(shape, list) or not all(isinstance(dim, int) and dim >= 0 for dim in shape):
+            raise SafetensorsError(f"{name}: invalid shape {shape}")
+        if (
+            not isinstance(offsets, list)
+            or len(offsets) != 2
+            or not all(isinstance(offset, int) for offset in offsets)
+            or not 0 <= offsets[0] <= offsets[1]
+        ):
+            raise SafetensorsError(f"{name}: invalid data_offsets {offsets}")
+        if offsets[1] - offsets[0] != math.prod(shape) * DTYPE_SIZES[dtype]:
+            raise SafetensorsError(f"{name}: {offsets[1] - offsets[0]} bytes for {dtype}{shape}")
+        spans.append(offsets)
+
+    end = 0
+    for begin, tensor_end in sorted(spans):
+        if begin != end:
+            raise SafetensorsError(f"tensor data {'overlaps' if begin < end else 'has a gap'} at {begin}")
+        end = tensor_end
+    if end != data_size:
+        raise SafetensorsError(f"tensors take {end} bytes, the file has {data_size} after the header")
+
+
+def guess_architecture(header: dict[str, Any], metadata: dict[str, str]) -> str | None:
+    for value in (metadata.get("modelspec.architecture"), metadata.get("ss_base_model_version")):
+        for prefix, architecture in ARCHITECTURE_PREFIXES:
+            if value and value.lower().startswith(prefix):
+                return architecture
+    for fragment, architecture in ARCHITECTURE_TENSORS:
+        if any(fragment in name for name in header):
+            return architecture
+    return None
+
+
+def guess_rank(header: dict[str, Any], metadata: dict[str, str]) -> int | None:
+    """Rank of a LoRA, None for anything else."""
+    if metadata.get("ss_network_dim", "").isdigit():
+        return int(metadata["ss_network_dim"])
+    for name, info in header.items():
+        # kohya-ss and diffusers/peft names of the down projection, (rank, in_features, ...)
+        if name.endswith((".lora_down.weight", ".lora_A.weight")) and info["shape"]:
+            return info["shape"][0]
+    return None
+
+
+def summarize_safetensors_header(path: str, stat: os.stat_result, header: dict[str, Any]) -> DBAPISafetensorsHeader:
+    """The parts of a validated header worth keeping: what's inside and what it was trained on."""
+    metadata = header.get("__metadata__", {})
+    tensors = {name: info for name, info in header.items() if name != "__metadata__"}
+    return DBAPISafetensorsHeader(
+        path=path,
+        size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,
+        inode=stat.st_ino,
+        tensor_count=len(tensors),
+        parameter_count=sum(math.prod(info["shape"]) for info in tensors.values()),
+        dtypes=Counter(info["dtype"] for info in tensors.values()),
+        metadata={
+            key: value for key, value in metadata.items() if key in METADATA_KEYS or key.startswith("modelspec.")
+        },
+        architecture=guess_architecture(tensors, metadata),
+        rank=guess_rank(tensors, metadata),
+    )
+
+
+def sampled_checksum(fd: int, start: int, end: int, samples: int = 16, blocksize: int = 1 << 20) -> str:
+    """blake3 of blocks spread evenly over [start, end), the first and the last one included."""
+    hasher = blake3()
+    length = end - start
+    offsets: Sequence[int]
+    if length <= samples * blocksize:
+        offsets = range(start, end, blocksize)
+    else:
+        step = (length - blocksize) / max(1, samples - 1)
+        offsets = [start + int(step * i) for i in range(samples)]
+    for offset in offsets:
+        block = os.pread(fd, min(blocksize, end - offset), offset)
+        if len(block) != min(blocksize, end - offset):
+            raise SafetensorsError(f"short read at {offset}")
+        hasher.update(block)
+    return hasher.hexdigest()
+
+
+def check_safetensors(
+    path: str,
+    level: str = "header",
+    samples: int = 16,
+    max_threads: int = blake3.AUTO,
+) -> tuple[DBAPIIntegrityCheck, DBAPISafetensorsHeader | None]:
+    """Check one file and summarize its header; a checksum is only computed once the header is fine."""
+    fd = os.open(path, os.O_RDONLY)
     try:
-        with open(filename, "rb") as f:
-            return parse_safetensor_header(f)
-    except UnicodeDecodeError:
-        return False
+        stat = os.fstat(fd)
+        check = DBAPIIntegrityCheck(
+            path=path,
+            size=stat.st_size,
+            mtime_ns=stat.st_mtime_ns,
+            inode=stat.st_ino,
+            checked_at=time.time(),
+        )
+        summary = None
+        try:
+            header, data_start = read_safetensors_header(fd, stat.st_size)
+            validate_safetensors_header(header, stat.st_size - data_start)
+            summary = summarize_safetensors_header(path, stat, header)
+            if level == "sample":
+                check.sample_checksum = sampled_checksum(fd, data_start, stat.st_size, samples)
+        except SafetensorsError as e:
+            check.error = str(e)
+    finally:
+        os.close(fd)
+
+    if level == "full" and check.error is None:
+        check.full_checksum = gen_filehashes(path, ["blake3"], max_threads=max_threads)["blake3"]
+    return check, summary
+
+
+class IntegrityChecker:
+    """Finds broken .safetensors files without loading a single tensor.
+
+    Results are kept against the file's size/mtime/inode: header checks of unchanged files aren't repeated,
+    checksums of unchanged files have to match the ones computed before. Summaries of the headers go
+    to the safetensors_headers table on the way.
+    """
+
+    def __init__(self, db_api: DBApi | None = None, level: str = "header", samples: int = 16, workers: int = 4):
+        if level not in INTEGRITY_LEVELS:
+            raise ValueError(f"Unknown integrity check level: {level}")
+        self.db_api = db_api
+        self.level = level
+        self.samples = samples
+        self.workers = max(1, workers)
+        # files are checked by several workers at once, full checksums don't need threads of their own
+        self.max_threads = 1 if self.workers > 1 else blake3.AUTO
+
+    def check(self, files: Iterable[str]) -> dict[str, str]:
+        """Problems found, by file path."""
+        files = list(files)
+        cached = self.db_api.get_integrity_checks() if self.db_api else {}
+        cached_headers = self.db_api.get_safetensors_headers() if self.db_api else {}
+        checks = {}
+        headers = {}
+        # sqlite connections stay in this thread, the workers only read files
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="integrity") as executor:
+            results = executor.map(self._check, files, [cached] * len(files), [cached_headers] * len(files))
+            for path, (check, header) in zip(files, results, strict=True):
+                if check is not None:
+                    checks[path] = check
+                    metrics.count("integrity_files_cached" if check is cached.get(path) else "integrity_files_checked")
+                if header is not None:
+                    headers[path] = header
+
+        if self.db_api:
+            with self.db_api.batch() as batch:
+                for path, check in checks.items():
+                    if check.checked_at is not None and check is not cached.get(path):
+                        batch.put_integrity_check(check)
+                for path, header in headers.items():
+                    if header is not cached_headers.get(path):
+                        batch.put_safetensors_header(header)
+        errors = {path: check.error for path, check in checks.items() if check.error}
+        metrics.set("integrity_corrupted_files", len(errors))
+        return errors
+
+    def _check(
+        self,
+        path: str,
+        cached: dict[str, DBAPIIntegrityCheck],
+        cached_headers: dict[str, DBAPISafetensorsHeader],
+    ) -> tuple[DBAPIIntegrityCheck | None, DBAPISafetensorsHeader | None]:
+        try:
+            fingerprint = FileFingerprint.from_path(path)
+        except FileNotFoundError:
+            return None, None
+        previous = cached.get(path)
+        if previous is not None and previous.fingerprint != fingerprint:
+            previous = None
+        header = cached_headers.get(path)
+        if header is not None and header.fingerprint != fingerprint:
+            header = None
+        if previous is not None and (previous.error or (self.level == "header" and header is not None)):
+            return previous, header
+
+        try:
+            check, header = check_safetensors(path, self.level, self.samples, self.max_threads)
+        except OSError as e:
+            loguru.logger.warning(f"Can't read {path}: {e}")
+            # not cached, the next run tries again
+            return DBAPIIntegrityCheck(path=path, error=f"read error: {e}"), None
+        if previous is None or check.fingerprint != fingerprint:
+            return check, header
 
+        for name in ("sample_checksum", "full_checksum"):
+            expected, actual = getattr(previous, name), getattr(check, name)
+            if actual is None:
+                setattr(check, name, expected)
+            elif expected is not None and expected != actual:
+                # the file changed without touching its size or mtime
+                check.error = f"{name.replace('_', ' ')} changed from {expected} to {actual}"
+                setattr(check, name, expected)
+        return check, header
 
-def get_corrupted_files(base_path: str) -> list[str]:
-    files = recursively_find_all_files_by_extension_in_folder(
-        folder=base_path,
-        extension="safetensors",
-    ).values()
 
-    res = [file for file in files if not can_read_safetensor_metadata(file, quick=True)]
-    res.extend([file for file in files if not can_read_safetensor_metadata(file, quick=False)])
+def get_corrupted_files(
+    base_path: str,
+    files: Iterable[str] | None = None,
+    db_api: DBApi | None = None,
+    level: str = "header",
+    workers: int = 4,
+) -> list[str]:
+    if files is None:
+        files = recursively_find_all_files_by_extension_in_folder(
+            folder=base_path,
+            extension="safetensors",
+        ).values()
 
-    return list(set(res))
+    problems = IntegrityChecker(db_api, level=level, workers=workers).check(list(files))
+    for path, problem in problems.items():
+        loguru.logger.warning(f"{path}: {problem}")
+    return sorted(problems)
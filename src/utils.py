@@ -1,11 +1,14 @@
 import fnmatch
 import hashlib
 import io
+import mmap
 import os
+import zlib
 
-from typing import Any
+from collections.abc import Iterable
 
 import loguru
+import numpy as np
 
 from blake3 import blake3
 
@@ -28,52 +31,97 @@ def read_chunks(file, size=io.DEFAULT_BUFFER_SIZE):
         yield chunk
 
 
-def __gen_file_sha256(filename):
-    loguru.logger.info(f"Use Memory Optimized SHA256 for {filename}")
-    blocksize = 1 << 20
-    h = hashlib.sha256()
-    length = 0
-    with open(os.path.realpath(filename), "rb") as f:
-        for block in read_chunks(f, size=blocksize):
-            length += len(block)
-            h.update(block)
-
-    hash_value = h.hexdigest()
-    loguru.logger.info(f"sha256: {hash_value}, length: {str(length)}")
-    return hash_value
+# digests CivitAI can look a model version up by, in the format of CivitaiHashes (but lowercase)
+HASH_ALGORITHMS = ("blake3", "sha256", "autov2", "crc32")
+
+
+class MultiHasher:
+    """Feed the same bytes to several digests at once.
+
+    blake3 spreads big updates over max_threads threads, pass 1 where the caller already runs hashers in parallel.
+    """
+
+    def __init__(self, algorithms: Iterable[str], max_threads: int = blake3.AUTO):
+        self.algorithms = list(dict.fromkeys(algorithms))
+        unknown = set(self.algorithms) - set(HASH_ALGORITHMS)
+        if unknown:
+            raise ValueError(f"Unknown algorithm: {', '.join(sorted(unknown))}")
+
+        self.blake3 = blake3(max_threads=max_threads) if "blake3" in self.algorithms else None
+        self.sha256 = hashlib.sha256() if {"sha256", "autov2"} & set(self.algorithms) else None
+        self.crc32 = 0 if "crc32" in self.algorithms else None
+        self.length = 0
+
+    def update(self, block: bytes | memoryview) -> None:
+        if self.blake3 is not None:
+            self.blake3.update(block)
+        if self.sha256 is not None:
+            self.sha256.update(block)
+        if self.crc32 is not None:
+            self.crc32 = zlib.crc32(block, self.crc32)
+        self.length += len(block)
+
+    def hexdigests(self) -> dict[str, str]:
+        digests = {}
+        if self.blake3 is not None:
+            digests["blake3"] = self.blake3.hexdigest()
+        if self.sha256 is not None:
+            digests["sha256"] = self.sha256.hexdigest()
+            digests["autov2"] = digests["sha256"][:10]
+        if self.crc32 is not None:
+            digests["crc32"] = f"{self.crc32:08x}"
+        return {algorithm: digests[algorithm] for algorithm in self.algorithms}
+
+
+def gen_filehashes(
+    filename: str,
+    algorithms: Iterable[str],
+    blocksize: int = 1 << 24,
+    max_threads: int = blake3.AUTO,
+) -> dict[str, str]:
+    """Compute several digests in a single pass over a memory-mapped file."""
+    hasher = MultiHasher(algorithms, max_threads)
+    loguru.logger.info(f"Calculating {', '.join(hasher.algorithms)} for {filename}")
 
+    with open(os.path.realpath(filename), "rb") as f:
+        length = os.fstat(f.fileno()).st_size
+        # mmap can't map an empty file
+        if length:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                for offset in range(0, length, blocksize):
+                    with view[offset : offset + blocksize] as block:
+                        hasher.update(block)
 
-def __gen_file_blake3(filename: str) -> str:
-    loguru.logger.info(f"Use Memory Optimized BLAKE3 for {filename}")
-    file_hasher = blake3(max_threads=blake3.AUTO)
-    file_hasher.update_mmap(filename)
-    hash_value = file_hasher.hexdigest()
-    loguru.logger.info(f"blake3: {hash_value}")
-    return hash_value
+    digests = hasher.hexdigests()
+    loguru.logger.info(f"{digests}, length: {length}")
+    return digests
 
 
 def gen_filehash(filename: str, algorithm: str | None = "blake3") -> str:
-    if algorithm == "sha256":
-        return __gen_file_sha256(filename)
-    elif algorithm == "blake3":
-        return __gen_file_blake3(filename)
-    else:
+    if algorithm is None:
         raise ValueError(f"Unknown algorithm: {algorithm}")
-
-
-def find_position_by_id(array: list[Any], field_name: str, target_id: Any) -> int:
-    return next(
-        (index for index, element in enumerate(array) if getattr(element, field_name) == target_id),
-        -1,
-    )
-
-
-def aggregate_min_max(elements, keys: list[str] | None = None) -> dict[str, list[int | float]]:
-    if keys is None:
-        keys = ["cfgScale", "steps"]
-
-    data = {}
-    for key in keys:
-        vals = [e[key] for e in elements]
-        data[key] = [min(vals), max(vals)]
-    return data
+    return gen_filehashes(filename, [algorithm])[algorithm]
+
+
+def grouped_stats(
+    groups: np.ndarray,
+    values: np.ndarray,
+    percentiles: Iterable[float] = (),
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Groups present in groups, their min, max and percentiles of values (a column per percentile).
+
+    One sort for all groups: within a group the values end up ordered, so min, max and every percentile
+    are lookups at offsets from the start of the group, interpolated like np.percentile does.
+    """
+    order = np.lexsort((values, groups))
+    groups, values = groups[order], values[order]
+    keys, starts, counts = np.unique(groups, return_index=True, return_counts=True)
+    last = starts + counts - 1
+    columns = []
+    for percentile in percentiles:
+        position = starts + (counts - 1) * percentile / 100
+        low = np.floor(position).astype(np.int64)
+        high = np.minimum(low + 1, last)
+        columns.append(values[low] + (values[high] - values[low]) * (position - low))
+    quantiles = np.stack(columns, axis=1) if columns else np.empty((len(keys), 0))
+    return keys, values[starts], values[last], quantiles
@@ -0,0 +1,220 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+from collections.abc import Callable, Iterable
+
+import loguru
+
+from src.models import FileFingerprint
+from src.scanner import FileScanner
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+# IN_MODIFY is left out on purpose: it fires on every write of a download
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify:
+    """Just enough of inotify(7) over ctypes, Linux only."""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.paths: dict[int, str] = {}
+
+    def add_watch(self, path: str, mask: int = WATCH_MASK) -> None:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        self.paths[wd] = path
+
+    def read(self, timeout: float | None) -> list[tuple[str, int, str]]:
+        """(directory, mask, name) of the events that arrive within timeout seconds, None waits forever."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((self.paths.get(wd, ""), mask, name))
+            if mask & IN_IGNORED:
+                # the watch is gone together with its directory
+                self.paths.pop(wd, None)
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class Watcher:
+    """Reports .safetensors files that appeared, changed or disappeared under roots.
+
+    inotify wakes the loop only when something happens, without it the tree is rescanned every
+    poll_interval seconds. A file is reported once its stat stayed the same for debounce seconds,
+    so downloads and copies in progress are left alone.
+    """
+
+    def __init__(
+        self,
+        roots: Iterable[str],
+        on_change: Callable[[dict[str, FileFingerprint], list[str]], None],
+        scanner: FileScanner,
+        files: dict[str, FileFingerprint],
+        debounce: float = 5.0,
+        poll_interval: float = 60.0,
+    ):
+        self.roots = list(roots)
+        self.on_change = on_change
+        self.scanner = scanner
+        self.extension = scanner.extension
+        # what was last reported, the baseline for changes
+        self.files = dict(files)
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        # path -> (when to look again, fingerprint seen last time or None if it's gone)
+        self.pending: dict[str, tuple[float, FileFingerprint | None]] = {}
+
+    def run(self) -> None:
+        inotify = None
+        try:
+            inotify = Inotify()
+            for root in self.roots:
+                self._watch_tree(inotify, root, initial=True)
+        except (OSError, AttributeError) as e:
+            # not Linux, or out of watches (fs.inotify.max_user_watches)
+            loguru.logger.warning(f"inotify unavailable ({e}), polling every {self.poll_interval}s")
+            if inotify is not None:
+                inotify.close()
+            inotify = None
+
+        loguru.logger.info(f"Watching {', '.join(self.roots)}")
+        next_poll = time.monotonic() + self.poll_interval
+        try:
+            while True:
+                deadline = min((due for due, _ in self.pending.values()), default=None)
+                if inotify is None:
+                    deadline = next_poll if deadline is None else min(deadline, next_poll)
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+
+                if inotify is not None:
+                    self._handle_events(inotify, inotify.read(timeout))
+                else:
+                    time.sleep(timeout or 0.0)
+                    if time.monotonic() >= next_poll:
+                        self._poll()
+                        next_poll = time.monotonic() + self.poll_interval
+
+                self._report_settled()
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+    def _watch_tree(self, inotify: Inotify, root: str, initial: bool = False) -> None:
+        for dirpath, _dirnames, filenames in os.walk(root):
+            inotify.add_watch(dirpath)
+            if not initial:
+                # files that were in place before the watch, e.g. in a directory moved in as a whole
+                for filename in filenames:
+                    self._schedule(os.path.join(dirpath, filename))
+
+    def _handle_events(self, inotify: Inotify, events: list[tuple[str, int, str]]) -> None:
+        for directory, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                loguru.logger.warning("inotify queue overflowed, rescanning")
+                self._poll()
+                continue
+
+            path = os.path.join(directory, name) if name else directory
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        self._watch_tree(inotify, path)
+                    except OSError as e:
+                        loguru.logger.warning(f"Can't watch {path}: {e}")
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    prefix = os.path.join(path, "")
+                    for known in [known for known in self.files if known.startswith(prefix)]:
+                        self._schedule(known)
+            elif name:
+                self._schedule(path)
+
+    def _poll(self) -> None:
+        files = self.scanner.scan(self.roots).files
+        for path, fingerprint in files.items():
+            if self.files.get(path) != fingerprint:
+                self._schedule(path)
+        for path in self.files.keys() - files.keys():
+            self._schedule(path)
+
+    def _schedule(self, path: str) -> None:
+        if path.endswith(self.extension):
+            self.pending[path] = (time.monotonic() + self.debounce, self._stat(path))
+
+    @staticmethod
+    def _stat(path: str) -> FileFingerprint | None:
+        try:
+            return FileFingerprint.from_path(path)
+        except FileNotFoundError:
+            return None
+
+    def _report_settled(self) -> None:
+        now = time.monotonic()
+        changed: dict[str, FileFingerprint] = {}
+        removed: list[str] = []
+        for path, (due, seen) in list(self.pending.items()):
+            if due > now:
+                continue
+            fingerprint = self._stat(path)
+            if fingerprint != seen:
+                # still being written, look again later
+                self.pending[path] = (now + self.debounce, fingerprint)
+                continue
+
+            del self.pending[path]
+            if fingerprint is None:
+                if path in self.files:
+                    removed.append(path)
+            elif self.files.get(path) != fingerprint:
+                changed[path] = fingerprint
+
+        if not changed and not removed:
+            return
+        loguru.logger.info(f"{len(changed)} files changed, {len(removed)} removed")
+        try:
+            self.on_change(changed, removed)
+        except Exception:
+            # the baseline stays as it was, so the same changes come up again
+            loguru.logger.exception(f"Failed to process changes, retrying in {self.poll_interval}s")
+            for path in [*changed, *removed]:
+                self.pending[path] = (now + self.poll_interval, self._stat(path))
+            return
+        self.files.update(changed)
+        for path in removed:
+            del self.files[path]
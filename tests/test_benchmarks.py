@@ -0,0 +1,45 @@
+from benchmarks.library import LORAS_FOLDER, MODELS_FOLDER, make_library
+from benchmarks.mockapi import MockCivitai, catalog
+
+from src.civitai import AsyncCivitai
+from src.db import DBApi
+from src.metadata import MetadataManipulator
+from src.ratelimit import RateLimiter, RetryPolicy
+from src.tensorreader import get_corrupted_files
+
+
+def test_library_is_reused_and_its_corrupted_files_are_found(tmp_path):
+    library = make_library(str(tmp_path), files_count=20, size=4096, corrupt=4, seed=1)
+    again = make_library(str(tmp_path), files_count=20, size=4096, corrupt=4, seed=1)
+
+    assert again.files == library.files
+    corrupted = sorted(path for path, file in zip(library.paths(), library.files, strict=True) if file.corrupted)
+    assert len(corrupted) == 4
+    assert get_corrupted_files(str(tmp_path), library.paths(), level="header", workers=2) == corrupted
+
+
+def test_sync_against_the_mock_api_binds_every_known_file(tmp_path):
+    library = make_library(str(tmp_path / "library"), files_count=30, size=4096)
+    mock = MockCivitai(catalog(library, versions=3, images=1), throttle=0.3, retry_after=0, seed=1)
+    rate_limiter = RateLimiter(rate=1000, max_per_host=8, retry_policy=RetryPolicy(max_retries=20))
+    api = AsyncCivitai("https://civitai.test/api/v1", "token", rate_limiter=rate_limiter, transport=mock.transport())
+    db_api = DBApi(str(tmp_path / "db.sqlite"))
+
+    MetadataManipulator(
+        csv_file_path="",
+        base_path=library.root,
+        models_path=MODELS_FOLDER,
+        loras_path=LORAS_FOLDER,
+        work_dir=str(tmp_path / "work"),
+        civitai_api=api,
+        db_api=db_api,
+        hash_algorithms=["sha256"],
+    )
+
+    bound = {record.filepath for record in db_api.get_filehashes().values() if record.modelversionid}
+    # every tenth file is unknown to the mock
+    assert bound == {path for index, path in enumerate(library.paths()) if index % 10}
+    assert mock.throttled > 0
+    assert rate_limiter.stats.throttled_responses == mock.throttled
+    assert mock.requests["GET model"] == 9
+    db_api.conn.close()
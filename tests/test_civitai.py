@@ -0,0 +1,257 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from src.civitai import AsyncCivitai, index_by_hash
+from src.db import DBApi
+from src.httpcache import ResponseCache
+from src.metadata import MetadataManipulator
+from src.models import CivitaiModelVersion, DBAPIFileHash
+from src.ratelimit import RateLimiter, RetryPolicy
+
+BASE_URL = "https://civitai.test/api/v1"
+
+
+def version_json(version_id: int, model_id: int, sha256: str) -> dict:
+    return {
+        "id": version_id,
+        "modelId": model_id,
+        "name": f"v{version_id}",
+        "baseModel": "SDXL 1.0",
+        "downloadUrl": f"https://civitai.test/api/download/models/{version_id}",
+        "files": [
+            {
+                "id": version_id,
+                "sizeKB": 1.0,
+                "name": f"model-{version_id}.safetensors",
+                "type": "Model",
+                "downloadUrl": f"https://civitai.test/api/download/models/{version_id}",
+                "metadata": {"format": "SafeTensor", "size": "pruned", "fp": "fp16"},
+                "hashes": {"SHA256": sha256},
+            },
+        ],
+    }
+
+
+def make_api(handler, **kwargs) -> AsyncCivitai:
+    kwargs.setdefault("rate_limiter", RateLimiter(rate=1000, max_per_host=16, retry_policy=RetryPolicy(max_retries=0)))
+    return AsyncCivitai(BASE_URL, "token", transport=httpx.MockTransport(handler), **kwargs)
+
+
+def call(api: AsyncCivitai, method: str, *args):
+    async def main():
+        async with api:
+            return await getattr(api, method)(*args)
+
+    return asyncio.run(main())
+
+
+def test_get_model_version_by_hash():
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(200, json=version_json(10, 1, "AB" * 32))
+
+    model_version = call(make_api(handler), "get_modelversion_by_hash", "ab" * 32)
+
+    assert model_version.id == 10
+    assert model_version.model_id() == 1
+    assert requests[0].url == f"{BASE_URL}/model-versions/by-hash/{'ab' * 32}"
+    assert requests[0].headers["Authorization"] == "Bearer token"
+
+
+@pytest.mark.parametrize("method", ["get_model", "get_modelversion_by_hash"])
+def test_not_found_is_none(method):
+    api = make_api(lambda request: httpx.Response(404, json={"error": "Not found"}))
+    assert call(api, method, 1) is None
+
+
+def test_errors_raise():
+    api = make_api(lambda request: httpx.Response(400, json={"error": "Bad request"}))
+    with pytest.raises(httpx.HTTPStatusError):
+        call(api, "get_model", 1)
+
+
+def test_requests_need_the_context_manager():
+    api = make_api(lambda request: httpx.Response(200, json={}))
+    with pytest.raises(RuntimeError):
+        asyncio.run(api.get_model(1))
+
+
+def test_client_is_reused_across_event_loops():
+    api = make_api(lambda request: httpx.Response(200, content=json.dumps(version_json(1, 1, "00" * 32))))
+    assert call(api, "get_modelversion_by_hash", "00").id == 1
+    assert call(api, "get_modelversion_by_hash", "00").id == 1
+    assert api.client is None
+
+
+def sha256(n: int) -> str:
+    return f"{n:064x}"
+
+
+class ByHashApi:
+    """Knows the versions of files 0..known-1 by their sha256, the bulk POST answers with post_status."""
+
+    def __init__(self, known: int, post_status: int = 200, post_misses: frozenset[str] = frozenset()):
+        self.versions = {sha256(n).upper(): version_json(100 + n, 1 + n, sha256(n).upper()) for n in range(known)}
+        self.post_status = post_status
+        self.post_misses = post_misses
+        self.posted: list[list[str]] = []
+        self.got: list[str] = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        if request.method == "POST":
+            filehashes = json.loads(request.content)
+            self.posted.append(filehashes)
+            if self.post_status != 200:
+                return httpx.Response(self.post_status, json={"error": "Unavailable"})
+            found = {
+                filehash.upper()
+                for filehash in filehashes
+                if filehash.upper() in self.versions and filehash not in self.post_misses
+            }
+            return httpx.Response(200, json=[self.versions[filehash] for filehash in sorted(found)])
+        filehash = request.url.path.rsplit("/", 1)[-1]
+        self.got.append(filehash)
+        if filehash.upper() not in self.versions:
+            return httpx.Response(404, json={"error": "Not found"})
+        return httpx.Response(200, json=self.versions[filehash.upper()])
+
+
+def file_items(count: int) -> list[DBAPIFileHash]:
+    # the primary blake3 digest is unknown to the API, the sha256 one is found
+    return [
+        DBAPIFileHash(filepath=f"/models/{n}.safetensors", filehash=f"b3{n:062x}", digests={"sha256": sha256(n)})
+        for n in range(count)
+    ]
+
+
+def manipulator(tmp_path, api: AsyncCivitai, batch_size: int = 100) -> MetadataManipulator:
+    for folder in ("models", "loras"):
+        (tmp_path / folder).mkdir(exist_ok=True)
+    return MetadataManipulator(
+        csv_file_path="",
+        base_path=str(tmp_path),
+        models_path="models",
+        loras_path="loras",
+        work_dir=str(tmp_path / "work"),
+        civitai_api=api,
+        db_api=DBApi(str(tmp_path / "db.sqlite")),
+        by_hash_batch_size=batch_size,
+    )
+
+
+def find(tmp_path, api: AsyncCivitai, items: list[DBAPIFileHash], batch_size: int = 100):
+    meta = manipulator(tmp_path, api, batch_size)
+
+    async def main():
+        async with api:
+            return await meta._find_modelversions(api, items)
+
+    try:
+        return asyncio.run(main())
+    finally:
+        meta.db_api.conn.close()
+
+
+def test_index_by_hash_keys_are_upper_case():
+    model_version = CivitaiModelVersion.model_validate(version_json(1, 1, "ab" * 32))
+    model_version.files[0].hashes.AutoV2 = "abcdef0123"
+
+    by_hash = index_by_hash([model_version])
+
+    assert by_hash == {"AB" * 32: model_version, "ABCDEF0123": model_version}
+
+
+def test_get_modelversions_by_hashes_posts_the_hashes():
+    mock = ByHashApi(known=2)
+    found = call(make_api(mock), "get_modelversions_by_hashes", [sha256(0), sha256(1), sha256(5)])
+
+    assert mock.posted == [[sha256(0), sha256(1), sha256(5)]]
+    assert sorted(model_version.id for model_version in found) == [100, 101]
+
+
+def test_hashes_are_posted_in_batches(tmp_path):
+    mock = ByHashApi(known=7)
+    items = file_items(7)
+
+    found = find(tmp_path, make_api(mock), items, batch_size=3)
+
+    # two hashes per file, the batches are sent at once
+    assert sorted(len(batch) for batch in mock.posted) == [2, 3, 3, 3, 3]
+    assert sorted(filehash for batch in mock.posted for filehash in batch) == sorted(
+        filehash for item in items for filehash in item.lookup_hashes()
+    )
+    assert [model_version.id for model_version in found] == [100 + n for n in range(7)]
+    assert mock.got == []
+
+
+def test_misses_of_the_post_are_looked_up_one_by_one(tmp_path):
+    mock = ByHashApi(known=4, post_misses=frozenset({sha256(2)}))
+    items = file_items(5)
+
+    found = find(tmp_path, make_api(mock), items)
+
+    assert [model_version and model_version.id for model_version in found] == [100, 101, 102, 103, None]
+    # every hash of the files the POST found nothing for
+    assert sorted(mock.got) == sorted([items[2].filehash, sha256(2), items[4].filehash, sha256(4)])
+
+
+@pytest.mark.parametrize("status", [404, 500])
+def test_failed_post_falls_back_to_single_lookups(tmp_path, status):
+    mock = ByHashApi(known=3, post_status=status)
+    items = file_items(3)
+
+    found = find(tmp_path, make_api(mock), items)
+
+    assert [model_version.id for model_version in found] == [100, 101, 102]
+    assert len(mock.posted) == 1
+    assert sorted(mock.got) == sorted(filehash for item in items for filehash in item.lookup_hashes())
+
+
+def test_hashes_cached_as_not_found_are_not_posted(tmp_path):
+    db_api = DBApi(str(tmp_path / "cache.sqlite"))
+    cache = ResponseCache(db_api, {r"/model-versions/by-hash/": 3600}, not_found_ttl=3600)
+    items = file_items(2)
+    call(make_api(ByHashApi(known=0), cache=cache), "get_modelversion_by_hash", items[0].filehash)
+
+    mock = ByHashApi(known=2)
+    call(make_api(mock, cache=cache), "get_modelversions_by_hashes", items[0].lookup_hashes())
+
+    assert mock.posted == [[sha256(0)]]
+    assert cache.stats.negative_hits == 1
+    db_api.conn.close()
+
+
+def test_bad_payload_loses_only_its_own_lookup(tmp_path):
+    mock = ByHashApi(known=3, post_status=500)
+    mock.versions[sha256(1).upper()] = {"id": "not a version"}
+
+    found = find(tmp_path, make_api(mock), file_items(3))
+
+    assert [model_version and model_version.id for model_version in found] == [100, None, 102]
+
+
+def test_bad_payload_loses_only_its_own_model(tmp_path):
+    def handler(request: httpx.Request) -> httpx.Response:
+        model_id = int(request.url.path.rsplit("/", 1)[-1])
+        if model_id == 2:
+            return httpx.Response(200, json={"id": model_id, "modelVersions": "none"})
+        return httpx.Response(
+            200,
+            json={"id": model_id, "name": f"Model {model_id}", "type": "LORA", "modelVersions": []},
+        )
+
+    api = make_api(handler)
+    meta = manipulator(tmp_path, api)
+
+    async def main():
+        async with api:
+            await meta._fetch_models(api, [1, 2, 3])
+
+    asyncio.run(main())
+    assert meta.db_api.get_fetched_model_ids() == {1, 3}
+    meta.db_api.conn.close()
@@ -0,0 +1,105 @@
+import pytest
+
+from src.db import DBApi
+from src.models import FileFingerprint
+
+
+@pytest.fixture
+def db_api(tmp_path):
+    db_api = DBApi(str(tmp_path / "db.sqlite"))
+    yield db_api
+    db_api.conn.close()
+
+
+def fingerprint(n: int) -> FileFingerprint:
+    return FileFingerprint(size=n, mtime_ns=n, inode=n)
+
+
+def test_batched_writes_to_a_file_keep_their_order(db_api):
+    db_api.update_filehash("/a", "A", fingerprint(1), {"blake3": "A"})
+    db_api.update_data("/a", 1, 10)
+
+    with db_api.batch(flush_interval=3600) as batch:
+        # a new hash drops the binding, the next update binds the file again
+        batch.update_filehash("/a", "B", fingerprint(2), {"blake3": "B", "sha256": "b"})
+        batch.update_data("/a", 2, 20)
+        batch.update_fingerprint("/a", fingerprint(3))
+        batch.update_filehash("/c", "C", fingerprint(4))
+        batch.update_data("/c", 3, 30)
+        # the same hash again keeps the binding
+        batch.update_filehash("/a", "B", fingerprint(5))
+        batch.update_fingerprint("/c", fingerprint(6))
+        assert db_api.get_filehashes()["/a"].filehash == "A"
+
+    records = db_api.get_filehashes()
+    assert records["/a"].filehash == "B"
+    assert (records["/a"].modelid, records["/a"].modelversionid) == (2, 20)
+    assert records["/a"].fingerprint == fingerprint(5)
+    assert records["/a"].digests == {"blake3": "B", "sha256": "b"}
+    assert (records["/c"].filehash, records["/c"].modelversionid) == ("C", 30)
+    assert records["/c"].fingerprint == fingerprint(6)
+
+
+def test_removed_and_added_again_in_one_batch(db_api):
+    db_api.update_filehash("/a", "A", fingerprint(1))
+    db_api.update_data("/a", 1, 10)
+
+    with db_api.batch(flush_interval=3600) as batch:
+        batch.remove_filehash("/a")
+        batch.update_filehash("/a", "A", fingerprint(2))
+
+    record = db_api.get_filehashes()["/a"]
+    assert record.modelversionid is None
+    assert record.fingerprint == fingerprint(2)
+
+
+def test_batch_flushes_every_flush_rows(db_api):
+    with db_api.batch(flush_interval=3600, flush_rows=3) as batch:
+        for n in range(4):
+            batch.update_filehash(f"/{n}", str(n), fingerprint(n))
+        # the fourth write waits for the next flush
+        assert sorted(db_api.get_filehashes()) == ["/0", "/1", "/2"]
+    assert len(db_api.get_filehashes()) == 4
+
+
+def test_transaction_rolls_back_on_error(db_api):
+    db_api.update_filehash("/a", "A", fingerprint(1))
+
+    def fail() -> None:
+        with db_api.transaction():
+            db_api.update_data("/a", 1, 10)
+            # nested blocks and batches join the outer transaction
+            with db_api.transaction(), db_api.batch() as batch:
+                batch.update_filehash("/b", "B", fingerprint(2))
+            raise RuntimeError
+
+    with pytest.raises(RuntimeError):
+        fail()
+
+    records = db_api.get_filehashes()
+    assert sorted(records) == ["/a"]
+    assert records["/a"].modelversionid is None
+
+    with db_api.transaction():
+        db_api.update_data("/a", 1, 10)
+    assert db_api.get_filehashes()["/a"].modelversionid == 10
+
+
+def test_failed_downloads_are_retried_only_on_request(db_api):
+    for name in ("active", "failed", "done"):
+        db_api.enqueue_download(f"https://civitai.test/{name}", "/models")
+    downloads = {item.url.rsplit("/", 1)[1]: item.id for item in db_api.get_downloads()}
+    db_api.update_download(downloads["active"], "active")
+    db_api.update_download(downloads["failed"], "failed", error="Hash mismatch")
+    db_api.update_download(downloads["done"], "done", filepath="/models/done.safetensors")
+
+    # an interrupted transfer resumes, a failed one keeps its error
+    db_api.requeue_unfinished_downloads()
+    assert [item.id for item in db_api.get_downloads(status="pending")] == [downloads["active"]]
+    assert [item.error for item in db_api.get_downloads(status="failed")] == ["Hash mismatch"]
+
+    db_api.requeue_unfinished_downloads(retry_failed=True)
+    pending = db_api.get_downloads(status="pending")
+    assert [item.id for item in pending] == [downloads["active"], downloads["failed"]]
+    assert [item.error for item in pending] == [None, None]
+    assert [item.id for item in db_api.get_downloads(status="done")] == [downloads["done"]]
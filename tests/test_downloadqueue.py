@@ -0,0 +1,136 @@
+import argparse
+import hashlib
+import io
+import re
+
+import httpx
+import pytest
+
+from tqdm import tqdm
+
+import src.downloadqueue
+import src.run
+
+from src.civitai import Civitai
+from src.db import DBApi
+from src.downloadqueue import DownloadQueue
+from src.models import Settings
+from src.ratelimit import RateLimiter
+
+FILES = {f"https://civitai.test/api/download/models/{n}": bytes([n]) * (3000 + n) for n in range(1, 5)}
+
+
+def serve(request: httpx.Request) -> httpx.Response:
+    content = FILES.get(str(request.url))
+    if content is None:
+        return httpx.Response(404)
+    headers = {"Content-Disposition": f'attachment; filename="{request.url.path.rsplit("/", 1)[1]}.safetensors"'}
+    if match := re.fullmatch(r"bytes=(\d+)-(\d+)", request.headers.get("Range", "")):
+        start, end = int(match[1]), min(int(match[2]), len(content) - 1)
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(content)}"
+        return httpx.Response(206, headers=headers, content=content[start : end + 1])
+    return httpx.Response(200, headers=headers, content=content)
+
+
+def version_json(version_id: int) -> dict:
+    url = f"https://civitai.test/api/download/models/{version_id}"
+    return {
+        "id": version_id,
+        "modelId": version_id,
+        "name": f"v{version_id}",
+        "baseModel": "SDXL 1.0",
+        "downloadUrl": url,
+        "files": [
+            {
+                "id": version_id,
+                "sizeKB": len(FILES[url]) / 1024,
+                "name": f"model-{version_id}.safetensors",
+                "type": "Model",
+                "downloadUrl": url,
+                "metadata": {"format": "SafeTensor", "size": "pruned", "fp": "fp16"},
+                "hashes": {"SHA256": hashlib.sha256(FILES[url]).hexdigest()},
+            },
+        ],
+    }
+
+
+@pytest.fixture
+def db_api(tmp_path):
+    db_api = DBApi(str(tmp_path / "db.sqlite"))
+    yield db_api
+    db_api.conn.close()
+
+
+def test_progress_covers_the_whole_queue(tmp_path, db_api, monkeypatch):
+    bars: list[tqdm] = []
+    totals: list[int] = []
+
+    def progress(**kwargs):
+        totals.append(kwargs["total"])
+        bars.append(tqdm(**kwargs, file=io.StringIO()))
+        return bars[-1]
+
+    monkeypatch.setattr(src.downloadqueue, "tqdm", progress)
+    api = Civitai("https://civitai.test/api/v1", "token")  # noqa: S106
+    api.client = httpx.Client(transport=httpx.MockTransport(serve))
+    queue = DownloadQueue(api, db_api, concurrency=4, segments=2)
+    for url, content in FILES.items():
+        # CivitAI rounds sizes to KB, the transfers correct them
+        db_api.enqueue_download(
+            url,
+            str(tmp_path / "models"),
+            hashes={"SHA256": hashlib.sha256(content).hexdigest()},
+            size=len(content) // 1024 * 1024,
+        )
+    db_api.enqueue_download("https://civitai.test/api/download/models/404", str(tmp_path / "models"), size=1000)
+
+    finished = queue.run()
+
+    assert sorted(item.status for item in finished) == ["done"] * len(FILES) + ["failed"]
+    (bar,) = bars
+    # known before the first transfer starts
+    assert totals == [sum(len(content) // 1024 * 1024 for content in FILES.values()) + 1000]
+    assert bar.n == sum(len(content) for content in FILES.values())
+    # the expected size of the failed download is still part of the total
+    assert bar.total == bar.n + 1000
+
+
+def test_download_command_skips_versions_it_cannot_fetch(tmp_path, db_api, monkeypatch):
+    def handler(request: httpx.Request) -> httpx.Response:
+        version_id = int(request.url.path.rsplit("/", 1)[1])
+        if request.url.path.startswith("/api/v1/model-versions/"):
+            if version_id == 2:
+                return httpx.Response(500)
+            if version_id == 3:
+                return httpx.Response(200, json={"id": "not a version"})
+            return httpx.Response(200, json=version_json(version_id))
+        return serve(request)
+
+    class MockCivitai(Civitai):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.client = httpx.Client(transport=httpx.MockTransport(handler))
+
+    monkeypatch.setattr(src.run, "Civitai", MockCivitai)
+    settings = Settings(
+        CIVITAI_API_BASE_URL="https://civitai.test/api/v1",
+        CIVITAI_API_TOKEN="token",  # noqa: S106
+        MODEL_LIST_FILE="",
+        BASE_PATH=str(tmp_path),
+        WORK_DIR=str(tmp_path / "work"),
+        MODELS_PATH="models",
+        LORAS_PATH="loras",
+    )
+    args = argparse.Namespace(
+        model_version_ids=[1, 2, 3, 4],
+        priority=0,
+        concurrency=2,
+        bandwidth=0,
+        retry_failed=False,
+    )
+
+    src.run.download(args, settings, db_api, RateLimiter())
+
+    downloads = db_api.get_downloads()
+    assert [item.modelversionid for item in downloads] == [1, 4]
+    assert [item.status for item in downloads] == ["done", "done"]
@@ -0,0 +1,42 @@
+import pytest
+
+from blake3 import blake3
+
+import src.hasher
+
+from src.hasher import hash_files
+from src.models import FileFingerprint
+from src.utils import MultiHasher, gen_filehashes
+
+
+@pytest.fixture
+def files(tmp_path) -> list[tuple[str, FileFingerprint]]:
+    paths = []
+    for n in range(6):
+        path = tmp_path / f"{n}.safetensors"
+        path.write_bytes(bytes([n]) * (1 << 20) * (n + 1))
+        paths.append(str(path))
+    return [(path, FileFingerprint.from_path(path)) for path in paths]
+
+
+@pytest.mark.parametrize(("workers", "max_threads"), [(4, 1), (1, blake3.AUTO)])
+def test_blake3_is_single_threaded_inside_the_pool(files, monkeypatch, workers, max_threads):
+    calls: list[int] = []
+
+    def spy(path, algorithms, **kwargs):
+        calls.append(kwargs["max_threads"])
+        return gen_filehashes(path, algorithms, **kwargs)
+
+    monkeypatch.setattr(src.hasher, "gen_filehashes", spy)
+    digests = {path: digests for path, _, digests in hash_files(files, ["blake3", "sha256"], workers=workers)}
+
+    assert calls == [max_threads] * len(files)
+    assert digests == {path: gen_filehashes(path, ["blake3", "sha256"]) for path, _ in files}
+
+
+def test_single_threaded_blake3_gives_the_same_digest():
+    data = b"x" * (3 << 20)
+    hashers = [MultiHasher(["blake3"], max_threads) for max_threads in (1, blake3.AUTO)]
+    for hasher in hashers:
+        hasher.update(data)
+    assert hashers[0].hexdigests() == hashers[1].hexdigests() == {"blake3": blake3(data).hexdigest()}
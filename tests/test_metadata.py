@@ -0,0 +1,125 @@
+import os
+
+import httpx
+import numpy as np
+import pytest
+
+from benchmarks.library import safetensors_bytes
+
+import src.metadata
+
+from src.civitai import AsyncCivitai
+from src.db import DBApi
+from src.metadata import MetadataManipulator, verify_filehashes
+from src.models import FileFingerprint
+from src.scanner import FileScanner
+from src.utils import gen_filehash
+
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    for folder in ("models", "loras"):
+        (tmp_path / folder).mkdir()
+    for name in ("a", "b"):
+        (tmp_path / "loras" / f"{name}.safetensors").write_bytes(name.encode() * 1024)
+    db_api = DBApi(str(tmp_path / "db.sqlite"))
+
+    hashed: list[str] = []
+    hash_files = src.metadata.hash_files
+
+    def spy(files, **kwargs):
+        files = list(files)
+        hashed.extend(path for path, _ in files)
+        return hash_files(files, **kwargs)
+
+    monkeypatch.setattr(src.metadata, "hash_files", spy)
+
+    def manipulator() -> MetadataManipulator:
+        # CivitAI knows none of the files, so the bindings stay as the test sets them
+        api = AsyncCivitai(
+            "https://civitai.test/api/v1",
+            "token",
+            transport=httpx.MockTransport(lambda request: httpx.Response(404, json={"error": "Not found"})),
+        )
+        return MetadataManipulator(
+            csv_file_path="",
+            base_path=str(tmp_path),
+            models_path="models",
+            loras_path="loras",
+            work_dir=str(tmp_path / "work"),
+            civitai_api=api,
+            db_api=db_api,
+        )
+
+    def sync() -> list[str]:
+        hashed.clear()
+        manipulator()
+        return sorted(hashed)
+
+    yield tmp_path, db_api, sync, manipulator
+    db_api.conn.close()
+
+
+def verify(tmp_path, db_api: DBApi) -> dict[str, list[str]]:
+    # --verify lists every directory
+    scan = FileScanner(db_api).scan([str(tmp_path / "models"), str(tmp_path / "loras")], full=True)
+    return verify_filehashes(db_api, scan.files)
+
+
+def test_file_rewritten_in_place_is_rehashed_and_unbound(library):
+    tmp_path, db_api, sync, _ = library
+    path_a, path_b = (str(tmp_path / "loras" / f"{name}.safetensors") for name in ("a", "b"))
+
+    assert sync() == [path_a, path_b]
+    for model_version_id, path in enumerate((path_a, path_b), start=1):
+        db_api.update_data(path, 1, model_version_id)
+    assert sync() == []
+    assert verify(tmp_path, db_api) == {"changed": [], "new": [], "unverified": [], "missing": []}
+
+    # same size, new content, written through the same inode
+    stat = os.stat(path_a)
+    with open(path_a, "r+b") as f:
+        f.write(b"c" * 1024)
+    os.utime(path_a, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert FileFingerprint.from_path(path_a).inode == stat.st_ino
+
+    assert verify(tmp_path, db_api)["changed"] == [path_a]
+
+    assert sync() == [path_a]
+    records = db_api.get_filehashes()
+    assert records[path_a].filehash == gen_filehash(path_a)
+    assert records[path_a].modelversionid is None
+    assert records[path_a].fingerprint == FileFingerprint.from_path(path_a)
+    assert records[path_b].modelversionid == 2
+    assert verify(tmp_path, db_api)["changed"] == []
+
+
+def test_records_without_fingerprints_are_trusted(library):
+    tmp_path, db_api, sync, _ = library
+    path_a = str(tmp_path / "loras" / "a.safetensors")
+    sync()
+    # as stored by versions before fingerprints
+    db_api.conn.execute("UPDATE file_hashes SET size = NULL, mtime_ns = NULL, inode = NULL")
+    db_api.conn.commit()
+
+    assert sorted(verify(tmp_path, db_api)["unverified"]) == [path_a, str(tmp_path / "loras" / "b.safetensors")]
+    assert sync() == []
+    assert db_api.get_filehashes()[path_a].fingerprint == FileFingerprint.from_path(path_a)
+
+
+def test_changed_files_are_checked_and_indexed(library):
+    tmp_path, db_api, _, manipulator = library
+    meta = manipulator()
+    good = tmp_path / "loras" / "c.safetensors"
+    good.write_bytes(safetensors_bytes("lora", 4096, np.random.default_rng(0)))
+    broken = tmp_path / "loras" / "d.safetensors"
+    broken.write_bytes(safetensors_bytes("lora", 4096, np.random.default_rng(1))[:-1])
+
+    meta.sync_files({str(path): FileFingerprint.from_path(str(path)) for path in (good, broken)}, [])
+
+    checks = db_api.get_integrity_checks()
+    assert checks[str(good)].error is None
+    assert checks[str(broken)].error.startswith("tensors take")
+    headers = db_api.get_safetensors_headers()
+    assert headers[str(good)].fingerprint == FileFingerprint.from_path(str(good))
+    assert str(broken) not in headers
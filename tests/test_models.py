@@ -0,0 +1,140 @@
+from itertools import groupby
+from operator import itemgetter
+
+import numpy as np
+
+from src.models import GENERATION_PERCENTILES, CivitaiModelVersion, compute_generation_stats
+
+
+def image(meta: dict | None, has_meta: bool = True, width: int = 832, height: int = 1216) -> dict:
+    return {
+        "url": "https://image.civitai.test/1.jpeg",
+        "nsfwLevel": 1,
+        "width": width,
+        "height": height,
+        "hash": "U5F~5@~q00004n%M",
+        "type": "image",
+        "hasMeta": has_meta,
+        "onSite": False,
+        "meta": meta,
+    }
+
+
+def model_version(version_id: int, images: list[dict]) -> CivitaiModelVersion:
+    return CivitaiModelVersion.model_validate(
+        {
+            "id": version_id,
+            "modelId": 1,
+            "name": f"v{version_id}",
+            "baseModel": "SDXL 1.0",
+            "downloadUrl": f"https://civitai.test/api/download/models/{version_id}",
+            "files": [],
+            "images": images,
+        },
+    )
+
+
+IMAGES = [
+    image({"sampler": "Euler a", "cfgScale": 7, "steps": 20, "Size": "1024x1024"}),
+    image({"sampler": "Euler a", "cfgScale": 5.5, "steps": 30}),
+    image({"sampler": "Euler a", "cfgScale": "8", "steps": "28"}),
+    image({"sampler": "DPM++ 2M", "Schedule type": "Karras", "cfgScale": 4, "steps": 25}),
+    image({"sampler": "DPM++ 2M", "Schedule type": "Karras", "cfgScale": 6, "steps": 35, "Size": "1024x1024"}),
+    image({"sampler": "DPM++ 2M", "Schedule type": "Karras", "cfgScale": 3.5, "steps": 35}),
+    # missing or non-numeric cfgScale and steps
+    image({"sampler": "DPM++ 2M", "Schedule type": "Karras", "steps": 30}),
+    image({"sampler": "DPM++ 2M", "Schedule type": "Karras", "cfgScale": None, "steps": 30}),
+    image({"sampler": "DPM++ 2M", "cfgScale": "auto", "steps": 20}),
+    image({"sampler": "DPM++ SDE", "cfgScale": 7, "steps": [20]}),
+    # not taken into account at all
+    image({"sampler": "LCM", "cfgScale": 1, "steps": 8}, has_meta=False),
+    image({"cfgScale": 1, "steps": 8}),
+    image(None),
+]
+
+
+def legacy_get_meta(images: list[dict]) -> dict[str, dict[str, list]]:
+    """What the templates showed before the stats were computed by numpy, it needed numbers in every image."""
+    elements = [dict(x["meta"]) for x in images if x["hasMeta"] and x["meta"] and x["meta"].get("sampler")]
+    for element in elements:
+        sampler_full = element.get("sampler")
+        if element.get("Schedule type"):
+            sampler_full = f"{sampler_full} {element.get('Schedule type')}"
+        element["sampler_full"] = sampler_full
+    elements.sort(key=itemgetter("sampler_full"))
+
+    result = {}
+    for sampler, sampler_group in groupby(elements, key=itemgetter("sampler_full")):
+        group = list(sampler_group)
+        result[sampler] = {
+            key: [min(e[key] for e in group), max(e[key] for e in group)] for key in ("cfgScale", "steps")
+        }
+        result[sampler]["images"] = len(group)
+    return result
+
+
+def numeric(images: list[dict]) -> list[dict]:
+    """The images the old aggregation could handle, with numbers sent as strings converted."""
+
+    def number(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    converted = []
+    for x in images:
+        meta = x["meta"] or {}
+        cfg_scale, steps = number(meta.get("cfgScale")), number(meta.get("steps"))
+        if cfg_scale is not None and steps is not None:
+            converted.append({**x, "meta": {**meta, "cfgScale": cfg_scale, "steps": steps}})
+    return converted
+
+
+def test_generation_stats_match_the_old_aggregation():
+    samplers = model_version(1, IMAGES).generation_stats().samplers
+    expected = legacy_get_meta(numeric(IMAGES))
+
+    assert list(samplers) == list(expected) == ["DPM++ 2M Karras", "Euler a"]
+    for name, info in samplers.items():
+        assert info.cfgScale == expected[name]["cfgScale"]
+        assert info.steps == expected[name]["steps"]
+        assert info.images == expected[name]["images"]
+    # numbers are shown as CivitAI sends them, 7 and not 7.0
+    assert [type(value) for value in samplers["Euler a"].cfgScale] == [float, int]
+    assert samplers["Euler a"].steps == [20, 30]
+
+
+def test_generation_stats_percentiles():
+    samplers = model_version(1, IMAGES).generation_stats().samplers
+
+    assert (
+        samplers["DPM++ 2M Karras"].cfgScale_percentiles == np.percentile([4, 6, 3.5], GENERATION_PERCENTILES).tolist()
+    )
+    assert samplers["DPM++ 2M Karras"].steps_percentiles == [30, 35, 35]
+    assert samplers["Euler a"].cfgScale_percentiles[1] == 7
+
+
+def test_generation_stats_of_several_versions_at_once():
+    versions = [
+        model_version(1, IMAGES),
+        model_version(2, IMAGES[3:6]),
+        model_version(3, IMAGES[6:]),
+        model_version(4, []),
+    ]
+    stats = compute_generation_stats(versions)
+
+    assert stats[1] == model_version(1, IMAGES).generation_stats()
+    assert stats[2] == model_version(2, IMAGES[3:6]).generation_stats()
+    assert list(stats[2].samplers) == ["DPM++ 2M Karras"]
+    # only images without usable numbers
+    assert stats[3].samplers == {}
+    assert stats[4].samplers == {}
+    assert stats[4].resolution is None
+
+
+def test_resolution_and_scheduler_are_the_most_common_ones():
+    stats = model_version(1, IMAGES).generation_stats()
+
+    assert stats.resolution == "832x1216"
+    assert stats.scheduler == "Karras"
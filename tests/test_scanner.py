@@ -0,0 +1,107 @@
+import os
+
+import pytest
+
+from src.db import DBApi
+from src.models import FileFingerprint
+from src.scanner import FileScanner
+
+# directory mtimes well in the past, so the scanner trusts them
+OLD_MTIME_NS = 1_000_000_000_000_000_000
+
+
+def set_mtime(path, mtime_ns: int) -> None:
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+@pytest.fixture
+def library(tmp_path):
+    root = tmp_path / "models"
+    for folder in ("a", "b"):
+        (root / folder).mkdir(parents=True)
+        (root / folder / f"{folder}.safetensors").write_bytes(b"x" * 16)
+    (root / "a" / "notes.txt").write_text("not a model")
+    for path in (root / "a", root / "b", root):
+        set_mtime(path, OLD_MTIME_NS)
+    db_api = DBApi(str(tmp_path / "db.sqlite"))
+    yield root, FileScanner(db_api, mtime_granularity_ns=0)
+    db_api.conn.close()
+
+
+def test_unchanged_directories_are_not_listed(library):
+    root, scanner = library
+
+    first = scanner.scan([str(root)])
+    assert sorted(first.files) == [str(root / "a" / "a.safetensors"), str(root / "b" / "b.safetensors")]
+    assert (first.scanned_dirs, first.cached_dirs) == (3, 0)
+
+    again = scanner.scan([str(root)])
+    assert again.files == first.files
+    assert (again.scanned_dirs, again.cached_dirs) == (0, 3)
+
+
+def test_new_file(library):
+    root, scanner = library
+    scanner.scan([str(root)])
+
+    (root / "b" / "c.safetensors").write_bytes(b"y")
+    set_mtime(root / "b", OLD_MTIME_NS + 1)
+
+    result = scanner.scan([str(root)])
+    assert str(root / "b" / "c.safetensors") in result.files
+    assert (result.scanned_dirs, result.cached_dirs) == (1, 2)
+
+
+def test_deleted_file(library):
+    root, scanner = library
+    scanner.scan([str(root)])
+
+    os.remove(root / "a" / "a.safetensors")
+    set_mtime(root / "a", OLD_MTIME_NS + 1)
+
+    result = scanner.scan([str(root)])
+    assert sorted(result.files) == [str(root / "b" / "b.safetensors")]
+    assert scanner.scan([str(root)]).files == result.files
+
+
+def test_file_modified_in_an_unchanged_directory(library):
+    root, scanner = library
+    scanner.scan([str(root)])
+    path = root / "a" / "a.safetensors"
+
+    # rewritten in place: the directory mtime stays as it was
+    path.write_bytes(b"z" * 32)
+    set_mtime(root / "a", OLD_MTIME_NS)
+
+    result = scanner.scan([str(root)])
+    assert result.cached_dirs == 3
+    assert result.files[str(path)] == FileFingerprint.from_path(str(path))
+    assert result.files[str(path)].size == 32
+    # and it's stored for the next scan
+    assert scanner.scan([str(root)]).files[str(path)].size == 32
+
+
+def test_full_scan_lists_every_directory(library):
+    root, scanner = library
+    scanner.scan([str(root)])
+
+    # a change the directory mtime doesn't show, as on filesystems with coarse mtimes
+    (root / "b" / "c.safetensors").write_bytes(b"y")
+    set_mtime(root / "b", OLD_MTIME_NS)
+    assert str(root / "b" / "c.safetensors") not in scanner.scan([str(root)]).files
+
+    result = scanner.scan([str(root)], full=True)
+    assert (result.scanned_dirs, result.cached_dirs) == (3, 0)
+    assert str(root / "b" / "c.safetensors") in result.files
+
+
+def test_recent_directories_are_listed_again(tmp_path):
+    (tmp_path / "models").mkdir()
+    (tmp_path / "models" / "a.safetensors").write_bytes(b"x")
+    db_api = DBApi(str(tmp_path / "db.sqlite"))
+    scanner = FileScanner(db_api)
+
+    # modified within mtime_granularity_ns of the scan, a change right after it could keep the same mtime
+    scanner.scan([str(tmp_path / "models")])
+    assert scanner.scan([str(tmp_path / "models")]).scanned_dirs == 1
+    db_api.conn.close()
@@ -0,0 +1,94 @@
+import pytest
+
+from src.db import DBApi, fts_query
+from src.models import CivitaiModel, FileFingerprint
+
+
+def make_model(model_id: int, name: str, trained_words: list[str], tags: list[str] | None = None) -> CivitaiModel:
+    return CivitaiModel.model_validate(
+        {
+            "id": model_id,
+            "name": name,
+            "type": "LORA",
+            "tags": tags,
+            "modelVersions": [
+                {
+                    "id": model_id * 10 + index,
+                    "modelId": model_id,
+                    "name": f"v{index}",
+                    "trainedWords": trained_words,
+                    "baseModel": base_model,
+                    "downloadUrl": f"https://civitai.test/api/download/models/{model_id * 10 + index}",
+                    "files": [],
+                }
+                for index, base_model in enumerate(("SDXL 1.0", "Pony"))
+            ],
+        },
+    )
+
+
+@pytest.fixture
+def db_api(tmp_path):
+    db_api = DBApi(str(tmp_path / "db.sqlite"))
+    db_api.upsert_model(make_model(1, "Watercolor Style", ["wtrclr"], tags=["painting"]))
+    db_api.upsert_model(make_model(2, "Cyberpunk City", ["neon lights"]))
+    yield db_api
+    db_api.conn.close()
+
+
+def search(db_api: DBApi, query: str, local_only: bool = False) -> list[int]:
+    return [hit.modelversionid for hit in db_api.search(query, local_only=local_only)]
+
+
+def test_inserted_versions_are_found(db_api):
+    assert sorted(search(db_api, "watercolor")) == [10, 11]
+    assert sorted(search(db_api, "wtrclr")) == [10, 11]
+    assert sorted(search(db_api, "painting")) == [10, 11]
+    assert search(db_api, "cyberpunk pony") == [21]
+    assert search(db_api, "watercolor cyberpunk") == []
+
+
+def test_renames_are_reindexed(db_api):
+    db_api.upsert_model(make_model(1, "Ink Wash", ["wtrclr"], tags=["painting"]))
+    assert search(db_api, "watercolor") == []
+    assert sorted(search(db_api, "ink wash")) == [10, 11]
+
+    # a version found by hash, renamed and with other trigger words
+    model_version = make_model(2, "Cyberpunk City", ["rain"]).modelVersions[0]
+    model_version.name = "Night edition"
+    db_api.upsert_model_version(model_version)
+    assert search(db_api, "night") == [20]
+    assert search(db_api, "neon") == [21]
+    assert search(db_api, "rain") == [20]
+
+
+def test_words_match_as_prefixes(db_api):
+    assert sorted(search(db_api, "water")) == [10, 11]
+    assert sorted(search(db_api, "cyb ne")) == [20, 21]
+    assert search(db_api, "colour") == []
+
+
+@pytest.mark.parametrize("query", ['"watercolor', "watercolor*", "(watercolor)", "-watercolor", "water^", "wtrclr:"])
+def test_fts_syntax_of_queries_is_dropped(db_api, query):
+    assert sorted(search(db_api, query)) == [10, 11]
+
+
+def test_operators_are_plain_words(db_api):
+    assert fts_query("watercolor OR name:cyberpunk") == '"watercolor"* "OR"* "name"* "cyberpunk"*'
+    assert search(db_api, "watercolor OR cyberpunk") == []
+    assert search(db_api, "NOT watercolor") == []
+
+
+def test_queries_without_words_find_nothing(db_api):
+    assert fts_query('"* () ^') == ""
+    assert search(db_api, '"* () ^') == []
+
+
+def test_local_only(db_api):
+    db_api.update_filehash("/models/a.safetensors", "a" * 64, FileFingerprint(size=1, mtime_ns=1, inode=1))
+    db_api.update_data("/models/a.safetensors", 1, 11)
+
+    assert sorted(search(db_api, "watercolor")) == [10, 11]
+    assert search(db_api, "watercolor", local_only=True) == [11]
+    assert search(db_api, "cyberpunk", local_only=True) == []
+    assert db_api.search("watercolor", local_only=True)[0].filepath == "/models/a.safetensors"
@@ -0,0 +1,120 @@
+import httpx
+import pytest
+
+from benchmarks.render import make_models
+
+from src.civitai import AsyncCivitai
+from src.db import DBApi
+from src.mdgenerator import model_to_markdown, models_to_markdown
+from src.metadata import MetadataManipulator
+from src.models import FileFingerprint, Settings
+from src.run import write_model_pages
+from src.sitewriter import SiteWriter
+
+
+@pytest.fixture
+def site(tmp_path):
+    for folder in ("models", "loras"):
+        (tmp_path / folder).mkdir()
+    db_api = DBApi(str(tmp_path / "db.sqlite"))
+    api = AsyncCivitai(
+        "https://civitai.test/api/v1",
+        "token",
+        transport=httpx.MockTransport(lambda request: httpx.Response(404, json={"error": "Not found"})),
+    )
+    meta = MetadataManipulator(
+        csv_file_path="",
+        base_path=str(tmp_path),
+        models_path="models",
+        loras_path="loras",
+        work_dir=str(tmp_path / "work"),
+        civitai_api=api,
+        db_api=db_api,
+    )
+    models = make_models(3, images=2)
+    for model in models:
+        model.id += 1  # model id 0 reads as missing
+        for model_version in model.modelVersions:
+            model_version.modelId = model.id
+        db_api.upsert_model(model)
+        # the first version of every model has a local file
+        fingerprint = FileFingerprint(size=1, mtime_ns=1, inode=model.id)
+        db_api.update_filehash(f"/models/{model.id}.safetensors", f"{model.id:064x}", fingerprint)
+        db_api.update_data(f"/models/{model.id}.safetensors", model.id, model.modelVersions[0].id)
+    meta.model_ids = {model.id for model in models}
+
+    settings = Settings(
+        CIVITAI_API_BASE_URL="https://civitai.test/api/v1",
+        CIVITAI_API_TOKEN="token",  # noqa: S106
+        MODEL_LIST_FILE="",
+        BASE_PATH=str(tmp_path),
+        WORK_DIR=str(tmp_path / "work"),
+        MODELS_PATH="models",
+        LORAS_PATH="loras",
+    )
+    loaded: list[list[int]] = []
+    iter_models = meta.iter_models
+
+    def spy(model_ids=None, images=True):
+        loaded.append(sorted(model_ids))
+        return iter_models(model_ids, images)
+
+    meta.iter_models = spy
+
+    def write() -> list[int]:
+        write_model_pages(settings, SiteWriter(db_api, meta.work_dir), meta, meta.model_ids)
+        return loaded.pop()
+
+    yield db_api, models, write
+    db_api.conn.close()
+
+
+def test_only_changed_models_are_loaded(site):
+    db_api, models, write = site
+
+    assert write() == [1, 2, 3]
+    assert write() == []
+
+    # the same data fetched again
+    db_api.upsert_model(models[1])
+    assert write() == []
+
+    models[1].name = "Renamed"
+    db_api.upsert_model(models[1])
+    assert write() == [2]
+
+    db_api.update_filehash("/models/new.safetensors", "f" * 64, FileFingerprint(size=1, mtime_ns=1, inode=9))
+    db_api.update_data("/models/new.safetensors", 3, models[2].modelVersions[1].id)
+    assert write() == [3]
+
+    # a version found by hash may differ from what the model endpoint sent
+    db_api.upsert_model_version(models[0].modelVersions[2])
+    assert write() == [1]
+
+
+def test_pages_show_which_versions_are_local(site, tmp_path):
+    db_api, models, write = site
+    write()
+
+    page = (tmp_path / "work" / "LORA" / "model-3.md").read_text()
+    assert page.count("## ✅") == 1
+    assert page.count("## ❌") == 2
+
+    db_api.update_filehash("/models/new.safetensors", "f" * 64, FileFingerprint(size=1, mtime_ns=1, inode=9))
+    db_api.update_data("/models/new.safetensors", 3, models[2].modelVersions[1].id)
+    write()
+
+    page = (tmp_path / "work" / "LORA" / "model-3.md").read_text()
+    assert page.count("## ✅") == 2
+
+
+def test_index_and_model_pages_show_the_same_stats():
+    model = make_models(1, versions=1, images=5)[0]
+    model.type = "Checkpoint"
+    model_page, index = model_to_markdown(model), models_to_markdown([model])
+
+    samplers = model.modelVersions[0].generation_stats().samplers
+    assert list(samplers) == ["DPM++ 2M Karras"]
+    lines = [line for line in model_page.splitlines() if "🎚️" in line or "👣" in line]
+    assert any("median" in line for line in lines)
+    assert lines == [line for line in index.splitlines() if "🎚️" in line or "👣" in line]
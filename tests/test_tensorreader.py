@@ -0,0 +1,138 @@
+import json
+import os
+import struct
+
+import numpy as np
+import pytest
+
+from benchmarks.library import make_library, safetensors_bytes
+
+import src.tensorreader
+
+from src.db import DBApi
+from src.tensorreader import IntegrityChecker, SafetensorsError, validate_safetensors_header
+
+
+@pytest.fixture
+def library(tmp_path):
+    # the corrupted files are 0, 6 and 12 with a header that doesn't parse and 19 truncated
+    return make_library(str(tmp_path / "library"), files_count=20, size=4096, corrupt=4, seed=1)
+
+
+@pytest.fixture
+def db_api(tmp_path):
+    db_api = DBApi(str(tmp_path / "db.sqlite"))
+    yield db_api
+    db_api.conn.close()
+
+
+def write_safetensors(path, header: dict, data: bytes) -> str:
+    encoded = json.dumps(header).encode()
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(encoded)) + encoded + data)
+    return str(path)
+
+
+def test_corrupted_files_of_the_library_are_found(library):
+    paths = library.paths()
+    problems = IntegrityChecker(level="header", workers=2).check(paths)
+
+    assert sorted(problems) == sorted(path for path, file in zip(paths, library.files, strict=True) if file.corrupted)
+    assert problems[paths[0]].startswith("header isn't valid JSON")
+    assert problems[paths[19]].startswith("tensors take")
+
+
+@pytest.mark.parametrize(
+    ("content", "error"),
+    [
+        (b"", "file is too short"),
+        (b"\x10\x00\x00", "file is too short"),
+        (struct.pack("<Q", 1 << 40) + b"{}", "doesn't fit the file"),
+        (struct.pack("<Q", 100) + b"{}", "doesn't fit the file"),
+        (struct.pack("<Q", 2) + b"[]", "header isn't a JSON object"),
+        (struct.pack("<Q", 2) + b"\xff\xfe", "header isn't valid JSON"),
+    ],
+)
+def test_unreadable_headers(tmp_path, content, error):
+    path = tmp_path / "broken.safetensors"
+    path.write_bytes(content)
+    problems = IntegrityChecker().check([str(path)])
+    assert error in problems[str(path)]
+
+
+def test_truncated_file(tmp_path):
+    content = safetensors_bytes("lora", 4096, np.random.default_rng(0))
+    path = tmp_path / "truncated.safetensors"
+    path.write_bytes(content[:-1])
+    assert "tensors take" in IntegrityChecker().check([str(path)])[str(path)]
+
+
+def test_data_offsets_beyond_the_end_of_the_file(tmp_path):
+    header = {
+        "a": {"dtype": "F16", "shape": [4], "data_offsets": [0, 8]},
+        "b": {"dtype": "F16", "shape": [4], "data_offsets": [8, 16]},
+    }
+    path = write_safetensors(tmp_path / "short.safetensors", header, b"\0" * 12)
+
+    assert IntegrityChecker().check([path]) == {path: "tensors take 16 bytes, the file has 12 after the header"}
+    with pytest.raises(SafetensorsError, match="tensors take 16 bytes"):
+        validate_safetensors_header(header, 12)
+
+
+@pytest.mark.parametrize(
+    ("tensor", "error"),
+    [
+        ({"dtype": "F17", "shape": [4], "data_offsets": [0, 8]}, "unknown dtype"),
+        ({"dtype": "F16", "shape": [-4], "data_offsets": [0, 8]}, "invalid shape"),
+        ({"dtype": "F16", "shape": [4], "data_offsets": [8, 0]}, "invalid data_offsets"),
+        ({"dtype": "F16", "shape": [4], "data_offsets": [0, 6]}, r"6 bytes for F16\[4\]"),
+        ({"dtype": "F16", "shape": [4], "data_offsets": [2, 10]}, "has a gap at 2"),
+    ],
+)
+def test_invalid_tensors(tensor, error):
+    with pytest.raises(SafetensorsError, match=error):
+        validate_safetensors_header({"t": tensor}, 10)
+
+
+def test_unchanged_files_are_not_checked_again(library, db_api, monkeypatch):
+    checked: list[str] = []
+    check_safetensors = src.tensorreader.check_safetensors
+
+    def spy(path, *args):
+        checked.append(path)
+        return check_safetensors(path, *args)
+
+    monkeypatch.setattr(src.tensorreader, "check_safetensors", spy)
+    paths = library.paths()
+
+    first = IntegrityChecker(db_api, workers=2).check(paths)
+    assert sorted(checked) == sorted(paths)
+    assert set(db_api.get_safetensors_headers()) == {path for path in paths if path not in first}
+
+    checked.clear()
+    assert IntegrityChecker(db_api, workers=2).check(paths) == first
+    assert checked == []
+
+    # a touched file is checked again, even if its content is the same
+    stat = os.stat(paths[1])
+    os.utime(paths[1], ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert IntegrityChecker(db_api, workers=2).check(paths) == first
+    assert checked == [paths[1]]
+
+
+def test_checksums_find_changes_that_keep_the_fingerprint(library, db_api):
+    path = library.paths()[1]
+    assert IntegrityChecker(db_api, level="sample").check([path]) == {}
+
+    # bit rot: the content changes, size and mtime stay
+    stat = os.stat(path)
+    with open(path, "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 0xFF]))
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    # the header level trusts the stored result
+    assert IntegrityChecker(db_api, level="header").check([path]) == {}
+    assert IntegrityChecker(db_api, level="sample").check([path])[path].startswith("sample checksum changed")